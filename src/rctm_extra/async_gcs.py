@@ -0,0 +1,252 @@
+import asyncio
+import base64
+import hashlib
+import os
+import random
+import re
+import time
+from urllib.parse import quote
+
+import aiohttp
+import google.auth.transport.requests
+from google.api_core.exceptions import from_http_status
+
+from rctm_extra.local_storage import glob_to_regex
+
+# statuses GCS asks clients to retry with exponential backoff
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+BACKOFF_RETRIES = 8
+BACKOFF_INITIAL = 0.5
+BACKOFF_MAX = 32
+# larger objects go through the sliced and resumable transfers of `TransferManager`
+MAX_OBJECT_SIZE = 8 * 1024 * 1024
+LIST_PAGE_SIZE = 5000
+LIST_FIELDS = "items(name,md5Hash),prefixes,nextPageToken"
+
+
+def backoff(retry: int) -> float:
+    """Exponential backoff with full jitter, so clients throttled together don't retry together."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_INITIAL * 2 ** retry))
+
+
+def retry_after(response) -> float:
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return None
+
+
+def md5_base64(data: bytes) -> str:
+    return base64.b64encode(hashlib.md5(data).digest()).decode()
+
+
+class AsyncStorage:
+    """
+    Lists blobs and moves small files with asyncio against the GCS JSON API, keeping up to
+    `concurrency` requests in flight on one connection pool and as many small files in memory.
+    The limit is per call of `download_files`, `upload_files` or `list_checksums`: every call
+    runs its own event loop and session, so calls from several threads at once, like the uploads
+    of a pipelined split, can each have that many requests in flight. Requests that hit a rate limit
+    or a transient error are retried with exponential backoff, honouring Retry-After.
+    Uses the endpoint and the credentials of `storage_client`, so STORAGE_EMULATOR_HOST
+    points it at a local stand-in of the storage API the same way as the regular client.
+    """
+
+    def __init__(self, storage_client, bucket_name: str, concurrency: int, transfer_manager=None):
+        self.bucket_name = bucket_name
+        self.concurrency = concurrency
+        self.transfer_manager = transfer_manager
+        self.base_url = storage_client._connection.API_BASE_URL.rstrip("/")
+        self.credentials = storage_client._credentials
+        self.session = None
+        self.slots = None
+        self.buffers = None
+        self.token_lock = None
+
+    async def _open(self) -> None:
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency))
+        self.slots = asyncio.Semaphore(self.concurrency)
+        # files held in memory, not `slots`, which every request attempt takes again
+        self.buffers = asyncio.Semaphore(self.concurrency)
+        self.token_lock = asyncio.Lock()
+
+    async def _close(self) -> None:
+        await self.session.close()
+        self.session = None
+
+    def _call(self, coroutine_function, *args):
+        async def main():
+            await self._open()
+            try:
+                return await coroutine_function(*args)
+            finally:
+                await self._close()
+
+        return asyncio.run(main())
+
+    async def _headers(self) -> dict:
+        async with self.token_lock:
+            if not self.credentials.valid:
+                await asyncio.to_thread(self.credentials.refresh, google.auth.transport.requests.Request())
+
+        headers = {}
+        self.credentials.apply(headers)
+        return headers
+
+    async def _request(self, method: str, url: str, handle, **kwargs) -> tuple:
+        """
+        Send a request and pass the response to the coroutine `handle`.
+        Returns what `handle` returned and the number of retries it took.
+        """
+        for retry in range(BACKOFF_RETRIES + 1):
+            delay = None
+            async with self.slots:
+                try:
+                    async with self.session.request(method, url, headers=await self._headers(), **kwargs) as response:
+                        if response.status < 400:
+                            return await handle(response), retry
+                        if response.status not in RETRYABLE_STATUSES or retry == BACKOFF_RETRIES:
+                            raise from_http_status(response.status, f"{method} {url}: {await response.text()}")
+                        delay = retry_after(response)
+                except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError):
+                    if retry == BACKOFF_RETRIES:
+                        raise
+            await asyncio.sleep(backoff(retry) if delay is None else delay)
+
+    def _object_url(self, blob_name: str) -> str:
+        return f"{self.base_url}/storage/v1/b/{self.bucket_name}/o/{quote(blob_name, safe='')}"
+
+    async def _download(self, blob_name: str, destination: str) -> int:
+        async def read(response):
+            if int(response.headers.get("Content-Length", 0)) > MAX_OBJECT_SIZE:
+                return None
+            # x-goog-hash comes once per checksum type or once with all of them
+            hashes = [value.strip() for header in response.headers.getall("x-goog-hash", []) for value in header.split(",")]
+            return await response.read(), hashes
+
+        async with self.buffers:
+            result, retries = await self._request("GET", self._object_url(blob_name), read, params={"alt": "media"})
+            if result is not None:
+                data, hashes = result
+                expected = [value[4:] for value in hashes if value.startswith("md5=")]
+                if expected and md5_base64(data) not in expected:
+                    raise ValueError(f"checksum mismatch downloading {blob_name}")
+
+                await asyncio.to_thread(_write_file, destination, data)
+                return retries
+
+        async with self.slots:
+            more_retries, _ = await asyncio.to_thread(self.transfer_manager._attempt, self.transfer_manager.download, (blob_name, destination))
+        return retries + more_retries
+
+    async def _upload(self, local_path: str, blob_name: str) -> int:
+        if os.path.getsize(local_path) > MAX_OBJECT_SIZE:
+            async with self.slots:
+                retries, _ = await asyncio.to_thread(self.transfer_manager._attempt, self.transfer_manager.upload_file, (local_path, blob_name))
+            return retries
+
+        async def read(response):
+            return (await response.json()).get("md5Hash")
+
+        url = f"{self.base_url}/upload/storage/v1/b/{self.bucket_name}/o"
+        params = {"uploadType": "media", "name": blob_name}
+        # only read once there is room, otherwise every pending upload would sit in memory
+        async with self.buffers:
+            data = await asyncio.to_thread(_read_file, local_path)
+            md5, retries = await self._request("POST", url, read, params=params, data=data)
+            if md5 is not None and md5 != md5_base64(data):
+                raise ValueError(f"checksum mismatch uploading {local_path}")
+
+        return retries
+
+    async def _transfer(self, func, task: tuple, progress, local_index: int):
+        start = time.perf_counter()
+        try:
+            retries = await func(*task)
+        except Exception as e:
+            if progress is not None:
+                progress.advance(task[0], error=e)
+            return task[0], e
+
+        if progress is not None:
+            progress.advance(task[0], seconds=time.perf_counter() - start, nbytes=os.path.getsize(task[local_index]), retries=retries)
+
+    async def _run(self, func, tasks: list, progress, local_index: int) -> list:
+        results = await asyncio.gather(*(self._transfer(func, task, progress, local_index) for task in tasks))
+        return [failure for failure in results if failure is not None]
+
+    def download_files(self, tasks: list, progress=None) -> list:
+        """Like `TransferManager.download_files`."""
+        return self._call(self._run, self._download, tasks, progress, 1)
+
+    def upload_files(self, tasks: list, progress=None) -> list:
+        """Like `TransferManager.upload_files`."""
+        return self._call(self._run, self._upload, tasks, progress, 0)
+
+    async def _list(self, prefix: str, match_glob: str = None, delimiter: str = None, pages: int = None) -> tuple:
+        """
+        Page through one listing, or through its first `pages` pages.
+        Returns `{name: md5}` of its blobs, its prefixes and whether pages were left out.
+        """
+        params = {"prefix": prefix, "maxResults": str(LIST_PAGE_SIZE), "fields": LIST_FIELDS}
+        if match_glob:
+            params["matchGlob"] = match_glob
+        if delimiter:
+            params["delimiter"] = delimiter
+
+        async def read(response):
+            return await response.json()
+
+        checksums, prefixes = {}, []
+        page_count = 0
+        while True:
+            page, _ = await self._request("GET", f"{self.base_url}/storage/v1/b/{self.bucket_name}/o", read, params=params)
+            checksums.update((item["name"], item.get("md5Hash")) for item in page.get("items", []))
+            prefixes.extend(page.get("prefixes", []))
+            page_count += 1
+            if not page.get("nextPageToken") or page_count == pages:
+                return checksums, prefixes, bool(page.get("nextPageToken"))
+            params["pageToken"] = page["nextPageToken"]
+
+    async def _list_checksums(self, prefix: str, match_glob: str = None) -> dict:
+        if match_glob:
+            # the glob is matched on the server, so the pages only hold what the caller asked for
+            return (await self._list(prefix, match_glob))[0]
+
+        checksums, _, truncated = await self._list(prefix, pages=1)
+        if not truncated:
+            return checksums
+
+        # the pages of one listing come one after another, so a listing of more than a page
+        # is split into the directories two levels down, usually the batches of a run,
+        # and those are listed side by side
+        checksums, prefixes, _ = await self._list(prefix, delimiter="/")
+        batch_prefixes = []
+        for level_checksums, level_prefixes, _ in await asyncio.gather(*(self._list(sub_prefix, delimiter="/") for sub_prefix in prefixes)):
+            checksums.update(level_checksums)
+            batch_prefixes.extend(level_prefixes)
+
+        for level_checksums, _, _ in await asyncio.gather(*(self._list(sub_prefix) for sub_prefix in batch_prefixes)):
+            checksums.update(level_checksums)
+
+        return checksums
+
+    def list_checksums(self, prefix: str, match_glob: str = None) -> dict:
+        """Returns `{blob name: md5}` of the blobs under `prefix` that match `match_glob`."""
+        checksums = self._call(self._list_checksums, prefix, match_glob)
+        # stand-ins of the storage API don't all implement matchGlob
+        if match_glob:
+            pattern = re.compile(glob_to_regex(match_glob))
+            checksums = {name: md5 for name, md5 in checksums.items() if pattern.fullmatch(name)}
+
+        return checksums
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def _write_file(path: str, data: bytes) -> None:
+    with open(path, "wb") as file:
+        file.write(data)
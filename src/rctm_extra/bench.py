@@ -0,0 +1,216 @@
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from importlib import metadata
+
+import netCDF4
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+# variables of the synthetic input files, the real ones have more but the same layout
+INPUT_VARIABLES = ["ndvi", "tmean", "precip"]
+PARAM_BANDS = 3
+# the modules each command of the CLI imports when it runs
+COMMAND_MODULES = {
+    "init": "rctm_extra.cmd.init",
+    "split": "rctm_extra.cmd.split",
+    "submit": "rctm_extra.cmd.submit",
+    "run": "rctm_extra.cmd.run",
+    "merge": "rctm_extra.cmd.merge",
+    "status": "rctm_extra.cmd.status",
+    "bench": "rctm_extra.cmd.bench",
+    "profile": "rctm_extra.cmd.profile",
+}
+# the best of this many fresh interpreters counts, the first one also warms the file cache
+IMPORT_REPEATS = 3
+
+
+def make_synthetic_site(directory: str, x_size: int, y_size: int, time_steps: int, spin_time_steps: int = 4, empty_fraction: float = 0.3, seed: int = 0) -> dict:
+    """
+    Write RCTM_inputs.nc, RCTM_spin_inputs.nc and spatial_params.tif of an `x_size` x `y_size` grid
+    into `directory`. The first `empty_fraction` of the columns has no data, like the area outside a site.
+    The files are written one time step or band at a time, so large grids don't have to fit in memory.
+    Returns the path of each file by tile kind.
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    empty_columns = int(x_size * empty_fraction)
+    x = 500000 + 30.0 * np.arange(x_size)
+    y = 4000000 - 30.0 * np.arange(y_size)
+
+    paths = {
+        "input": os.path.join(directory, "RCTM_inputs.nc"),
+        "spin_input": os.path.join(directory, "RCTM_spin_inputs.nc"),
+        "params": os.path.join(directory, "spatial_params.tif"),
+    }
+    for kind, steps in (("input", time_steps), ("spin_input", spin_time_steps)):
+        with netCDF4.Dataset(paths[kind], "w") as ds:
+            ds.createDimension("time", steps)
+            ds.createDimension("y", y_size)
+            ds.createDimension("x", x_size)
+            times = ds.createVariable("time", "f8", ("time",))
+            times.units = "days since 2000-01-01"
+            times.calendar = "standard"
+            times[:] = 30 * np.arange(steps)
+            ds.createVariable("y", "f8", ("y",))[:] = y
+            ds.createVariable("x", "f8", ("x",))[:] = x
+            for name in INPUT_VARIABLES:
+                var = ds.createVariable(name, "f8", ("time", "y", "x"), fill_value=np.nan)
+                for step in range(steps):
+                    values = rng.random((y_size, x_size))
+                    values[:, :empty_columns] = np.nan
+                    var[step] = values
+
+    profile = {
+        "driver": "GTiff",
+        "width": x_size,
+        "height": y_size,
+        "count": PARAM_BANDS,
+        "dtype": "float32",
+        "nodata": np.nan,
+        "crs": "EPSG:32613",
+        "transform": from_origin(x[0] - 15, y[0] + 15, 30, 30),
+        "tiled": True,
+        "compress": "deflate",
+        "BIGTIFF": "IF_SAFER",
+    }
+    with rasterio.open(paths["params"], "w", **profile) as dst:
+        for band in range(1, PARAM_BANDS + 1):
+            values = rng.random((y_size, x_size), dtype=np.float32)
+            values[:, :empty_columns] = np.nan
+            dst.write(values, band)
+
+    return paths
+
+
+def _written_bytes() -> int:
+    """Bytes the process and its reaped children passed to write calls, None where /proc isn't there."""
+    try:
+        with open("/proc/self/io") as file:
+            for line in file:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def _measure(func, connection) -> None:
+    written_before = _written_bytes()
+    start = time.perf_counter()
+    try:
+        items = func()
+        error = None
+    except Exception as e:
+        items = None
+        error = repr(e)
+    wall_time = time.perf_counter() - start
+
+    written_after = _written_bytes()
+    # ru_maxrss is in KiB on Linux, the children are the process pools of the stage
+    peak_rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    ) * 1024
+    connection.send({
+        "wall_time": wall_time,
+        "peak_rss": peak_rss,
+        "bytes_written": None if written_before is None else written_after - written_before,
+        "items": items,
+        "error": error,
+    })
+    connection.close()
+
+
+def run_stage(func) -> dict:
+    """
+    Run `func` in a forked process and measure its wall time, peak RSS and bytes written,
+    so every stage starts from the same memory footprint. `func` returns the number of items it handled.
+    """
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_measure, args=(func, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {"error": "the stage process died"}
+    process.join()
+    if process.exitcode:
+        result["error"] = result.get("error") or f"exit code {process.exitcode}"
+
+    return result
+
+
+def _parse_importtime(output: str) -> dict:
+    """Cumulative seconds of every top-level import in the output of `python -X importtime`."""
+    modules = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        # nested imports are indented below the one that pulled them in
+        if name[1:].startswith(" ") or not cumulative.strip().isdigit():
+            continue
+        modules[name.strip()] = int(cumulative) / 1e6
+
+    return modules
+
+
+def measure_imports(modules: list) -> dict:
+    """
+    Import `modules` in a fresh interpreter with `-X importtime`.
+    Returns the seconds all imports took, including the interpreter's own, and the heaviest top-level ones.
+    """
+    statement = "; ".join(f"import {module}" for module in modules) or "pass"
+    best = None
+    for _ in range(IMPORT_REPEATS):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], capture_output=True, text=True, check=True)
+        imports = _parse_importtime(result.stderr)
+        if best is None or sum(imports.values()) < sum(best.values()):
+            best = imports
+
+    return {
+        "wall_time": sum(best.values()),
+        "peak_rss": None,
+        "bytes_written": None,
+        "items": len(best),
+        "error": None,
+        "heaviest": sorted(best.items(), key=lambda item: item[1], reverse=True)[:5],
+    }
+
+
+def environment() -> dict:
+    try:
+        version = metadata.version("rctm-extra")
+    except metadata.PackageNotFoundError:
+        version = None
+
+    return {
+        "version": version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def compare_results(current: dict, baseline: dict) -> list:
+    """Returns `(stage, metric, baseline value, current value, ratio)` for every measurement both runs have."""
+    rows = []
+    for stage, metrics in current["stages"].items():
+        previous = baseline.get("stages", {}).get(stage)
+        if previous is None:
+            continue
+        for metric in ("wall_time", "peak_rss", "bytes_written"):
+            before, after = previous.get(metric), metrics.get(metric)
+            if before is None or after is None:
+                continue
+            rows.append((stage, metric, before, after, after / before if before else None))
+
+    return rows
@@ -0,0 +1,207 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from contextlib import ExitStack, contextmanager
+
+import yaml
+
+# keys of a batch config that point at files every batch shares
+SHARED_CONFIG_KEYS = [
+    "C_stock_inits_yaml",
+    "path_to_RCTM_params",
+    "path_to_geometry_local",
+    "starfm_config",
+    "starfm_source",
+    "workflows_path",
+]
+DEFAULT_CACHE_SIZE = 1024 ** 3
+
+
+def default_cache_directory() -> str:
+    # TMPDIR usually points at node-local disk on the cluster
+    return os.path.join(tempfile.gettempdir(), "rctm_extra_cache")
+
+
+def fingerprint(path: str) -> list:
+    """The relative path, size and modification time of every file under `path`, or of `path` itself."""
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return [["", stat.st_size, stat.st_mtime_ns]]
+
+    files = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            file_path = os.path.join(dirpath, filename)
+            stat = os.stat(file_path)
+            files.append([os.path.relpath(file_path, path), stat.st_size, stat.st_mtime_ns])
+
+    return files
+
+
+def content_key(path: str) -> str:
+    """
+    SHA-256 of the name and content of a file, or of a directory with the names and contents
+    of its files. The name is part of it because the cached copy keeps it.
+    """
+    digest = hashlib.sha256(os.path.basename(path).encode() + b"\0")
+    for relative_path, _, _ in fingerprint(path):
+        digest.update(relative_path.encode() + b"\0")
+        with open(os.path.join(path, relative_path) if relative_path else path, "rb") as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                digest.update(chunk)
+        digest.update(b"\0")
+
+    return digest.hexdigest()
+
+
+def directory_size(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+
+    return sum(
+        os.path.getsize(os.path.join(dirpath, filename))
+        for dirpath, _, filenames in os.walk(path)
+        for filename in filenames
+    )
+
+
+class NodeCache:
+    """
+    Copies of shared files and directories on node-local disk, stored under the hash of their
+    content, so every job on a node reads one copy instead of the shared filesystem.
+    Jobs hold a shared lock on the entries they use; the least recently used entries
+    nobody holds are evicted once the cache grows over `max_bytes`.
+    """
+
+    def __init__(self, root: str = None, max_bytes: int = DEFAULT_CACHE_SIZE):
+        self.root = root or default_cache_directory()
+        self.max_bytes = max_bytes
+
+    def _key(self, path: str) -> str:
+        """The content key of `path`, only hashed again when its files changed since the last time."""
+        index_path = os.path.join(self.root, "index", hashlib.sha256(path.encode()).hexdigest())
+        current = fingerprint(path)
+        try:
+            with open(index_path) as file:
+                index = json.load(file)
+            if index["fingerprint"] == current:
+                return index["key"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+        key = content_key(path)
+        tmp_path = f"{index_path}.{os.getpid()}"
+        with open(tmp_path, "w") as file:
+            json.dump({"path": path, "fingerprint": current, "key": key}, file)
+        os.replace(tmp_path, index_path)
+        return key
+
+    def _entry(self, path: str, stack: ExitStack, held: set) -> str:
+        """
+        Stage `path` unless it's already cached and lock its entry until `stack` closes.
+        `held` are the keys already locked on `stack`. Returns the cached copy.
+        """
+        key = self._key(path)
+        entry = os.path.join(self.root, "objects", key)
+        cached_path = os.path.join(entry, os.path.basename(path))
+        if key in held:
+            # another lock on the same file from this process would wait for the one it holds
+            return cached_path
+
+        held.add(key)
+        lock = stack.enter_context(open(f"{entry}.lock", "a"))
+        while True:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(entry):
+                tmp_entry = f"{entry}.{os.getpid()}"
+                shutil.rmtree(tmp_entry, ignore_errors=True)
+                os.makedirs(tmp_entry)
+                if os.path.isdir(path):
+                    shutil.copytree(path, os.path.join(tmp_entry, os.path.basename(path)))
+                else:
+                    shutil.copy2(path, os.path.join(tmp_entry, os.path.basename(path)))
+                os.rename(tmp_entry, entry)
+            # marks the entry as recently used for eviction
+            os.utime(entry)
+            # flock can't turn an exclusive lock into a shared one atomically, another job's
+            # evict() may take the entry in between. stage it again if it did
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            if os.path.exists(entry):
+                return cached_path
+
+    def evict(self) -> int:
+        """Remove the least recently used entries no job holds until the cache fits `max_bytes`. Returns the bytes freed."""
+        objects = os.path.join(self.root, "objects")
+        entries = []
+        for name in os.listdir(objects):
+            entry = os.path.join(objects, name)
+            if os.path.isdir(entry) and "." not in name:
+                entries.append((os.path.getmtime(entry), entry, directory_size(entry)))
+
+        total = sum(size for _, _, size in entries)
+        freed = 0
+        for _, entry, size in sorted(entries):
+            if total - freed <= self.max_bytes:
+                break
+            with open(f"{entry}.lock", "a") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                shutil.rmtree(entry, ignore_errors=True)
+                freed += size
+
+        return freed
+
+    @contextmanager
+    def use(self, paths: list):
+        """
+        Make node-local copies of `paths` available while the context is open.
+        Yields `path -> cached path`.
+        """
+        os.makedirs(os.path.join(self.root, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(self.root, "index"), exist_ok=True)
+        with ExitStack() as stack:
+            held = set()
+            cached = {path: self._entry(path, stack, held) for path in paths}
+            with open(os.path.join(self.root, "evict.lock"), "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                self.evict()
+            yield cached
+
+
+def shared_config_paths(config_data: dict) -> dict:
+    """Returns `config key -> path` of the shared files a batch config points at that exist on this node."""
+    paths = {}
+    for key in SHARED_CONFIG_KEYS:
+        value = config_data.get(key)
+        if isinstance(value, str) and os.path.exists(value):
+            paths[key] = os.path.normpath(value)
+
+    return paths
+
+
+@contextmanager
+def cached_config(config_path: str, cache: NodeCache, directory: str):
+    """
+    Write a copy of a batch config into `directory` whose shared files point at their copies
+    in the node cache, and yield its path. The copies stay locked while the context is open.
+    """
+    with open(config_path) as file:
+        config_data = yaml.safe_load(file)
+
+    paths = shared_config_paths(config_data)
+    with cache.use(list(paths.values())) as cached:
+        for key, path in paths.items():
+            # RCTM joins file names onto directories like `starfm_source` that end with a slash
+            config_data[key] = cached[path] + ("/" if config_data[key].endswith("/") else "")
+        os.makedirs(directory, exist_ok=True)
+        local_config_path = os.path.join(directory, "config.yaml")
+        with open(local_config_path, "w") as file:
+            yaml.dump(config_data, file)
+        yield local_config_path
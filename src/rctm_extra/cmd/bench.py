@@ -0,0 +1,240 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from rctm_extra.bench import COMMAND_MODULES, compare_results, environment, make_synthetic_site, measure_imports, run_stage
+from rctm_extra.cmd.base import BaseCommand
+from rctm_extra.cmd.merge import MergeCommand
+from rctm_extra.cmd.split import SplitCommand
+from rctm_extra.cmd.submit import CONTROL_FILES
+from rctm_extra.encoding import EncodingProfile
+from rctm_extra.gcp import TransferManager, list_batch_files, list_blob_checksums
+from rctm_extra.io import compile_config_template, create_config_file, create_slurm_file
+from rctm_extra.local_storage import LocalStorageClient
+from rctm_extra.manifest import MANIFEST_NAME, build_manifest, save_manifest
+from rctm_extra.spatial import get_valid_cell_grid
+from rctm_extra.types import Batch
+
+BENCH_BUCKET = "bench"
+REMOTE_BATCH_PATH = "batches"
+# stages faster than this are mostly noise, --max-slowdown ignores them
+MIN_COMPARED_WALL_TIME = 0.1
+
+
+class BenchCommand(BaseCommand):
+    def __init__(self, args):
+        super().__init__(args)
+
+    def _stages(self, work_directory: str) -> list:
+        """The `(name, function)` pairs of the benchmarked stages, in the order they have to run."""
+        X, Y = self.args.x_size, self.args.y_size
+        workers = self.args.workers or os.cpu_count()
+        transfer_workers = self.args.transfer_workers
+        site_directory = os.path.join(work_directory, "site")
+        split_directory = os.path.join(work_directory, "split_data")
+        submit_directory = os.path.join(work_directory, "submit")
+        merge_directory = os.path.join(work_directory, "merged")
+        client = LocalStorageClient(os.path.join(work_directory, "bucket"))
+        os.makedirs(os.path.join(client.root, BENCH_BUCKET), exist_ok=True)
+
+        paths = {
+            "input": os.path.join(site_directory, "RCTM_inputs.nc"),
+            "spin_input": os.path.join(site_directory, "RCTM_spin_inputs.nc"),
+            "params": os.path.join(site_directory, "spatial_params.tif"),
+        }
+        config_data = {"bucket_name": BENCH_BUCKET, "gcloud_workflow_base_dir": "site"}
+        rctm_path = os.path.join(work_directory, "RCTM")
+        batch_objs = Batch.create_list(X, Y, split_directory)
+
+        def generate():
+            make_synthetic_site(site_directory, X, Y, self.args.time_steps)
+            return len(paths)
+
+        def create_list():
+            return len(Batch.create_list(X, Y, split_directory))
+
+        def valid_cell_grid():
+            grid = get_valid_cell_grid(paths["input"], paths["params"])
+            return int(grid.count((0, X), (0, Y)))
+
+        def split():
+            command = SplitCommand(type("Args", (), {})())
+            command._split_input_files(batch_objs, paths["input"], paths["spin_input"], paths["params"], workers, profile=EncodingProfile())
+            return len(batch_objs)
+
+        def config_files():
+            config_template = compile_config_template(config_data, REMOTE_BATCH_PATH, rctm_path)
+            for obj in batch_objs:
+                os.makedirs(obj.local_batch_path, exist_ok=True)
+                create_config_file(obj, config_template)
+            return len(batch_objs)
+
+        def slurm_files():
+            for obj in batch_objs:
+                create_slurm_file(obj)
+            return len(batch_objs)
+
+        def manifest():
+            save_manifest(build_manifest(batch_objs, dict.fromkeys(paths), {}, {}), os.path.join(split_directory, MANIFEST_NAME))
+            return len(batch_objs)
+
+        def upload():
+            transfer_manager = TransferManager(client, BENCH_BUCKET, workers=transfer_workers)
+            failures = transfer_manager.upload_directory(split_directory, split_directory, REMOTE_BATCH_PATH)
+            if failures:
+                raise failures[0][1]
+            return sum(len(files) for _, _, files in os.walk(split_directory))
+
+        def list_blobs():
+            checksums = list_blob_checksums(client, BENCH_BUCKET, REMOTE_BATCH_PATH)
+            list_batch_files(client, BENCH_BUCKET, REMOTE_BATCH_PATH, CONTROL_FILES)
+            return len(checksums)
+
+        def download():
+            tasks = []
+            for batch_name, files in list_batch_files(client, BENCH_BUCKET, REMOTE_BATCH_PATH, CONTROL_FILES).items():
+                os.makedirs(os.path.join(submit_directory, batch_name), exist_ok=True)
+                for file_name in files:
+                    tasks.append((f"{REMOTE_BATCH_PATH}/{batch_name}/{file_name}", os.path.join(submit_directory, batch_name, file_name)))
+            failures = TransferManager(client, BENCH_BUCKET, workers=transfer_workers).download_files(tasks)
+            if failures:
+                raise failures[0][1]
+            return len(tasks)
+
+        def merge():
+            # merges the input tiles back into one file, the batch outputs have the same layout
+            os.makedirs(merge_directory, exist_ok=True)
+            command = MergeCommand(type("Args", (), {"output_path": merge_directory})())
+            batches = {obj.name: (obj.x_range, obj.y_range) for obj in batch_objs}
+            problems = command._merge_file("RCTM_ins/RCTM_inputs.nc", batches, split_directory, X, Y, workers)
+            if problems:
+                raise RuntimeError(f"{len(problems)} batches couldn't be merged")
+            return len(batches)
+
+        return [
+            ("generate", generate),
+            ("create_list", create_list),
+            ("valid_cell_grid", valid_cell_grid),
+            ("split", split),
+            ("config_files", config_files),
+            ("slurm_files", slurm_files),
+            ("manifest", manifest),
+            ("upload", upload),
+            ("list_blobs", list_blobs),
+            ("download", download),
+            ("merge", merge),
+        ]
+
+    def _import_stages(self) -> list:
+        """The `(name, modules)` of the startup measurements: the bare interpreter, the CLI, and the CLI with each command."""
+        stages = [("import_interpreter", []), ("import_cli", ["rctm_extra.main"])]
+        for command, module in COMMAND_MODULES.items():
+            stages.append((f"import_{command}", ["rctm_extra.main", module]))
+        return stages
+
+    def _measure_imports(self, results: dict) -> bool:
+        """Print the startup cost of every command. Returns False if run got too slow to start."""
+        failed = False
+        for name, modules in self._import_stages():
+            try:
+                result = measure_imports(modules)
+            except subprocess.CalledProcessError as e:
+                result = {"error": e.stderr.strip().splitlines()[-1]}
+            results["stages"][name] = result
+            if result.get("error"):
+                failed = True
+                print(f"{name:<16} failed with error: {result['error']}")
+                continue
+
+            heaviest = ", ".join(f"{module} {seconds * 1000:.0f} ms" for module, seconds in result["heaviest"][:3])
+            print(f"{name:<16} {result['wall_time']:>9.3f} s {heaviest}")
+
+        stages = results["stages"]
+        if self.args.max_run_startup and not failed:
+            overhead = stages["import_run"]["wall_time"] - stages["import_interpreter"]["wall_time"]
+            if overhead > self.args.max_run_startup:
+                print(f"importing the run command takes {overhead:.3f} s over the bare interpreter, more than {self.args.max_run_startup} s")
+                failed = True
+
+        return not failed
+
+    def _compare(self, results: dict) -> bool:
+        """Print the change of every measurement against the baseline. Returns False if a stage got too slow."""
+        with open(self.args.compare_path) as file:
+            baseline = json.load(file)
+
+        print(f"\ncompared to {self.args.compare_path} (version {baseline.get('environment', {}).get('version')}):")
+        passed = True
+        for stage, metric, before, after, ratio in compare_results(results, baseline):
+            flag = ""
+            if (
+                self.args.max_slowdown
+                and metric == "wall_time"
+                and before >= MIN_COMPARED_WALL_TIME
+                and ratio > self.args.max_slowdown
+            ):
+                flag = "  <- slower"
+                passed = False
+            # seconds, or MiB for the memory and disk measurements
+            scale, unit = (1, "s") if metric == "wall_time" else (1024 ** 2, "MiB")
+            change = "-" if ratio is None else f"{ratio:.2f}x"
+            print(f"  {stage:<16} {metric:<14} {before / scale:>10.3f} {unit:<3} -> {after / scale:>10.3f} {unit:<3} {change:>7}{flag}")
+
+        return passed
+
+    def _save(self, results: dict) -> bool:
+        """Write the results and compare them with the baseline. Returns False if a stage got too slow."""
+        with open(self.args.output_path, "w") as file:
+            json.dump(results, file, indent=1, sort_keys=True)
+        print(f"results saved to {self.args.output_path}")
+
+        return not self.args.compare_path or self._compare(results)
+
+    def execute(self):
+        results = {
+            "environment": environment(),
+            "parameters": {
+                "x_size": self.args.x_size,
+                "y_size": self.args.y_size,
+                "time_steps": self.args.time_steps,
+                "workers": self.args.workers or os.cpu_count(),
+                "transfer_workers": self.args.transfer_workers,
+            },
+            "stages": {},
+        }
+        print("measuring the import time of every command")
+        failed = not self._measure_imports(results)
+        if self.args.imports_only:
+            if not self._save(results) or failed:
+                sys.exit(1)
+            return
+
+        work_directory = self.args.work_directory or tempfile.mkdtemp(prefix="rctm_extra_bench_")
+        os.makedirs(work_directory, exist_ok=True)
+        print(f"benchmarking a {self.args.x_size}x{self.args.y_size} grid with {self.args.time_steps} time steps in {work_directory}")
+        try:
+            for name, func in self._stages(work_directory):
+                result = run_stage(func)
+                results["stages"][name] = result
+                if result.get("error"):
+                    failed = True
+                    print(f"{name:<16} failed with error: {result['error']}")
+                    continue
+
+                written = result["bytes_written"]
+                print(
+                    f"{name:<16} {result['wall_time']:>9.3f} s {result['peak_rss'] / 1024 ** 2:>9.1f} MiB peak RSS "
+                    f"{'-' if written is None else f'{written / 1024 ** 2:.1f}':>9} MiB written {result['items']:>8} items"
+                )
+        finally:
+            if not self.args.keep and not self.args.work_directory:
+                shutil.rmtree(work_directory, ignore_errors=True)
+
+        if not self._save(results):
+            failed = True
+
+        if failed:
+            sys.exit(1)
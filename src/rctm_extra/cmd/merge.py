@@ -1,9 +1,210 @@
+import concurrent.futures
+import json
+import os
+import sys
+
+import netCDF4
+import rasterio
+from rasterio.windows import Window
+
 from rctm_extra.cmd.base import BaseCommand
+from rctm_extra.gcp import TransferManager, get_storage_client, list_batch_files
+from rctm_extra.manifest import MANIFEST_NAME, fetch_remote_manifest, is_up_to_date, load_manifest
+from rctm_extra.spatial import create_netcdf_target, grid_coordinates, grid_description, spatial_index
+from rctm_extra.types import Batch
+from rctm_extra.utils import bounded_submit
+
+
+def read_netcdf_tile(task):
+    path, x_range, y_range = task
+    arrays = {}
+    with netCDF4.Dataset(path) as ds:
+        ds.set_auto_maskandscale(False)
+        for dim, window in (("x", x_range), ("y", y_range)):
+            if dim in ds.dimensions and len(ds.dimensions[dim]) != window[1] - window[0]:
+                raise ValueError(f"{dim} has {len(ds.dimensions[dim])} cells instead of {window[1] - window[0]}")
+        for name, var in ds.variables.items():
+            if "x" in var.dimensions or "y" in var.dimensions:
+                arrays[name] = var[:]
+
+    return arrays
+
+
+def read_raster_tile(task):
+    path, x_range, y_range = task
+    with rasterio.open(path) as src:
+        if (src.width, src.height) != (x_range[1] - x_range[0], y_range[1] - y_range[0]):
+            raise ValueError(f"raster is {src.width}x{src.height} instead of the batch window")
+        return src.read()
+
+
+def create_raster_target(template_path: str, target_path: str, X: int, Y: int, x_start: int, y_start: int) -> None:
+    with rasterio.open(template_path) as src:
+        profile = src.profile
+        profile.update(
+            width=X,
+            height=Y,
+            # shift the template's origin back to the top-left corner of the whole grid
+            transform=src.transform * rasterio.Affine.translation(-x_start, -y_start),
+            tiled=True,
+            blockxsize=256,
+            blockysize=256,
+            compress="deflate",
+            BIGTIFF="IF_SAFER",
+        )
+
+    with rasterio.open(target_path, "w", **profile):
+        pass
 
 
 class MergeCommand(BaseCommand):
     def __init__(self, args):
         super().__init__(args)
 
+    def _expected_batches(self, work_directory: str, manifest: dict) -> dict:
+        names = {entry["batch"] for entry in manifest.get("files", {}).values()}
+        if not names:
+            names = {name for name in os.listdir(work_directory) if os.path.isdir(os.path.join(work_directory, name))}
+
+        batches = {}
+        for name in names:
+            ranges = Batch.parse_name(name)
+            if ranges is not None:
+                batches[name] = ranges
+
+        return batches
+
+    def _source_grid(self, work_directory: str, manifest: dict) -> dict:
+        """The grid the batches were split from: from the manifest, or the master input in the batch directory."""
+        if "grid" in manifest:
+            return manifest["grid"]
+
+        path_to_input = os.path.join(work_directory, "RCTM_inputs.nc")
+        if os.path.exists(path_to_input):
+            return grid_description(path_to_input)
+
+        return None
+
+    def _download_outputs(self, work_directory: str, batches: dict) -> None:
+        bucket_name = self.args.bucket_name
+        prefix = self.args.remote_batch_path
+        client = get_storage_client(self.args.transfer_workers)
+        batch_files = list_batch_files(client, bucket_name, prefix, self.args.output_files)
+        download_tasks = []
+        for name in batches:
+            for output_file, md5 in batch_files.get(name, {}).items():
+                destination = os.path.join(work_directory, name, output_file)
+                if not is_up_to_date(destination, md5):
+                    os.makedirs(os.path.dirname(destination), exist_ok=True)
+                    download_tasks.append((f"{prefix}/{name}/{output_file}", destination))
+
+        print(f"downloading {len(download_tasks)} batch outputs from the bucket")
+        transfer_manager = TransferManager(client, bucket_name, workers=self.args.transfer_workers)
+        for blob_name, error in transfer_manager.download_files(download_tasks):
+            print(f"Downloading {blob_name} failed with error: {error}")
+
+    def _merge_file(self, output_file: str, batches: dict, work_directory: str, X: int, Y: int, workers: int, coordinates: dict = None) -> dict:
+        """
+        Mosaic `output_file` of every batch into one X by Y file. `coordinates` are the x and y
+        values of the whole grid, written up front so cells no batch covers still have theirs.
+        """
+        target_path = os.path.join(self.args.output_path, os.path.basename(output_file))
+        is_raster = output_file.endswith(".tif")
+        problems = {}
+        tasks = []
+        for name, (x_range, y_range) in sorted(batches.items()):
+            path = os.path.join(work_directory, name, output_file)
+            if os.path.exists(path):
+                tasks.append((path, x_range, y_range))
+            else:
+                problems[name] = "missing"
+
+        if not tasks:
+            print(f"no batch has {output_file}, skipping it")
+            return problems
+
+        template_path, x_range, y_range = tasks[0]
+        if is_raster:
+            create_raster_target(template_path, target_path, X, Y, x_range[0], y_range[0])
+            target = rasterio.open(target_path, "r+")
+            read_tile = read_raster_tile
+        else:
+            create_netcdf_target(template_path, target_path, X, Y)
+            target = netCDF4.Dataset(target_path, "a")
+            target.set_auto_maskandscale(False)
+            for dim, values in (coordinates or {}).items():
+                if dim in target.variables:
+                    target.variables[dim][:] = values.astype(target.variables[dim].dtype)
+            read_tile = read_netcdf_tile
+
+        print(f"merging {len(tasks)} batches of {output_file} into {target_path}")
+        with target, concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            # reads happen in parallel, the single writer keeps at most 2 tiles per worker in memory
+            for task, future in bounded_submit(executor, read_tile, tasks, workers * 2):
+                path, x_range, y_range = task
+                name = os.path.relpath(path, work_directory).split(os.sep)[0]
+                try:
+                    data = future.result()
+                    if is_raster:
+                        window = Window(x_range[0], y_range[0], x_range[1] - x_range[0], y_range[1] - y_range[0])
+                        target.write(data, window=window)
+                    else:
+                        for var_name, array in data.items():
+                            var = target.variables[var_name]
+                            var[spatial_index(var.dimensions, x_range, y_range)] = array
+                except Exception as e:
+                    problems[name] = f"incomplete: {e}"
+
+        return problems
+
     def execute(self):
-        print("merge command")
+        work_directory = self.args.local_batch_path
+        os.makedirs(self.args.output_path, exist_ok=True)
+
+        manifest_path = os.path.join(work_directory, MANIFEST_NAME)
+        if self.args.bucket_name:
+            client = get_storage_client(self.args.transfer_workers)
+            manifest = fetch_remote_manifest(client, self.args.bucket_name, self.args.remote_batch_path)
+        elif os.path.exists(manifest_path):
+            manifest = load_manifest(manifest_path)
+        else:
+            manifest = {}
+
+        batches = self._expected_batches(work_directory, manifest)
+        if not batches:
+            print(f"couldn't find any batch in {work_directory}")
+            return
+
+        if self.args.bucket_name:
+            self._download_outputs(work_directory, batches)
+
+        grid = self._source_grid(work_directory, manifest)
+        coordinates = None
+        if grid is None:
+            X = max(x_range[1] for x_range, _ in batches.values())
+            Y = max(y_range[1] for _, y_range in batches.values())
+            print("the manifest doesn't describe the source grid, the merged grid only spans the batches")
+        else:
+            X, Y = grid["x"]["size"], grid["y"]["size"]
+            coordinates = grid_coordinates(grid)
+        print(f"merging {len(batches)} batches into a {X}x{Y} grid")
+
+        workers = self.args.workers or os.cpu_count()
+        report = {}
+        for output_file in self.args.output_files:
+            problems = self._merge_file(output_file, batches, work_directory, X, Y, workers, coordinates)
+            if problems:
+                report[output_file] = problems
+                print(f"{len(problems)} of {len(batches)} batches are missing or incomplete in {output_file}:")
+                for name, problem in sorted(problems.items()):
+                    print(f"  {name}: {problem}")
+
+        report_path = os.path.join(self.args.output_path, "merge_report.json")
+        with open(report_path, "w") as file:
+            json.dump(report, file, indent=1, sort_keys=True)
+
+        if report:
+            print(f"merge finished with missing or incomplete batches, see {report_path}")
+            sys.exit(1)
+        else:
+            print("all batches were merged")
@@ -0,0 +1,69 @@
+import glob
+import json
+import os
+import pstats
+import sys
+
+from rctm_extra.cmd.base import BaseCommand
+from rctm_extra.config import PROFILE_DIR_NAME
+from rctm_extra.profiling import CPU_PROFILE_NAME, STAGES_FILE_NAME, aggregate_stages, hotspots
+
+MERGED_PROFILE_NAME = "profile_merged.prof"
+
+
+class ProfileCommand(BaseCommand):
+    def __init__(self, args):
+        super().__init__(args)
+
+    def _print_stages(self, stages: dict, total_seconds: float) -> None:
+        print(f"{'stage':<32} {'batches':>8} {'calls':>8} {'self h':>10} {'share':>7} {'cumulative h':>13} {'max s':>10} {'max peak MiB':>13}")
+        for name, stage in sorted(stages.items(), key=lambda item: item[1]["seconds"], reverse=True):
+            share = stage["seconds"] / total_seconds if total_seconds else 0
+            print(
+                f"{name:<32} {stage['batches']:>8} {stage['calls']:>8} {stage['seconds'] / 3600:>10.2f} "
+                f"{share:>7.1%} {stage['cumulative_seconds'] / 3600:>13.2f} {stage['max_seconds']:>10.1f} "
+                f"{stage['max_peak_rss'] / 1024 ** 2:>13.1f}"
+            )
+
+    def _print_hotspots(self, title: str, rows: list, total_seconds: float, key: int) -> None:
+        """Print the rows of `hotspots`, with the share of the run the time they're sorted by `key` takes."""
+        print(f"\n{title}")
+        print(f"{'calls':>12} {'total s':>12} {'cumulative s':>13} {'share':>7}  function")
+        for row in rows:
+            location, calls, total, cumulative = row
+            share = row[key] / total_seconds if total_seconds else 0
+            print(f"{calls:>12} {total:>12.1f} {cumulative:>13.1f} {share:>7.1%}  {location}")
+
+    def execute(self):
+        work_directory = self.args.local_batch_path
+        stage_files = sorted(glob.glob(os.path.join(work_directory, "*", PROFILE_DIR_NAME, STAGES_FILE_NAME)))
+        profile_files = sorted(glob.glob(os.path.join(work_directory, "*", PROFILE_DIR_NAME, CPU_PROFILE_NAME)))
+        if not stage_files:
+            print(f"couldn't find any batch profile in {work_directory}. run the batches with rctm_extra run --profile first")
+            sys.exit(1)
+
+        print(f"aggregating the profiles of {len(stage_files)} batches")
+        stages, total_seconds = aggregate_stages(stage_files)
+        print(f"{total_seconds / 3600:.2f} hours in total, {total_seconds / len(stage_files):.1f} s per batch\n")
+        self._print_stages(stages, total_seconds)
+
+        stats = pstats.Stats(*profile_files)
+        merged_path = os.path.join(work_directory, MERGED_PROFILE_NAME)
+        stats.dump_stats(merged_path)
+        by_total = hotspots(stats, self.args.top, 2)
+        by_cumulative = hotspots(stats, self.args.top, 3)
+        self._print_hotspots("functions by their own time", by_total, total_seconds, 2)
+        self._print_hotspots("functions by the time spent in them and what they call", by_cumulative, total_seconds, 3)
+
+        report_path = self.args.report_path or os.path.join(work_directory, "profile_report.json")
+        with open(report_path, "w") as file:
+            json.dump({
+                "batches": len(stage_files),
+                "seconds": total_seconds,
+                "stages": stages,
+                "hotspots": {
+                    "total": [dict(zip(("function", "calls", "total", "cumulative"), row)) for row in by_total],
+                    "cumulative": [dict(zip(("function", "calls", "total", "cumulative"), row)) for row in by_cumulative],
+                },
+            }, file, indent=1)
+        print(f"\nreport saved to {report_path}, the merged CPU profile to {merged_path}")
@@ -1,7 +1,85 @@
+import concurrent.futures
 import os
+import shutil
 import sys
+import time
+from contextlib import ExitStack
 
+from rctm_extra.cache import NodeCache, cached_config
 from rctm_extra.cmd.base import BaseCommand
+from rctm_extra.config import PROFILE_DIR_NAME
+from rctm_extra.report import RunReport
+from rctm_extra.virtual import materialize_window, scratch_directory, window_file_path
+
+
+def load_pipeline():
+    home = os.getenv("HOME")
+    rctm_path = os.path.join(home, "RCTM")
+
+    if rctm_path not in sys.path:
+        sys.path.insert(0, rctm_path)
+    os.environ["PYTHONPATH"] = ""
+    os.environ["RCTMPATH"] = os.path.join(rctm_path, "RCTM")
+
+    from RCTM.pipelines.RCTM_model_pipeline import RCTMPipeline
+
+    return RCTMPipeline
+
+
+def run_pipeline(pipeline, config_path: str, spin_cache=None, profile_directory: str = None) -> None:
+    with ExitStack() as stack:
+        if profile_directory is not None:
+            from rctm_extra.profiling import profiled
+
+            stack.enter_context(profiled(pipeline, profile_directory))
+        if spin_cache is None:
+            pipeline.run_RCTM()
+        else:
+            spin_cache.run(pipeline, config_path)
+
+
+def run_batch(config_path: str, cache: NodeCache = None, spin_cache=None, profile: bool = False) -> float:
+    """Run the model on one batch. Returns the seconds it took."""
+    start = time.perf_counter()
+    # next to the batch's own config, not the copy in scratch
+    profile_directory = os.path.join(os.path.dirname(os.path.abspath(config_path)), PROFILE_DIR_NAME) if profile else None
+    # the pipeline module is already imported by the time this runs, so this is a dict lookup
+    RCTMPipeline = load_pipeline()
+    if not os.path.exists(window_file_path(config_path)) and cache is None:
+        pipeline = RCTMPipeline(config_filename=config_path)
+        run_pipeline(pipeline, config_path, spin_cache, profile_directory)
+        return time.perf_counter() - start
+
+    # RCTM only reads files its config points at, so a copy of the config in scratch points it at local copies
+    scratch = scratch_directory(os.path.basename(os.path.dirname(os.path.abspath(config_path))))
+    try:
+        with ExitStack() as stack:
+            if os.path.exists(window_file_path(config_path)):
+                # a virtual batch, the window is copied to scratch first
+                config_path = materialize_window(config_path)
+            if cache is not None:
+                config_path = stack.enter_context(cached_config(config_path, cache, scratch))
+            pipeline = RCTMPipeline(config_filename=config_path)
+            run_pipeline(pipeline, config_path, spin_cache, profile_directory)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return time.perf_counter() - start
+
+
+def read_batch_index(index_path: str, task_id: int = None) -> list:
+    """Returns the config paths of one task of a batch index file, or of every task if `task_id` is None."""
+    with open(index_path) as file:
+        lines = file.read().splitlines()
+
+    if task_id is not None:
+        lines = [lines[task_id]]
+
+    return [config_path for line in lines for config_path in line.split()]
+
+
+def available_cores() -> int:
+    # only the cores SLURM allocated to the job, not every core of the node
+    return len(os.sched_getaffinity(0))
 
 
 class RunCommand(BaseCommand):
@@ -9,19 +87,73 @@ class RunCommand(BaseCommand):
         super().__init__(args)
 
     def execute(self):
-        home = os.getenv("HOME")
-        rctm_path = os.path.join(home, "RCTM")
+        config_paths = list(self.args.config_paths or [])
+        if self.args.batch_index:
+            task_id = self.args.task_id
+            if task_id is None and os.getenv("SLURM_ARRAY_TASK_ID"):
+                task_id = int(os.getenv("SLURM_ARRAY_TASK_ID"))
+            config_paths.extend(read_batch_index(self.args.batch_index, task_id))
 
-        sys.path.insert(0, rctm_path)
-        os.environ["PYTHONPATH"] = ""
-        os.environ["RCTMPATH"] = os.path.join(rctm_path, "RCTM")
+        if not config_paths:
+            print("No config file given. Use --config-path or --batch-index. Aborting")
+            sys.exit(1)
 
-        from RCTM.pipelines.RCTM_model_pipeline import RCTMPipeline
+        for config_path in config_paths:
+            if not os.path.exists(config_path) or not config_path.endswith(".yaml"):
+                print(f"The given path {config_path} not found or not a config file. Aborting")
+                sys.exit(1)
 
-        config_path = self.args.config_path
-        if not os.path.exists(config_path) or not config_path.endswith(".yaml"):
-            print("The given path not found or not a config file. Aborting")
-            sys.exit(1)
+        # import once, process pool workers inherit the loaded modules when they fork
+        RCTMPipeline = load_pipeline()
 
-        pipeline = RCTMPipeline(config_filename=config_path)
-        pipeline.run_RCTM()
+        cache = NodeCache(self.args.cache_dir, self.args.cache_size * 1024 ** 2) if self.args.node_cache else None
+        spin_cache = None
+        if self.args.spin_cache:
+            from rctm_extra.spinup import SpinCache, spin_cache_problems
+
+            problems = spin_cache_problems(RCTMPipeline, config_paths)
+            if problems:
+                for problem in problems:
+                    print(problem)
+                print("can't reuse spin-up results of these batches. Aborting")
+                sys.exit(1)
+
+            spin_cache = SpinCache(
+                self.args.spin_cache,
+                self.args.spin_ignore_keys or [],
+                rctm_path=os.path.join(os.getenv("HOME"), "RCTM"),
+                max_age=self.args.spin_cache_max_age * 24 * 3600 if self.args.spin_cache_max_age else None,
+                max_bytes=self.args.spin_cache_size * 1024 ** 3 if self.args.spin_cache_size else None,
+            )
+        workers = self.args.workers or available_cores()
+        workers = min(workers, len(config_paths))
+        report = RunReport("run")
+        with report.stage("run", total=len(config_paths)) as progress:
+            if workers == 1:
+                for config_path in config_paths:
+                    try:
+                        progress.advance(config_path, seconds=run_batch(config_path, cache, spin_cache, self.args.profile))
+                    except Exception as e:
+                        print(f"Running {config_path} failed with error: {e}")
+                        progress.fail(config_path, e)
+            else:
+                print(f"running {len(config_paths)} batches with {workers} processes")
+                with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                    futures = {executor.submit(run_batch, config_path, cache, spin_cache, self.args.profile): config_path for config_path in config_paths}
+                    for future in concurrent.futures.as_completed(futures):
+                        try:
+                            progress.advance(futures[future], seconds=future.result())
+                        except Exception as e:
+                            print(f"Running {futures[future]} failed with error: {e}")
+                            progress.fail(futures[future], e)
+
+        if spin_cache is not None and (spin_cache.max_age or spin_cache.max_bytes):
+            evicted = spin_cache.evict()
+            if evicted:
+                print(f"evicted {evicted} spin-up results from {self.args.spin_cache}")
+
+        if self.args.report_path:
+            report.finish(self.args.report_path)
+        if report.failures:
+            print(f"{report.failures} of {len(config_paths)} batches failed")
+            sys.exit(1)
@@ -1,55 +1,331 @@
 import os
+import sys
 import yaml
-import xarray as xr
-import shutil
-import rioxarray
 import concurrent.futures
+import numpy as np
+import rasterio
+from string import Template
 
 from rctm_extra.cmd.base import BaseCommand
-from rctm_extra.gcp import get_storage_client, download_blob, upload_directory
-from rctm_extra.spatial import get_dimensions_netcdf
+from rctm_extra.encoding import EncodingProfile
+from rctm_extra.gcp import TransferManager, get_storage_client, list_blob_checksums, open_blob
+from rctm_extra.report import RunReport, StageProgress
+from rctm_extra.spatial import (
+    block_bytes,
+    cell_bytes,
+    coordinate_window,
+    count_time_steps,
+    get_dimensions_netcdf,
+    get_valid_cell_grid,
+    grid_description,
+    open_sources,
+    plan_blocks,
+    time_steps_in_range,
+    write_batch_task,
+    write_block_task,
+)
 from rctm_extra.types import Batch
-from rctm_extra.io import create_slurm_file, create_config_file, make_unique_folder
-from rctm_extra.config import X_STEP, Y_STEP
+from rctm_extra.io import (
+    CONFIG_INDEX_NAME,
+    compile_config_template,
+    create_config_file,
+    create_slurm_file,
+    create_window_file,
+    make_unique_folder,
+    write_config_index,
+)
+from rctm_extra.manifest import (
+    MANIFEST_NAME,
+    accept_sources,
+    batch_entries,
+    build_manifest,
+    fetch_remote_manifest,
+    file_md5,
+    is_up_to_date,
+    manifest_windows,
+    save_manifest,
+    unchanged_tiles,
+)
+from rctm_extra.resources import MIN_HISTORY, CostModel, load_history
+from rctm_extra.utils import bounded_submit
+from rctm_extra.virtual import MASTER_DIR, create_master_files
 
 
 class SplitCommand(BaseCommand):
     def __init__(self, args):
         super().__init__(args)
 
-    def _split_input_files(self, batch_objs: list, path_to_input: str, path_to_spin_input: str, path_to_params: str) -> None:
-        ds = xr.open_dataset(path_to_input)
-        for obj in batch_objs:
-            subset = ds.isel(
-                x=slice(obj.x_range[0], obj.x_range[1]),
-                y=slice(obj.y_range[0], obj.y_range[1]),
-            )
-            os.makedirs(os.path.dirname(obj.input_path), exist_ok=True)
-            subset.to_netcdf(obj.input_path)
+    def _split_input_files(self, batch_objs: list, path_to_input: str, path_to_spin_input: str, path_to_params: str, workers: int, tile_kinds: dict = None, profile: EncodingProfile = None, progress: StageProgress = None) -> None:
+        if tile_kinds is not None:
+            batch_objs = [obj for obj in batch_objs if tile_kinds[obj.name]]
+        if not batch_objs:
+            return
 
-        ds.close()
+        raw_bytes = 0
+        written_bytes = 0
+        initargs = (path_to_input, path_to_spin_input, path_to_params)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=open_sources, initargs=initargs) as executor:
+            futures = {
+                executor.submit(write_batch_task, (obj, tile_kinds[obj.name] if tile_kinds else None, profile)): obj
+                for obj in batch_objs
+            }
+            for future in concurrent.futures.as_completed(futures):
+                obj = futures[future]
+                try:
+                    sizes, seconds = future.result()
+                except Exception as e:
+                    print(f"Splitting {obj.name} failed with error: {e}")
+                    if progress is not None:
+                        progress.fail(obj.name, e)
+                    continue
+
+                batch_bytes = sum(written_size for _, written_size in sizes.values())
+                raw_bytes += sum(raw_size for raw_size, _ in sizes.values())
+                written_bytes += batch_bytes
+                if progress is not None:
+                    progress.advance(obj.name, seconds=seconds, nbytes=batch_bytes)
+
+        saved = 100 * (1 - written_bytes / raw_bytes) if raw_bytes else 0
+        print(
+            f"tiles take {written_bytes / 1024 ** 2:.1f} MiB on disk for {raw_bytes / 1024 ** 2:.1f} MiB of data "
+            f"({saved:.0f}% saved)"
+        )
+
+    def _split_batches(self, batch_objs: list, sources: tuple, workers: int, tile_kinds: dict, profile: EncodingProfile, progress: StageProgress):
+        """Write the tiles of every batch, yielding the batches that succeeded as they complete."""
+        tasks = [(obj, tile_kinds[obj.name], profile) for obj in batch_objs]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=open_sources, initargs=sources) as executor:
+            # at most two batches per worker wait to be picked up by the next stage
+            for (obj, _, _), future in bounded_submit(executor, write_batch_task, tasks, workers * 2):
+                try:
+                    sizes, seconds = future.result()
+                except Exception as e:
+                    print(f"Splitting {obj.name} failed with error: {e}")
+                    progress.fail(obj.name, e)
+                    continue
+                progress.advance(obj.name, seconds=seconds, nbytes=sum(written_size for _, written_size in sizes.values()))
+                yield obj
+
+    def _split_blocks(self, batch_objs: list, sources: tuple, workers: int, tile_kinds: dict, profile: EncodingProfile, memory_budget: int, progress: StageProgress):
+        """
+        Write the tiles in blocks of batches from the same row band, each read from the sources in one go,
+        with no more blocks in flight than fit in `memory_budget` bytes, whatever the size of the site.
+        Yields the batches that succeeded as their blocks complete.
+        """
+        batch_objs = [obj for obj in batch_objs if tile_kinds[obj.name]]
+        if not batch_objs:
+            return
 
-        ds = xr.open_dataset(path_to_spin_input)
-        for obj in batch_objs:
-            subset = ds.isel(
-                x=slice(obj.x_range[0], obj.x_range[1]),
-                y=slice(obj.y_range[0], obj.y_range[1]),
+        bytes_per_cell = cell_bytes(*sources)
+        blocks = plan_blocks(batch_objs, bytes_per_cell, memory_budget // workers)
+        largest = max(block_bytes(block, bytes_per_cell) for block in blocks)
+        concurrent_blocks = max(1, min(workers, memory_budget // largest))
+        if largest > memory_budget:
+            print(f"the largest batch needs about {largest / 1024 ** 2:.0f} MiB, more than the memory budget. writing one at a time")
+        print(f"writing {len(batch_objs)} batches in {len(blocks)} blocks of up to {largest / 1024 ** 2:.0f} MiB, {concurrent_blocks} at a time")
+
+        tasks = [(block, {obj.name: tile_kinds[obj.name] for obj in block}, profile) for block in blocks]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=concurrent_blocks, initializer=open_sources, initargs=sources) as executor:
+            for (block, _, _), future in bounded_submit(executor, write_block_task, tasks, concurrent_blocks):
+                try:
+                    results = future.result()
+                except Exception as e:
+                    print(f"Splitting the block of {block[0].name} failed with error: {e}")
+                    for obj in block:
+                        progress.fail(obj.name, e)
+                    continue
+                for obj, sizes, seconds in results:
+                    progress.advance(obj.name, seconds=seconds, nbytes=sum(written_size for _, written_size in sizes.values()))
+                    yield obj
+
+    def _upload_batch(self, transfer_manager: TransferManager, obj: Batch, upload_tasks: list, progress: StageProgress) -> list:
+        """Upload the files of a batch, then delete its tiles. Returns the `(local_path, error)` pairs of the failed uploads."""
+        failures = transfer_manager.upload_files(upload_tasks, progress) if upload_tasks else []
+
+        # tiles that failed to upload stay on disk to look into
+        failed = {local_path for local_path, _ in failures}
+        for path in obj.tile_paths().values():
+            if path not in failed and os.path.exists(path):
+                os.remove(path)
+
+        return failures
+
+    def _pipelined_split(self, batch_objs: list, sources: tuple, workers: int, tile_kinds: dict, skipped: dict, source_md5s: dict, previous_manifest: dict, remote_checksums: dict, config_template: Template, transfer_manager: TransferManager, report: RunReport, job_sizing: tuple = ()) -> dict:
+        """
+        Move every batch through splitting, config and SLURM file creation and upload as soon as
+        the previous stage is done with it, instead of running each stage over all batches in turn.
+        Each stage holds a bounded number of batches, which also bounds the scratch disk in use.
+        Returns the manifest entries of the files that made it to the bucket.
+        """
+        remote_batch_path = self.args.remote_batch_path
+        files = {}
+
+        def ready_batches(split_progress, control_progress):
+            if self.args.memory_budget:
+                split_batches = self._split_blocks(batch_objs, sources, workers, tile_kinds, self.args.encoding_profile, self.args.memory_budget * 1024 ** 2, split_progress)
+            else:
+                split_batches = self._split_batches(batch_objs, sources, workers, tile_kinds, self.args.encoding_profile, split_progress)
+            for obj in split_batches:
+                try:
+                    os.makedirs(obj.local_batch_path, exist_ok=True)
+                    create_config_file(obj, config_template)
+                    create_slurm_file(obj, *job_sizing)
+                except Exception as e:
+                    print(f"Creating the config or SLURM file of {obj.name} failed with error: {e}")
+                    control_progress.fail(obj.name, e)
+                    continue
+                control_progress.advance(obj.name)
+
+                entries = batch_entries(obj, source_md5s, previous_manifest, skipped[obj.name], self.args.encoding_profile.fingerprint())
+                files.update(entries)
+                upload_tasks = [
+                    (os.path.join(obj.local_base_directory, relative_path), f"{remote_batch_path}/{relative_path}")
+                    for relative_path, entry in entries.items()
+                    if remote_checksums.get(f"{remote_batch_path}/{relative_path}") != entry["md5"]
+                ]
+                yield obj, upload_tasks
+
+        uploaded = 0
+        with (
+            report.stage("split", total=len(batch_objs)) as split_progress,
+            report.stage("control_files", total=len(batch_objs)) as control_progress,
+            report.stage("upload") as upload_progress,
+            concurrent.futures.ThreadPoolExecutor(max_workers=transfer_manager.workers) as executor,
+        ):
+            # the batches are uploaded in parallel, the files of one batch one after the other
+            batch_uploader = TransferManager(transfer_manager.storage_client, transfer_manager.bucket.name, workers=1)
+
+            def upload_task(task):
+                return self._upload_batch(batch_uploader, *task, upload_progress)
+
+            batches = ready_batches(split_progress, control_progress)
+            for (obj, _), future in bounded_submit(executor, upload_task, batches, transfer_manager.workers * 2):
+                for local_file, error in future.result():
+                    print(f"Uploading {local_file} failed with error: {error}")
+                    files.pop(os.path.relpath(local_file, obj.local_base_directory), None)
+                uploaded += 1
+
+        print(f"{uploaded} of {len(batch_objs)} batches were split and uploaded")
+        return files
+
+    def _create_files(self, func, batch_objs: list, progress: StageProgress, *args) -> None:
+        """Call `func(batch_obj, *args)` for every batch on a few threads."""
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            futures = {executor.submit(func, obj, *args): obj for obj in batch_objs}
+            for future in concurrent.futures.as_completed(futures):
+                obj = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Creating the {progress.name} of {obj.name} failed with error: {e}")
+                    progress.fail(obj.name, e)
+                    continue
+                progress.advance(obj.name)
+
+    def _upload_config_index(self, transfer_manager: TransferManager, config_template: Template, batch_objs: list, local_base_directory: str, report: RunReport) -> None:
+        index_path = os.path.join(local_base_directory, CONFIG_INDEX_NAME)
+        write_config_index(config_template, [obj.name for obj in batch_objs], index_path)
+        with report.stage("upload_config_index", total=1) as progress:
+            for _, error in transfer_manager.upload_files([(index_path, f"{self.args.remote_batch_path}/{CONFIG_INDEX_NAME}")], progress):
+                print(f"Uploading the config index failed with error: {error}")
+
+    def _upload_manifest(self, transfer_manager: TransferManager, manifest_path: str, report: RunReport) -> None:
+        with report.stage("upload_manifest", total=1) as progress:
+            for _, error in transfer_manager.upload_files([(manifest_path, f"{self.args.remote_batch_path}/{MANIFEST_NAME}")], progress):
+                print(f"Uploading the manifest failed with error: {error}")
+
+    def _is_downloaded(self, transfer_manager: TransferManager, blob_name: str, local_path: str) -> bool:
+        blob = transfer_manager.bucket.blob(blob_name)
+        blob.reload()
+        return is_up_to_date(local_path, blob.md5_hash)
+
+    def _restrict_to_change(self, batch_objs: list, previous_manifest: dict, source_md5s: dict, window: tuple, changed_kinds: set) -> tuple:
+        """
+        Limit an update to the batches that overlap the changed `window`, all of them if it is None,
+        and within those to the tiles of `changed_kinds`. Every other tile keeps its content from the
+        previous run, now as made from the current sources.
+        Returns the batches to update and the manifest entries of the other batches.
+        """
+        def overlaps(x_range, y_range):
+            return window is None or (
+                x_range[0] < window[0][1] and window[0][0] < x_range[1]
+                and y_range[0] < window[1][1] and window[1][0] < y_range[1]
             )
-            os.makedirs(os.path.dirname(obj.spin_input_path), exist_ok=True)
-            subset.to_netcdf(obj.spin_input_path)
-
-        ds.close()
 
-        ds = rioxarray.open_rasterio(path_to_params)
-        for obj in batch_objs:
-            subset = ds.isel(
-                x=slice(obj.x_range[0], obj.x_range[1]),
-                y=slice(obj.y_range[0], obj.y_range[1]),
+        accept_sources(
+            previous_manifest,
+            source_md5s,
+            lambda entry: entry["source"] in changed_kinds and overlaps(entry["x_range"], entry["y_range"]),
+        )
+        changed = [obj for obj in batch_objs if overlaps(obj.x_range, obj.y_range)]
+        changed_names = {obj.name for obj in changed}
+        carried = {
+            relative_path: entry
+            for relative_path, entry in previous_manifest["files"].items()
+            if entry["batch"] not in changed_names
+        }
+        return changed, carried
+
+    def _job_sizing(self, batch_objs: list, path_to_input: str, path_to_params: str, grid, report: RunReport) -> tuple:
+        """
+        Count the valid cells of every batch and fit the cost model to the history of earlier jobs.
+        Returns the time steps of the run and the model, which is None while the history is too short.
+        """
+        if any(obj.valid_cells is None for obj in batch_objs):
+            if grid is None:
+                print("counting valid cells")
+                with report.stage("valid_cell_grid"):
+                    grid = get_valid_cell_grid(path_to_input, path_to_params)
+            for obj in batch_objs:
+                obj.valid_cells = grid.count(obj.x_range, obj.y_range)
+
+        time_steps = count_time_steps(path_to_input)
+        history = load_history(self.args.history_path)
+        cost_model = CostModel.fit(history)
+        if cost_model is None:
+            print(f"{self.args.history_path} has fewer than {MIN_HISTORY} completed jobs, jobs keep asking for a whole node. rctm_extra status records them")
+        else:
+            print(f"sizing the SLURM jobs from {cost_model.runs} completed jobs in {self.args.history_path}")
+
+        return time_steps, cost_model
+
+    def _print_tiling_report(self, batch_objs: list, cell_count: int) -> None:
+        cells = np.array([obj.valid_cells for obj in batch_objs])
+        print(f"{len(batch_objs)} tiles hold {cells.sum()} of {cell_count} cells as valid")
+        print(f"{np.count_nonzero(cells == 0)} tiles have no valid cells")
+        print(
+            f"valid cells per tile: min {cells.min()}, median {int(np.median(cells))}, "
+            f"mean {cells.mean():.0f}, max {cells.max()}"
+        )
+        print(f"imbalance (max / mean): {cells.max() / max(cells.mean(), 1):.2f}")
+        counts, edges = np.histogram(cells, bins=10)
+        for count, low, high in zip(counts, edges[:-1], edges[1:]):
+            print(f"  {low:>10.0f} - {high:<10.0f} {count:>6} {'#' * round(50 * count / counts.max())}")
+
+    def _dry_run(self, storage_client, bucket_name: str, site_path: str) -> None:
+        """Report the tiling of the site from the inputs in the bucket, without a batch directory or downloads."""
+        def opener(path, mode="rb"):
+            return open_blob(storage_client, bucket_name, path)
+
+        print("counting valid cells from the inputs in the bucket")
+        # the opener streams the blocks it reads, GDAL shouldn't look for sidecar files next to the blob
+        with rasterio.Env(GDAL_DISABLE_READDIR_ON_OPEN="EMPTY_DIR"):
+            grid = get_valid_cell_grid(
+                f"{site_path}/RCTM_ins/RCTM_inputs.nc",
+                f"{site_path}/params/spatial_params.tif",
+                opener=opener,
             )
-            os.makedirs(os.path.dirname(obj.spatial_params_path), exist_ok=True)
-            subset.rio.to_raster(obj.spatial_params_path)
 
-        ds.close()
+        # nothing is written, the batches only need a base directory to be created
+        print(f"creating batch objects with {self.args.tiling} tiling")
+        if self.args.tiling == "adaptive":
+            batch_objs = Batch.create_adaptive_list(grid, "", self.args.target_cells, self.args.max_tile_size)
+        else:
+            batch_objs = Batch.create_list(grid.x_dim, grid.y_dim, "")
+            for obj in batch_objs:
+                obj.valid_cells = grid.count(obj.x_range, obj.y_range)
+
+        self._print_tiling_report(batch_objs, grid.x_dim * grid.y_dim)
 
     def execute(self):
         absolute_config_path = os.path.abspath(self.args.config_path)
@@ -57,6 +333,53 @@ class SplitCommand(BaseCommand):
             print(f"couldn't find the given config path: {absolute_config_path}")
             return
 
+        if self.args.tiling not in ("fixed", "adaptive"):
+            print(f"unknown tiling mode: {self.args.tiling}. use fixed or adaptive")
+            sys.exit(1)
+
+        try:
+            self.args.encoding_profile.validate()
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+
+        bbox = None
+        if self.args.bbox:
+            try:
+                bbox = tuple(float(value) for value in self.args.bbox.split(","))
+            except ValueError:
+                bbox = ()
+            if len(bbox) != 4:
+                print(f"invalid bounding box: {self.args.bbox}. use xmin,ymin,xmax,ymax")
+                sys.exit(1)
+
+        time_range = None
+        if self.args.time_range:
+            time_range = [value.strip() for value in self.args.time_range.split(",")]
+            try:
+                for value in time_range:
+                    np.datetime64(value)
+            except ValueError:
+                time_range = ()
+            if len(time_range) != 2:
+                print(f"invalid time range: {self.args.time_range}. use start,end dates")
+                sys.exit(1)
+
+        if self.args.pipeline and self.args.virtual:
+            print("--pipeline can't be used with --virtual, there are no tiles to upload while splitting")
+            sys.exit(1)
+
+        incremental = bbox is not None or time_range is not None
+        if incremental and self.args.virtual:
+            print("--bbox and --time-range can't be used with --virtual, the master files always hold the whole site")
+            sys.exit(1)
+        if incremental and not self.args.run_dir:
+            print("--bbox and --time-range update a previous split in place, give its batch directory with --run-dir")
+            sys.exit(1)
+        if incremental and self.args.dry_run:
+            print("--dry-run reports a new tiling, it can't be used with --bbox or --time-range")
+            sys.exit(1)
+
         absolute_rctm_path = os.path.abspath(self.args.rctm_path)
         if not os.path.exists(absolute_rctm_path):
             print(f"couldn't find the given RCTM folder: {absolute_rctm_path}")
@@ -68,88 +391,226 @@ class SplitCommand(BaseCommand):
         bucket_name = config_data.get("bucket_name")
         site_path = config_data.get("gcloud_workflow_base_dir")
 
-        home = os.getenv("HOME")
-        local_base_directory = os.path.join(home, "split_data")
-        local_base_directory = make_unique_folder(local_base_directory)
+        if self.args.dry_run:
+            self._dry_run(get_storage_client(self.args.transfer_workers), bucket_name, site_path)
+            return
+
+        if self.args.run_dir:
+            local_base_directory = os.path.abspath(self.args.run_dir)
+            if not os.path.isdir(local_base_directory):
+                print(f"couldn't find the given run directory: {local_base_directory}")
+                sys.exit(1)
+            print(f"updating the batch directory {local_base_directory} in place")
+        else:
+            home = os.getenv("HOME")
+            local_base_directory = os.path.join(home, "split_data")
+            local_base_directory = make_unique_folder(local_base_directory)
 
-        print(f"created batch directory: {local_base_directory}. do not forget that!!!")
+            print(f"created batch directory: {local_base_directory}. do not forget that!!!")
 
         path_to_input = os.path.join(local_base_directory, "RCTM_inputs.nc")
         path_to_spin_input = os.path.join(local_base_directory, "RCTM_spin_inputs.nc")
         path_to_params = os.path.join(local_base_directory, "spatial_params.tif")
 
-        storage_client = get_storage_client()
+        transfer_workers = self.args.transfer_workers
+        storage_client = get_storage_client(transfer_workers)
+        transfer_manager = TransferManager(storage_client, bucket_name, workers=transfer_workers)
         download_tasks = [
-            (storage_client, bucket_name, f"{site_path}/RCTM_ins/RCTM_inputs.nc", path_to_input),
-            (storage_client, bucket_name, f"{site_path}/RCTM_ins/RCTM_spin_inputs.nc", path_to_spin_input),
-            (storage_client, bucket_name, f"{site_path}/params/spatial_params.tif", path_to_params)
+            (f"{site_path}/RCTM_ins/RCTM_inputs.nc", path_to_input),
+            (f"{site_path}/RCTM_ins/RCTM_spin_inputs.nc", path_to_spin_input),
+            (f"{site_path}/params/spatial_params.tif", path_to_params)
         ]
 
-        print("downloading the input data in parallel")
-        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
-            def starmap_helper(func, args_tuple):
-                return func(*args_tuple)
-
-            futures = [executor.submit(starmap_helper, download_blob, task) for task in download_tasks]
-            concurrent.futures.wait(futures)
-
-            for future in futures:
-                try:
-                    future.result()
-                except Exception as e:
-                    print(f"Download failed with error: {e}")
+        report = RunReport("split")
+        report_path = self.args.report_path or os.path.join(local_base_directory, "split_report.json")
+
+        print("downloading the input data in parallel slices")
+        with report.stage("download", total=len(download_tasks)) as progress:
+            for task in download_tasks:
+                if self.args.run_dir and self._is_downloaded(transfer_manager, *task):
+                    print(f"{task[1]} is up to date")
+                    progress.advance(task[0])
+                    continue
+                # one file at a time, each one is already fetched in parallel slices
+                for blob_name, error in transfer_manager.download_files([task], progress):
+                    print(f"Downloading {blob_name} failed with error: {error}")
+        if report.failures:
+            report.finish(report_path)
+            sys.exit(1)
 
         X, Y = get_dimensions_netcdf(path_to_input)
+        # merge rebuilds the whole grid from it, whichever batches made it
+        source_grid = grid_description(path_to_input)
         cell_count = X * Y
         print(f"total cell count = {cell_count}")
 
-        print("creating batch objects")
-        batch_objs = Batch.create_list(X, Y, local_base_directory)
-
-        print("splitting input files")
-        self._split_input_files(batch_objs, path_to_input, path_to_spin_input, path_to_params)
-
-        print("creating config files")
         remote_batch_path = self.args.remote_batch_path
-        config_tasks = [(obj, config_data, remote_batch_path, absolute_rctm_path) for obj in batch_objs]
-        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
-            def starmap_helper(func, args_tuple):
-                return func(*args_tuple)
+        grid = None
+        if incremental:
+            # an update keeps the batches of the run it updates, whatever the tiling options say
+            with report.stage("fetch_manifest"):
+                previous_manifest = fetch_remote_manifest(storage_client, bucket_name, remote_batch_path)
+            windows = manifest_windows(previous_manifest)
+            if not windows:
+                print(f"there is no previous run under {remote_batch_path} to update, run a full split first")
+                sys.exit(1)
+            batch_objs = [Batch.from_window(x_range, y_range, local_base_directory) for x_range, y_range in windows.values()]
+        else:
+            if self.args.tiling == "adaptive":
+                print("counting valid cells")
+                with report.stage("valid_cell_grid"):
+                    grid = get_valid_cell_grid(path_to_input, path_to_params)
+
+            print(f"creating batch objects with {self.args.tiling} tiling")
+            if self.args.tiling == "adaptive":
+                batch_objs = Batch.create_adaptive_list(grid, local_base_directory, self.args.target_cells, self.args.max_tile_size)
+            else:
+                batch_objs = Batch.create_list(X, Y, local_base_directory)
+
+        with report.stage("compare_previous_run"):
+            source_md5s = {
+                "input": file_md5(path_to_input),
+                "spin_input": file_md5(path_to_spin_input),
+                "params": file_md5(path_to_params),
+            }
+            if not incremental:
+                previous_manifest = fetch_remote_manifest(storage_client, bucket_name, remote_batch_path)
+            remote_checksums = list_blob_checksums(storage_client, bucket_name, remote_batch_path)
+        # only trust entries whose blob is still in the bucket with the same content
+        previous_manifest["files"] = {
+            relative_path: entry
+            for relative_path, entry in previous_manifest["files"].items()
+            if remote_checksums.get(f"{remote_batch_path}/{relative_path}") == entry["md5"]
+        }
+        all_batch_objs = batch_objs
+        carried = {}
+        if incremental:
+            window = None
+            if bbox is not None:
+                window = coordinate_window(path_to_input, bbox)
+                if window is None:
+                    print(f"the bounding box {self.args.bbox} doesn't overlap the site, nothing to update")
+                    return
+            changed_kinds = set(source_md5s)
+            if time_range is not None:
+                tile_sources = {"input": path_to_input, "spin_input": path_to_spin_input}
+                changed_kinds = {kind for kind, path in tile_sources.items() if time_steps_in_range(path, *time_range)}
+            batch_objs, carried = self._restrict_to_change(batch_objs, previous_manifest, source_md5s, window, changed_kinds)
+            print(f"{len(batch_objs)} of {len(all_batch_objs)} batches overlap the change, the {', '.join(sorted(changed_kinds)) or 'no'} tiles of those may be rewritten")
+
+        job_sizing = ()
+        if self.args.job_resources:
+            job_sizing = self._job_sizing(batch_objs, path_to_input, path_to_params, grid, report)
+
+        # serialized once, every batch config only fills in its own directory name
+        config_template = compile_config_template(config_data, remote_batch_path, absolute_rctm_path)
+        master_paths = {}
+        manifest_path = os.path.join(local_base_directory, MANIFEST_NAME)
+        if self.args.virtual:
+            # batches only describe their window, nothing is carried over from tiles of a previous run
+            skipped = {}
+            print("converting the input data to chunked master files")
+            with report.stage("master_files"):
+                master_paths = create_master_files(
+                    path_to_input,
+                    path_to_spin_input,
+                    path_to_params,
+                    os.path.join(local_base_directory, MASTER_DIR),
+                    self.args.encoding_profile,
+                )
+        else:
+            encoding = self.args.encoding_profile.fingerprint()
+            skipped = {obj.name: unchanged_tiles(previous_manifest, obj, source_md5s, encoding) for obj in batch_objs}
+            tile_kinds = {obj.name: set(source_md5s) - skipped[obj.name] for obj in batch_objs}
+            unchanged_count = sum(len(kinds) for kinds in skipped.values())
+            if unchanged_count:
+                print(f"{unchanged_count} tiles are unchanged since the previous run and won't be regenerated")
+
+            workers = self.args.workers or os.cpu_count()
+            if self.args.pipeline:
+                print(f"splitting with {workers} workers and uploading every batch as soon as it is ready")
+                files = self._pipelined_split(
+                    batch_objs,
+                    (path_to_input, path_to_spin_input, path_to_params),
+                    workers,
+                    tile_kinds,
+                    skipped,
+                    source_md5s,
+                    previous_manifest,
+                    remote_checksums,
+                    config_template,
+                    transfer_manager,
+                    report,
+                    job_sizing,
+                )
+                files.update(carried)
+                save_manifest({"sources": source_md5s, "grid": source_grid, "files": files}, manifest_path)
+                if self.args.config_index:
+                    self._upload_config_index(transfer_manager, config_template, all_batch_objs, local_base_directory, report)
+                self._upload_manifest(transfer_manager, manifest_path, report)
+                if report.finish(report_path):
+                    sys.exit(1)
+                return
+
+            print(f"splitting input files with {workers} workers")
+            with report.stage("split", total=sum(1 for kinds in tile_kinds.values() if kinds)) as progress:
+                if self.args.memory_budget:
+                    sources = (path_to_input, path_to_spin_input, path_to_params)
+                    for _ in self._split_blocks(batch_objs, sources, workers, tile_kinds, self.args.encoding_profile, self.args.memory_budget * 1024 ** 2, progress):
+                        pass
+                else:
+                    self._split_input_files(batch_objs, path_to_input, path_to_spin_input, path_to_params, workers, tile_kinds, self.args.encoding_profile, progress)
 
-            futures = [executor.submit(starmap_helper, create_config_file, task) for task in config_tasks]
-            concurrent.futures.wait(futures)
+        for obj in batch_objs:
+            os.makedirs(obj.local_batch_path, exist_ok=True)
+
+        if master_paths:
+            print("creating window files")
+            master_blobs = {
+                kind: f"{remote_batch_path}/{os.path.relpath(path, local_base_directory)}"
+                for kind, path in master_paths.items()
+            }
+            with report.stage("window_files", total=len(batch_objs)) as progress:
+                for obj in batch_objs:
+                    create_window_file(obj, bucket_name, master_blobs)
+                    progress.advance(obj.name)
 
-            for future in futures:
-                try:
-                    future.result()
-                except Exception as e:
-                    print(f"Creating config files failed with error: {e}")
+        print("creating config files")
+        with report.stage("config_files", total=len(batch_objs)) as progress:
+            self._create_files(create_config_file, batch_objs, progress, config_template)
 
         print("creating slurm files")
-        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
-            futures = [executor.submit(create_slurm_file, obj) for obj in batch_objs]
-            concurrent.futures.wait(futures)
+        with report.stage("slurm_files", total=len(batch_objs)) as progress:
+            self._create_files(create_slurm_file, batch_objs, progress, *job_sizing)
 
-            for future in futures:
-                try:
-                    future.result()
-                except Exception as e:
-                    print(f"Creating SLURM files failed with error: {e}")
+        print("creating the manifest")
+        with report.stage("manifest"):
+            manifest = build_manifest(batch_objs, source_md5s, previous_manifest, skipped, self.args.encoding_profile.fingerprint())
+            manifest["files"].update(carried)
+            manifest["grid"] = source_grid
+            save_manifest(manifest, manifest_path)
 
         upload_tasks = []
-        for obj in batch_objs:
-            upload_tasks.append((storage_client, bucket_name, obj.local_base_directory, obj.local_batch_path, remote_batch_path))
-
-        print("uploading the split data to the bucket")
-        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
-            def starmap_helper(func, args_tuple):
-                return func(*args_tuple)
-
-            futures = [executor.submit(starmap_helper, upload_directory, task) for task in upload_tasks]
-            concurrent.futures.wait(futures)
-
-            for future in futures:
-                try:
-                    future.result()
-                except Exception as e:
-                    print(f"Download failed with error: {e}")
+        for path in master_paths.values():
+            blob_name = f"{remote_batch_path}/{os.path.relpath(path, local_base_directory)}"
+            if remote_checksums.get(blob_name) != file_md5(path):
+                upload_tasks.append((path, blob_name))
+        for relative_path, entry in manifest["files"].items():
+            blob_name = f"{remote_batch_path}/{relative_path}"
+            if remote_checksums.get(blob_name) != entry["md5"]:
+                upload_tasks.append((os.path.join(local_base_directory, relative_path), blob_name))
+
+        print(f"uploading {len(upload_tasks)} changed files of the split data to the bucket, {len(manifest['files']) + len(master_paths) - len(upload_tasks)} are up to date")
+        with report.stage("upload", total=len(upload_tasks)) as progress:
+            for local_file, error in transfer_manager.upload_files(upload_tasks, progress):
+                print(f"Uploading {local_file} failed with error: {error}")
+                manifest["files"].pop(os.path.relpath(local_file, local_base_directory), None)
+
+        if self.args.config_index:
+            self._upload_config_index(transfer_manager, config_template, all_batch_objs, local_base_directory, report)
+
+        # the manifest goes last so it only describes files that made it to the bucket
+        save_manifest(manifest, manifest_path)
+        self._upload_manifest(transfer_manager, manifest_path, report)
+        if report.finish(report_path):
+            sys.exit(1)
@@ -0,0 +1,149 @@
+import os
+import subprocess
+import sys
+import time
+
+from rctm_extra.cmd.base import BaseCommand
+from rctm_extra.config import OUTPUT_FILES
+from rctm_extra.gcp import get_storage_client, list_batch_files
+from rctm_extra.resources import Resources, append_history, load_history, read_script_resources, resize_script
+from rctm_extra.slurm import FAILED_STATES, query_states, query_usage, sbatch
+from rctm_extra.status import DONE, FAILED, RUNNING, STATUS_DB_NAME, SUBMITTED, StatusStore
+
+# the SLURM state recorded for a job neither sacct nor squeue reports. a job that is still
+# unreported on the next poll is counted as failed, so it can be resubmitted
+UNREPORTED = "UNREPORTED"
+
+
+class StatusCommand(BaseCommand):
+    def __init__(self, args):
+        super().__init__(args)
+
+    def _finished_batches(self) -> set:
+        """Batches whose outputs are all in the bucket."""
+        client = get_storage_client()
+        batch_files = list_batch_files(client, self.args.bucket_name, self.args.remote_batch_path, OUTPUT_FILES)
+        return {batch_name for batch_name, files in batch_files.items() if len(files) == len(OUTPUT_FILES)}
+
+    def _poll(self, store: StatusStore) -> None:
+        rows = [row for row in store.batches() if row[2] != DONE]
+        if not rows:
+            return
+
+        check_outputs = bool(self.args.bucket_name and self.args.remote_batch_path)
+        finished = self._finished_batches() if check_outputs else set()
+        slurm_states = query_states([job_id for _, job_id, _, _, _ in rows])
+        updates = {}
+        for name, job_id, state, previous_slurm_state, _ in rows:
+            slurm_state = slurm_states.get(job_id)
+            if name in finished:
+                updates[name] = (DONE, slurm_state)
+            elif slurm_state is None and state == FAILED:
+                continue
+            elif slurm_state is None:
+                # a job the scheduler forgot, e.g. purged from accounting, whose outputs never arrived
+                updates[name] = (FAILED if previous_slurm_state == UNREPORTED else state, UNREPORTED)
+            elif slurm_state == "COMPLETED":
+                # the job ended cleanly but its outputs never reached the bucket
+                updates[name] = (FAILED if check_outputs else DONE, slurm_state)
+            elif slurm_state in FAILED_STATES:
+                updates[name] = (FAILED, slurm_state)
+            elif slurm_state == "RUNNING":
+                updates[name] = (RUNNING, slurm_state)
+            else:
+                updates[name] = (SUBMITTED, slurm_state)
+
+        store.update_states(updates)
+
+    def _record_usage(self, store: StatusStore) -> None:
+        """Append the runtime and peak memory of the jobs that ended to the history split sizes jobs from."""
+        recorded = {record["job_id"] for record in load_history(self.args.history_path)}
+        jobs = {}
+        for name, job_id, _, slurm_state, _ in store.batches():
+            if job_id not in recorded and (slurm_state == "COMPLETED" or slurm_state in FAILED_STATES):
+                jobs.setdefault(job_id, []).append(name)
+
+        sizes = {}
+        for job_id, names in jobs.items():
+            job_sizes = [read_script_resources(os.path.join(self.args.local_batch_path, name, "slurm_runner.sh"))[0] for name in names]
+            # batches split without --job-resources don't say how large they are
+            if all(job_sizes):
+                sizes[job_id] = job_sizes
+        if not sizes:
+            return
+
+        records = []
+        for job_id, (state, seconds, max_rss, cpus) in query_usage(list(sizes)).items():
+            records.append({
+                "job_id": job_id,
+                "state": state,
+                "batches": len(sizes[job_id]),
+                "cell_steps": sum(valid_cells * time_steps for valid_cells, time_steps in sizes[job_id]),
+                "cpus": cpus,
+                "seconds": seconds,
+                "max_rss": max_rss,
+            })
+        append_history(self.args.history_path, records)
+
+    def _grow_request(self, path: str, name: str, slurm_state: str) -> None:
+        """Double the time or memory a sized job ran out of before it runs again."""
+        _, resources = read_script_resources(path)
+        if resources is None or slurm_state not in ("TIMEOUT", "OUT_OF_MEMORY"):
+            return
+
+        if slurm_state == "TIMEOUT":
+            resources = Resources(resources.seconds * 2, resources.memory, resources.cpus)
+        else:
+            resources = Resources(resources.seconds, resources.memory * 2, resources.cpus)
+        resize_script(path, resources)
+        print(f"{name} ran out of {'time' if slurm_state == 'TIMEOUT' else 'memory'}, asking for {resources.seconds // 60} minutes and {resources.memory // 1024 ** 2} MiB")
+
+    def _retry(self, store: StatusStore) -> int:
+        """Resubmit failed batches that have attempts left. Returns how many batches failed for good."""
+        job_ids = {}
+        exhausted = 0
+        for name, _, state, slurm_state, attempts in store.batches():
+            if state != FAILED:
+                continue
+            if attempts > self.args.max_retries:
+                exhausted += 1
+                continue
+
+            path = os.path.join(self.args.local_batch_path, name, "slurm_runner.sh")
+            self._grow_request(path, name, slurm_state)
+            try:
+                job_ids[name] = sbatch(path)
+                print(f"resubmitted {name} ({slurm_state}), attempt {attempts + 1}")
+            except (OSError, subprocess.CalledProcessError) as e:
+                print(f"Resubmitting {name} failed with error: {e}")
+
+        store.record_submission(job_ids)
+        return exhausted
+
+    def execute(self):
+        work_directory = self.args.local_batch_path
+        if not os.path.exists(os.path.join(work_directory, STATUS_DB_NAME)):
+            print(f"couldn't find any submission in {work_directory}. run rctm_extra submit first")
+            sys.exit(1)
+
+        with StatusStore(work_directory) as store:
+            while True:
+                self._poll(store)
+                self._record_usage(store)
+                exhausted = self._retry(store) if self.args.retry else 0
+                summary = store.summary()
+                print(", ".join(f"{count} {state}" for state, count in sorted(summary.items())))
+
+                active = summary.get(SUBMITTED, 0) + summary.get(RUNNING, 0)
+                retryable = summary.get(FAILED, 0) - exhausted if self.args.retry else 0
+                if not self.args.watch or active + retryable == 0:
+                    break
+                time.sleep(self.args.watch)
+
+            if self.args.verbose:
+                for name, job_id, state, slurm_state, attempts in store.batches():
+                    print(f"{name}\t{job_id}\t{state}\t{slurm_state or '-'}\t{attempts}")
+
+            if summary.get(FAILED, 0):
+                print(f"{summary[FAILED]} batches failed")
+                sys.exit(1)
@@ -1,70 +1,207 @@
-import concurrent.futures
 import os
 import subprocess
+import sys
+import time
+
+from google.api_core.exceptions import NotFound
 
 from rctm_extra.cmd.base import BaseCommand
-from rctm_extra.gcp import get_storage_client, list_blobs, download_blob
-from rctm_extra.utils import get_batch_dirs
+from rctm_extra.gcp import TransferManager, get_storage_client, list_batch_files
+from rctm_extra.io import (
+    CONFIG_INDEX_NAME,
+    create_array_slurm_file,
+    create_batch_index,
+    create_pack_slurm_file,
+    load_config_index,
+    render_config,
+)
+from rctm_extra.manifest import is_up_to_date
+from rctm_extra.report import RunReport, StageProgress
+from rctm_extra.resources import Resources, pack_batches, read_script_resources
+from rctm_extra.slurm import sbatch
+from rctm_extra.status import StatusStore
+from rctm_extra.virtual import WINDOW_FILE_NAME
+
+
+CONTROL_FILES = ["config.yaml", "slurm_runner.sh"]
+# only batches split with --virtual have these
+OPTIONAL_FILES = [WINDOW_FILE_NAME]
 
 
 class SubmitCommand(BaseCommand):
     def __init__(self, args):
         super().__init__(args)
 
-    def execute(self):
-        bucket_name = self.args.bucket_name
-        prefix = self.args.remote_batch_path
-        work_directory = self.args.local_batch_path
+    def _submit_array(self, work_directory: str, batch_dirs: list, progress: StageProgress, job_ids: dict) -> None:
+        """Submit the batches as job arrays, adding the task ID of every submitted batch to `job_ids`."""
+        work_directory = os.path.abspath(work_directory)
+        config_paths = [os.path.join(work_directory, batch_dir, "config.yaml") for batch_dir in batch_dirs]
+        index_path = os.path.join(work_directory, "batch_index.txt")
+        task_count = create_batch_index(config_paths, index_path, self.args.batches_per_task)
+        os.makedirs(os.path.join(work_directory, "logs"), exist_ok=True)
 
-        os.makedirs(work_directory, exist_ok=True)
+        # an array task runs its batches one after the other, so it asks for the largest batch that many times
+        requests = [read_script_resources(os.path.join(work_directory, batch_dir, "slurm_runner.sh"))[1] for batch_dir in batch_dirs]
+        resources = None
+        if requests and all(requests):
+            resources = Resources(
+                seconds=max(request.seconds for request in requests) * self.args.batches_per_task,
+                memory=max(request.memory for request in requests),
+            )
+
+        # a single array can't be larger than the cluster's MaxArraySize, larger runs are spread over several
+        max_array_size = self.args.max_array_size
+        submitted = len(job_ids)
+        for offset in range(0, task_count, max_array_size):
+            script_path = os.path.join(work_directory, f"array_runner_{offset // max_array_size}.sh")
+            create_array_slurm_file(
+                script_path,
+                index_path,
+                offset,
+                min(max_array_size, task_count - offset),
+                job_name=os.path.basename(work_directory),
+                log_path=os.path.join(work_directory, "logs", "%A_%a.log"),
+                max_concurrent=self.args.max_concurrent,
+                resources=resources,
+            )
+            start = time.perf_counter()
+            try:
+                array_job_id = sbatch(script_path)
+            except (OSError, subprocess.CalledProcessError) as e:
+                print(f"Submitting {script_path} failed with error: {e}")
+                progress.fail(script_path, e)
+                continue
+            progress.advance(script_path, seconds=time.perf_counter() - start)
+            first_batch = offset * self.args.batches_per_task
+            last_batch = (offset + max_array_size) * self.args.batches_per_task
+            for i, batch_dir in enumerate(batch_dirs[first_batch:last_batch]):
+                job_ids[batch_dir] = f"{array_job_id}_{i // self.args.batches_per_task}"
 
-        client = get_storage_client()
-        files = list_blobs(client, bucket_name, prefix)
-        batch_dirs = get_batch_dirs(files, prefix)
+        print(f"submitted {len(job_ids) - submitted} batches as {task_count} array tasks")
 
+    def _pack_scripts(self, work_directory: str, batch_dirs: list) -> list:
+        """
+        Put the batches sized by split --job-resources into jobs that run several of them side by side.
+        Returns `(script path, batch dirs)` of every job, batches without a size keep their own job.
+        """
+        work_directory = os.path.abspath(work_directory)
+        requests = {}
+        scripts = []
         for batch_dir in batch_dirs:
-            full_path = os.path.join(work_directory, batch_dir)
-            os.makedirs(full_path, exist_ok=True)
+            script_path = os.path.join(work_directory, batch_dir, "slurm_runner.sh")
+            _, resources = read_script_resources(script_path)
+            if resources is None:
+                scripts.append((script_path, [batch_dir]))
+            else:
+                requests[batch_dir] = resources
+
+        os.makedirs(os.path.join(work_directory, "logs"), exist_ok=True)
+        for i, (pack, resources) in enumerate(pack_batches(requests, self.args.pack_cpus, int(self.args.pack_hours * 3600))):
+            if len(pack) == 1:
+                scripts.append((os.path.join(work_directory, pack[0], "slurm_runner.sh"), pack))
+                continue
+            script_path = os.path.join(work_directory, f"pack_runner_{i}.sh")
+            create_pack_slurm_file(
+                script_path,
+                [os.path.join(work_directory, batch_dir, "config.yaml") for batch_dir in pack],
+                resources,
+                job_name=f"{os.path.basename(work_directory)}_pack_{i}",
+                log_path=os.path.join(work_directory, "logs", "pack_%j.log"),
+            )
+            scripts.append((script_path, pack))
+
+        print(f"packed {len(batch_dirs)} batches into {len(scripts)} jobs")
+        return scripts
 
-        config_files = []
-        slurm_files = []
-        for file in files:
-            if "config.yaml" in file:
-                config_files.append(file)
+    def _fetch_config_index(self, client, work_directory: str):
+        """Returns the config template of the split run if it uploaded a config index, otherwise None."""
+        blob = client.bucket(self.args.bucket_name).blob(f"{self.args.remote_batch_path}/{CONFIG_INDEX_NAME}")
+        index_path = os.path.join(work_directory, CONFIG_INDEX_NAME)
+        try:
+            with open(index_path, "wb") as file:
+                file.write(blob.download_as_bytes())
+        except NotFound:
+            os.remove(index_path)
+            return None
 
-            if "slurm_runner.sh" in file:
-                slurm_files.append(file)
+        config_template, _ = load_config_index(index_path)
+        return config_template
 
-        file_pairs = list(zip(config_files, slurm_files))
+    def execute(self):
+        bucket_name = self.args.bucket_name
+        prefix = self.args.remote_batch_path
+        work_directory = self.args.local_batch_path
+
+        os.makedirs(work_directory, exist_ok=True)
+
+        report = RunReport("submit")
+        client = get_storage_client(self.args.transfer_workers)
+        batch_dirs = []
         download_tasks = []
-        for config_file, slurm_file in file_pairs:
-            config_raw_file = config_file.replace(f"{prefix}/", "")
-            config_dest = os.path.join(work_directory, config_raw_file)
-            if not os.path.exists(config_dest):
-                download_tasks.append((client, bucket_name, config_file, config_dest))
+        with report.stage("list_batches") as progress:
+            batch_files = list_batch_files(client, bucket_name, prefix, CONTROL_FILES + OPTIONAL_FILES)
+            for batch_dir, files in sorted(batch_files.items()):
+                missing = [file_name for file_name in CONTROL_FILES if file_name not in files]
+                if missing:
+                    print(f"Skipping {batch_dir}, it has no {' or '.join(missing)} in the bucket")
+                    progress.fail(batch_dir, f"no {' or '.join(missing)} in the bucket")
+                    continue
+                progress.advance(batch_dir)
+                batch_dirs.append(batch_dir)
 
-            slurm_raw_file = slurm_file.replace(f"{prefix}/", "")
-            slurm_dest = os.path.join(work_directory, slurm_raw_file)
-            if not os.path.exists(slurm_dest):
-                download_tasks.append((client, bucket_name, slurm_file, slurm_dest))
+        config_template = self._fetch_config_index(client, work_directory)
+        for batch_dir in batch_dirs:
+            files = batch_files[batch_dir]
+            os.makedirs(os.path.join(work_directory, batch_dir), exist_ok=True)
+            for file_name, md5 in files.items():
+                destination = os.path.join(work_directory, batch_dir, file_name)
+                if file_name == "config.yaml" and config_template is not None and not is_up_to_date(destination, md5):
+                    # rendered from the index instead of downloaded, the checksum below catches a stale index
+                    with open(destination, "w") as file:
+                        file.write(render_config(config_template, batch_dir))
+                if not is_up_to_date(destination, md5):
+                    download_tasks.append((f"{prefix}/{batch_dir}/{file_name}", destination))
 
         if download_tasks:
-            print("Downloading missing files from the bucket. This may take a while...")
-            with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
-                def starmap_helper(func, args_tuple):
-                    return func(*args_tuple)
-
-                futures = [executor.submit(starmap_helper, download_blob, task) for task in download_tasks]
-                concurrent.futures.wait(futures)
-
-                for future in futures:
-                    try:
-                        future.result()
-                    except Exception as e:
-                        print(f"Download failed with error: {e}")
+            print(f"Downloading {len(download_tasks)} missing or changed files from the bucket. This may take a while...")
+            transfer_manager = TransferManager(client, bucket_name, workers=self.args.transfer_workers)
+            with report.stage("download", total=len(download_tasks)) as progress:
+                for blob_name, error in transfer_manager.download_files(download_tasks, progress):
+                    print(f"Downloading {blob_name} failed with error: {error}")
         else:
-            print("All files already exist locally. No downloads needed.")
+            print("All files are up to date locally. No downloads needed.")
 
-        for batch_dir in batch_dirs:
-            path = os.path.join(work_directory, batch_dir, "slurm_runner.sh")
-            subprocess.run(["sbatch", path])
+        job_ids = {}
+        try:
+            with report.stage("sbatch") as progress:
+                if self.args.array:
+                    self._submit_array(work_directory, batch_dirs, progress, job_ids)
+                else:
+                    if self.args.pack_cpus:
+                        scripts = self._pack_scripts(work_directory, batch_dirs)
+                    else:
+                        scripts = [(os.path.join(work_directory, batch_dir, "slurm_runner.sh"), [batch_dir]) for batch_dir in batch_dirs]
+                    for path, job_batch_dirs in scripts:
+                        start = time.perf_counter()
+                        try:
+                            job_id = sbatch(path)
+                        except (OSError, subprocess.CalledProcessError) as e:
+                            # OSError when sbatch can't be started at all, e.g. it isn't installed
+                            error = e.stderr.strip() if isinstance(e, subprocess.CalledProcessError) else str(e)
+                            print(f"Submitting {' '.join(job_batch_dirs)} failed with error: {error}")
+                            for batch_dir in job_batch_dirs:
+                                progress.fail(batch_dir, error)
+                            continue
+                        seconds = time.perf_counter() - start
+                        for batch_dir in job_batch_dirs:
+                            job_ids[batch_dir] = job_id
+                            progress.advance(batch_dir, seconds=seconds / len(job_batch_dirs))
+        finally:
+            # jobs already in the queue are recorded even if a later submission crashed
+            with StatusStore(work_directory) as store:
+                store.record_submission(job_ids)
+            print(f"recorded {len(job_ids)} job IDs, run rctm_extra status to follow them")
+
+        report_path = self.args.report_path or os.path.join(work_directory, "submit_report.json")
+        if report.finish(report_path):
+            sys.exit(1)
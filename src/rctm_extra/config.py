@@ -1,2 +1,21 @@
+import os
+
 X_STEP = 100
 Y_STEP = 100
+# adaptive tile edges are multiples of this many cells
+TILE_ALIGN = 10
+
+# outputs of a finished batch, relative to the batch directory
+OUTPUT_FILES = [
+    "RCTM_output/transient/C_stock_hist_grass-tree.nc",
+    "RCTM_output/transient/flux_hist_grass-tree.nc",
+]
+
+# tiles are written under this suffix, before the extension, and renamed once they are complete
+PARTIAL_SUFFIX = ".partial"
+
+DEFAULT_TRANSFER_WORKERS = 16
+# runtimes and peak memory of finished jobs, split sizes SLURM requests from them
+DEFAULT_HISTORY_PATH = os.path.join(os.path.expanduser("~"), ".rctm_extra", "resource_history.jsonl")
+# where run --profile writes the profiles of a batch, next to its config
+PROFILE_DIR_NAME = "profile"
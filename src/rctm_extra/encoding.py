@@ -0,0 +1,107 @@
+import hashlib
+import json
+from dataclasses import asdict, dataclass
+
+import numpy as np
+
+NETCDF_COMPRESSIONS = ("none", "zlib", "zstd")
+RASTER_COMPRESSIONS = ("none", "deflate", "zstd", "lzw")
+
+
+@dataclass
+class EncodingProfile:
+    """How split writes its NetCDF and GeoTIFF tiles."""
+
+    compression: str = "zlib"
+    level: int = 4
+    # None keeps the whole time axis in one chunk, which suits reading per-cell time series
+    time_chunk: int = None
+    spatial_chunk: int = 50
+    float32: bool = False
+    raster_compression: str = "deflate"
+    raster_block_size: int = 256
+
+    def validate(self) -> None:
+        if self.compression not in NETCDF_COMPRESSIONS:
+            raise ValueError(f"unknown NetCDF compression {self.compression}, use one of {', '.join(NETCDF_COMPRESSIONS)}")
+        if self.raster_compression not in RASTER_COMPRESSIONS:
+            raise ValueError(f"unknown raster compression {self.raster_compression}, use one of {', '.join(RASTER_COMPRESSIONS)}")
+        if self.raster_block_size % 16:
+            raise ValueError("the raster block size has to be a multiple of 16")
+
+    def fingerprint(self) -> str:
+        """A hash of every setting. The manifest keeps it with each tile, a tile written with other settings is regenerated."""
+        return hashlib.md5(json.dumps(asdict(self), sort_keys=True).encode()).hexdigest()
+
+    def _chunks(self, var) -> tuple:
+        chunks = []
+        for dim, size in zip(var.dims, var.shape):
+            if dim in ("x", "y"):
+                chunk = self.spatial_chunk
+            elif dim == "time":
+                chunk = self.time_chunk
+            else:
+                chunk = None
+            chunks.append(max(min(chunk or size, size), 1))
+
+        return tuple(chunks)
+
+    def netcdf_encoding(self, ds) -> dict:
+        encoding = {}
+        for name, var in ds.data_vars.items():
+            var_encoding = {"contiguous": False}
+            if var.ndim:
+                var_encoding["chunksizes"] = self._chunks(var)
+            if self.compression == "zlib":
+                var_encoding.update(zlib=True, complevel=self.level, shuffle=True)
+            elif self.compression == "zstd":
+                # needs a netCDF-C build with the zstd filter plugin, on both the writing and reading side
+                var_encoding.update(compression="zstd", complevel=self.level, shuffle=True)
+            else:
+                var_encoding.update(zlib=False)
+            if self.float32 and is_float32_safe(var):
+                var_encoding["dtype"] = "float32"
+            encoding[name] = var_encoding
+
+        return encoding
+
+    def netcdf4_compression(self) -> dict:
+        """The compression arguments of `netCDF4.Dataset.createVariable` for files written without xarray."""
+        if self.compression == "none":
+            return {"compression": None}
+
+        return {"compression": self.compression, "complevel": self.level, "shuffle": True}
+
+    def raster_options(self, da) -> dict:
+        if self.raster_compression == "none":
+            return {}
+
+        # blocks bigger than the tile only add padding
+        block_x = min(self.raster_block_size, -(-da.sizes["x"] // 16) * 16)
+        block_y = min(self.raster_block_size, -(-da.sizes["y"] // 16) * 16)
+        options = {
+            "compress": self.raster_compression,
+            "tiled": True,
+            "blockxsize": block_x,
+            "blockysize": block_y,
+        }
+        # horizontal differencing, the floating point variant for float data
+        options["predictor"] = 3 if np.issubdtype(da.dtype, np.floating) else 2
+
+        return options
+
+
+def is_float32_safe(var) -> bool:
+    """
+    A float64 variable can be stored as float32 when every value
+    comes back from float32 unchanged, so nothing is lost.
+    """
+    if var.dtype != np.float64:
+        return False
+
+    values = var.values
+    finite = values[np.isfinite(values)]
+    if finite.size and np.abs(finite).max() > np.finfo(np.float32).max:
+        return False
+
+    return bool(np.array_equal(finite, finite.astype(np.float32).astype(np.float64)))
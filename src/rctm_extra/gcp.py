@@ -1,29 +1,231 @@
+import concurrent.futures
+import functools
+import json
+import os
+import threading
+import time
 from pathlib import Path
+
+import requests
 from google.cloud import storage
 
+from rctm_extra.config import DEFAULT_TRANSFER_WORKERS
+from rctm_extra.local_storage import LocalStorageClient
+from rctm_extra.manifest import file_md5
 
-def get_storage_client():
-    return storage.Client(project="rangelands-explo-1571664594580")
+# point this at a directory to use a filesystem-backed fake bucket instead of GCS
+LOCAL_BUCKET_ENV = "RCTM_EXTRA_LOCAL_BUCKET"
+# set to a number of requests in flight to list blobs and move small files with asyncio instead of the thread pool.
+# the number holds per call, a pipelined split uploads up to --transfer-workers batches with that many each
+ASYNC_TRANSFERS_ENV = "RCTM_EXTRA_ASYNC_TRANSFERS"
+SLICE_SIZE = 64 * 1024 * 1024
+# resumable uploads need a multiple of 256 KiB
+UPLOAD_CHUNK_SIZE = 32 * 1024 * 1024
+# uploads without a generation precondition aren't retried by the client library
+TRANSFER_RETRIES = 2
+# the largest page the listing API returns
+LIST_PAGE_SIZE = 5000
+# read-ahead of blobs opened as files, small enough that a windowed read only fetches the chunks it needs
+READ_CHUNK_SIZE = 4 * 1024 * 1024
 
 
-def upload_directory(storage_client, bucket_name, relative_to, source_directory, destination_directory):
-    bucket = storage_client.bucket(bucket_name)
+@functools.cache
+def get_storage_client(workers: int = DEFAULT_TRANSFER_WORKERS):
+    local_root = os.getenv(LOCAL_BUCKET_ENV)
+    if local_root:
+        return LocalStorageClient(local_root)
+
+    client = storage.Client(project="rangelands-explo-1571664594580")
+    # the default connection pool holds 10 connections, which serializes larger worker pools.
+    # `_http` is the requests session of google-cloud-storage 3.1.0 (pinned in requirements.txt),
+    # it isn't public API and may change with other versions
+    adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    client._http.mount("https://", adapter)
+    return client
+
+
+def async_concurrency(storage_client) -> int:
+    """The request concurrency of the asyncio backend, None when it's off or the bucket is local."""
+    value = os.getenv(ASYNC_TRANSFERS_ENV)
+    if not value or isinstance(storage_client, LocalStorageClient):
+        return None
+
+    return int(value)
+
+
+def get_async_storage(storage_client, bucket_name: str, transfer_manager=None):
+    """An `AsyncStorage` for the bucket if the asyncio backend is on, otherwise None."""
+    concurrency = async_concurrency(storage_client)
+    if not concurrency:
+        return None
+
+    # aiohttp is only loaded when the backend is used
+    from rctm_extra.async_gcs import AsyncStorage
+
+    return AsyncStorage(storage_client, bucket_name, concurrency, transfer_manager)
+
+
+class TransferManager:
+    """
+    Moves files between the local disk and a bucket with a shared pool of workers.
+    Large downloads are split into slices that are fetched in parallel and can be
+    resumed after an interruption; uploads are spread over the whole pool.
+    A failed transfer is tried again up to `retries` times.
+    """
+
+    def __init__(self, storage_client, bucket_name: str, workers: int = DEFAULT_TRANSFER_WORKERS, slice_size: int = SLICE_SIZE, retries: int = TRANSFER_RETRIES):
+        self.storage_client = storage_client
+        self.bucket = storage_client.bucket(bucket_name)
+        self.workers = workers
+        self.slice_size = slice_size
+        self.retries = retries
+
+    def download(self, blob_name: str, destination: str) -> str:
+        blob = self.bucket.blob(blob_name)
+        blob.reload()
+        if blob.size <= self.slice_size:
+            blob.download_to_filename(destination)
+            return destination
+
+        part_path = f"{destination}.part"
+        state_path = f"{destination}.part.json"
+        state = {"generation": blob.generation, "size": blob.size, "slice_size": self.slice_size, "done": []}
+        if os.path.exists(state_path) and os.path.exists(part_path):
+            with open(state_path) as file:
+                previous = json.load(file)
+            if all(previous.get(key) == state[key] for key in ("generation", "size", "slice_size")):
+                state = previous
+                print(f"resuming download of {blob_name} ({len(state['done'])} slices already done)")
+
+        if not state["done"]:
+            with open(part_path, "wb") as file:
+                file.truncate(blob.size)
+
+        done = set(state["done"])
+        pending = [i for i in range(0, blob.size, self.slice_size) if i not in done]
+        lock = threading.Lock()
+
+        def download_slice(start):
+            end = min(start + self.slice_size, blob.size) - 1
+            with open(part_path, "r+b") as file:
+                file.seek(start)
+                blob.download_to_file(file, start=start, end=end, if_generation_match=blob.generation, checksum=None)
+            with lock:
+                done.add(start)
+                state["done"] = sorted(done)
+                with open(state_path, "w") as file:
+                    json.dump(state, file)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for future in [executor.submit(download_slice, start) for start in pending]:
+                future.result()
+
+        # slices skip the client's checksum, a corrupt or short one only shows in the whole file.
+        # composite objects have no MD5
+        if blob.md5_hash is not None and file_md5(part_path) != blob.md5_hash:
+            # the retry starts over instead of resuming from the bad slices
+            os.remove(part_path)
+            os.remove(state_path)
+            raise ValueError(f"checksum mismatch downloading {blob_name}")
+
+        os.replace(part_path, destination)
+        os.remove(state_path)
+        return destination
+
+    def download_files(self, tasks: list, progress=None) -> list:
+        """
+        Download `(blob_name, destination)` pairs in parallel.
+        Returns the `(blob_name, error)` pairs of the downloads that failed.
+        """
+        async_storage = get_async_storage(self.storage_client, self.bucket.name, self)
+        if async_storage is not None:
+            return async_storage.download_files(tasks, progress)
+
+        return self._run(self.download, tasks, progress, local_index=1)
 
-    local_batch_dir = Path(source_directory)
-    for local_file in local_batch_dir.rglob("*"):
+    def upload_file(self, local_path: str, blob_name: str) -> str:
+        blob = self.bucket.blob(blob_name)
+        if os.path.getsize(local_path) > UPLOAD_CHUNK_SIZE:
+            # chunked resumable upload, a dropped connection only retries the current chunk
+            blob.chunk_size = UPLOAD_CHUNK_SIZE
+        blob.upload_from_filename(local_path)
+        return blob_name
+
+    def upload_files(self, tasks: list, progress=None) -> list:
+        """
+        Upload `(local_path, blob_name)` pairs in parallel.
+        Returns the `(local_path, error)` pairs of the uploads that failed.
+        """
+        async_storage = get_async_storage(self.storage_client, self.bucket.name, self)
+        if async_storage is not None:
+            return async_storage.upload_files(tasks, progress)
+
+        return self._run(self.upload_file, tasks, progress, local_index=0)
+
+    def upload_directory(self, relative_to: str, source_directory: str, destination_directory: str) -> list:
+        return self.upload_files(directory_upload_tasks(relative_to, source_directory, destination_directory))
+
+    def _attempt(self, func, task: tuple) -> tuple:
+        """Run one transfer, trying again on failure. Returns the retry count and the seconds it took."""
+        start = time.perf_counter()
+        retry = 0
+        while True:
+            try:
+                func(*task)
+                return retry, time.perf_counter() - start
+            except Exception:
+                if retry >= self.retries:
+                    raise
+                retry += 1
+
+    def _run(self, func, tasks: list, progress=None, local_index: int = 0) -> list:
+        """
+        Run the transfers on the pool. Each one is reported to `progress`, a `StageProgress`,
+        with the size of its local file at `local_index` of the task.
+        """
+        failures = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self._attempt, func, task): task for task in tasks}
+            for future in concurrent.futures.as_completed(futures):
+                task = futures[future]
+                try:
+                    retries, seconds = future.result()
+                except Exception as e:
+                    failures.append((task[0], e))
+                    if progress is not None:
+                        progress.advance(task[0], retries=self.retries, error=e)
+                    continue
+
+                if progress is not None:
+                    progress.advance(task[0], seconds=seconds, nbytes=os.path.getsize(task[local_index]), retries=retries)
+
+        return failures
+
+
+def directory_upload_tasks(relative_to, source_directory, destination_directory) -> list:
+    tasks = []
+    for local_file in Path(source_directory).rglob("*"):
         if local_file.is_file():
             relative_path = local_file.relative_to(relative_to)
-            blob_path = f"{destination_directory}/{relative_path}"
-            blob = bucket.blob(blob_path)
-            blob.upload_from_filename(str(local_file))
+            tasks.append((str(local_file), f"{destination_directory}/{relative_path}"))
+
+    return tasks
+
+
+def upload_directory(storage_client, bucket_name, relative_to, source_directory, destination_directory):
+    manager = TransferManager(storage_client, bucket_name, workers=1)
+    failures = manager.upload_directory(relative_to, source_directory, destination_directory)
+    if failures:
+        raise failures[0][1]
 
 
 def download_blob(storage_client, bucket_name, source_blob_name, destination_file_name):
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(source_blob_name)
-    blob.download_to_filename(destination_file_name)
+    return TransferManager(storage_client, bucket_name).download(source_blob_name, destination_file_name)
+
 
-    return destination_file_name
+def open_blob(storage_client, bucket_name, blob_name, chunk_size=READ_CHUNK_SIZE):
+    """Open a blob as a seekable, read-only file object that fetches byte ranges on demand."""
+    return storage_client.bucket(bucket_name).blob(blob_name).open("rb", chunk_size=chunk_size)
 
 
 def list_blobs(storage_client, bucket_name, prefix):
@@ -33,4 +235,39 @@ def list_blobs(storage_client, bucket_name, prefix):
     for blob in blobs:
         files.append(blob.name)
 
-    return files
\ No newline at end of file
+    return files
+
+
+def iter_blobs(storage_client, bucket_name, prefix, match_glob=None, delimiter=None):
+    """Lazily page through the blobs under `prefix`, fetching only their name and checksum."""
+    return storage_client.list_blobs(
+        bucket_name,
+        prefix=prefix,
+        match_glob=match_glob,
+        delimiter=delimiter,
+        page_size=LIST_PAGE_SIZE,
+        fields="items(name,md5Hash),prefixes,nextPageToken",
+    )
+
+
+def list_blob_checksums(storage_client, bucket_name, prefix, match_glob=None) -> dict:
+    async_storage = get_async_storage(storage_client, bucket_name)
+    if async_storage is not None:
+        return async_storage.list_checksums(prefix, match_glob)
+
+    return {blob.name: blob.md5_hash for blob in iter_blobs(storage_client, bucket_name, prefix, match_glob=match_glob)}
+
+
+def list_batch_files(storage_client, bucket_name, prefix, file_names: list) -> dict:
+    """
+    Find the given files of every batch directory directly under `prefix` with a single
+    glob query, so the tiles next to them are never listed.
+    Returns `batch name -> {file name: md5}`.
+    """
+    match_glob = f"{prefix}/*/{{{','.join(file_names)}}}"
+    batch_files = {}
+    for blob_name, md5 in list_blob_checksums(storage_client, bucket_name, prefix, match_glob).items():
+        batch_name, file_name = blob_name[len(prefix) + 1:].split("/", 1)
+        batch_files.setdefault(batch_name, {})[file_name] = md5
+
+    return batch_files
@@ -1,38 +1,125 @@
+import json
 import os
 import yaml
 from string import Template
 
+from .resources import SIZE_HEADER, CostModel
 from .types import Batch
 
+CONFIG_INDEX_NAME = "config_index.json"
+# keys of the site config that make no sense for a single batch
+IGNORED_CONFIG_KEYS = ["ee_geometry_save_dir", "path_to_existing_ee_geom", "geometry_polygon", "shape_name_col"]
+# stands in for the batch name while the config template is serialized
+BATCH_NAME_PLACEHOLDER = "RCTMEXTRABATCHNAME"
+
 
 JOB_TEMPLATE = """#!/bin/sh
+{size_header}
+#SBATCH --job-name {job_name}
+#SBATCH -o {log_path}
+#SBATCH -p compute
+#SBATCH -N 1
+{resources}
+source /data/venv/bin/activate
+
+rctm_extra run --config-path {config_path}
+"""
+
+
+ARRAY_JOB_TEMPLATE = """#!/bin/sh
 
 #SBATCH --job-name {job_name}
 #SBATCH -o {log_path}
 #SBATCH -p compute
 #SBATCH -N 1
+#SBATCH --array=0-{last_task}{throttle}
+{resources}
+source /data/venv/bin/activate
+
+# every line of the index file holds the config paths of one array task
+rctm_extra run --batch-index {index_path} --task-id $((SLURM_ARRAY_TASK_ID + {offset})) --workers 0
+"""
 
+
+# several small batches side by side in one job
+PACK_JOB_TEMPLATE = """#!/bin/sh
+
+#SBATCH --job-name {job_name}
+#SBATCH -o {log_path}
+#SBATCH -p compute
+#SBATCH -N 1
+{resources}
 source /data/venv/bin/activate
-pip install -r /opt/requirements.txt
 
-rctm_extra run --config-path {config_path}
+rctm_extra run {config_options} --workers 0
 """
 
 
-def create_slurm_file(batch_obj: Batch) -> None:
+def create_slurm_file(batch_obj: Batch, time_steps: int = None, cost_model: CostModel = None) -> None:
+    """
+    Without a `cost_model` the job asks for a whole node. The size of the batch is written into
+    the script whenever its valid cells and `time_steps` are known, so its runtime can be learned from.
+    """
+    sized = batch_obj.valid_cells is not None and time_steps is not None
+    resources = ""
+    if sized and cost_model is not None:
+        resources = cost_model.predict(batch_obj.valid_cells, time_steps).sbatch_lines() + "\n"
     values = {
         "job_name": batch_obj.name,
         "log_path": batch_obj.name,
         "config_path": batch_obj.config_path,
+        "size_header": SIZE_HEADER.format(valid_cells=batch_obj.valid_cells, time_steps=time_steps) if sized else "",
+        "resources": resources,
     }
     text = JOB_TEMPLATE.format(**values)
     with open(batch_obj.slurm_script_path, "w") as file:
         file.write(text)
 
 
-def create_config_file(batch_obj: Batch, config_data: dict, gcloud_base_dir: str, path_to_rctm: str) -> None:
-    base_path = f"{gcloud_base_dir}/{batch_obj.name}"
-    paths = {
+def create_batch_index(config_paths: list, index_path: str, batches_per_task: int = 1) -> int:
+    """
+    Write the index file that maps array task IDs to batch configs, `batches_per_task` configs per line.
+    Returns the number of tasks.
+    """
+    lines = []
+    for i in range(0, len(config_paths), batches_per_task):
+        lines.append(" ".join(config_paths[i:i + batches_per_task]))
+
+    with open(index_path, "w") as file:
+        file.write("\n".join(lines) + "\n")
+
+    return len(lines)
+
+
+def create_array_slurm_file(script_path: str, index_path: str, offset: int, task_count: int, job_name: str, log_path: str, max_concurrent: int = None, resources=None) -> None:
+    values = {
+        "resources": resources.sbatch_lines() + "\n" if resources else "",
+        "job_name": job_name,
+        "log_path": log_path,
+        "last_task": task_count - 1,
+        "throttle": f"%{max_concurrent}" if max_concurrent else "",
+        "offset": offset,
+        "index_path": index_path,
+    }
+    text = ARRAY_JOB_TEMPLATE.format(**values)
+    with open(script_path, "w") as file:
+        file.write(text)
+
+
+def create_pack_slurm_file(script_path: str, config_paths: list, resources, job_name: str, log_path: str) -> None:
+    values = {
+        "job_name": job_name,
+        "log_path": log_path,
+        "resources": resources.sbatch_lines() + "\n",
+        "config_options": " ".join(f"--config-path {config_path}" for config_path in config_paths),
+    }
+    text = PACK_JOB_TEMPLATE.format(**values)
+    with open(script_path, "w") as file:
+        file.write(text)
+
+
+def config_paths(base_path: str, path_to_rctm: str) -> dict:
+    return {
         "gcloud_workflow_base_dir": base_path,
         "landsat_save_dir": f"{base_path}/landsat",
         "modis_save_dir": f"{base_path}/modis",
@@ -46,31 +133,71 @@ def create_config_file(batch_obj: Batch, config_data: dict, gcloud_base_dir: str
         "RCTM_input_dir": f"{base_path}/RCTM_ins",
         "spatial_param_outname": f"{base_path}/params/spatial_params.tif",
         "fused_landcover_outname": f"{base_path}/landcover/fused_landcover.tif",
-        # "spatial_spin_fig_path": f"{base_path}/RCTM_output/spinup/figs/spin_fig_grass-tree.jpg",
+        # "spatial_spin_fig_path": f"{base_path}/RCTM_output/spinup/figs/spin_fig_grass-tree.jpg",
         "transient_C_stock_hist": f"{base_path}/RCTM_output/transient/C_stock_hist_grass-tree.nc",
         "transient_flux_hist": f"{base_path}/RCTM_output/transient/flux_hist_grass-tree.nc",
         "C_stock_inits_yaml": f"{path_to_rctm}/RCTM/templates/C_stock_inits.yaml",
-        # "C_stock_spin_out_path": f"{base_path}/RCTM_output/spinup/RCTM_C_stocks_spin_output_grass-tree.tif",
-        # "C_stock_spin_out_path_point": f"{base_path}/RCTM_output/spinup/RCTM_C_stocks_spin_outputs_grass-tree.csv",
+        # "C_stock_spin_out_path": f"{base_path}/RCTM_output/spinup/RCTM_C_stocks_spin_output_grass-tree.tif",
+        # "C_stock_spin_out_path_point": f"{base_path}/RCTM_output/spinup/RCTM_C_stocks_spin_outputs_grass-tree.csv",
         # "gee_key_json": "/home/dteber/res/gee_key.json", # todo: change this later
         "path_to_RCTM_params": f"{path_to_rctm}/RCTM/templates/RCTM_params.yaml",
         "path_to_RCTM_spatial_params": f"{base_path}/params/spatial_params.tif",
         "path_to_geometry_local": f"{path_to_rctm}/examples/geometries/test_poly.geojson",
-        # "path_to_spin_covariates_point": f"{base_path}/RCTM_ins/RCTM_spin_inputs.csv",
-        # "path_to_spin_covariates_spatial": f"{base_path}/RCTM_ins/RCTM_spin_inputs.nc",
+        # "path_to_spin_covariates_point": f"{base_path}/RCTM_ins/RCTM_spin_inputs.csv",
+        # "path_to_spin_covariates_spatial": f"{base_path}/RCTM_ins/RCTM_spin_inputs.nc",
         "starfm_config": f"{path_to_rctm}/RCTM/config/input_ref.txt",
         "starfm_source": f"{path_to_rctm}/RCTM/remote_sensing/starfm_source/",
         "transient_covariate_path": f"{base_path}/RCTM_ins/RCTM_inputs.nc",
         "workflows_path": f"{path_to_rctm}/examples/workflows/test_single_poly/",
     }
 
-    ignore = ["ee_geometry_save_dir", "path_to_existing_ee_geom", "geometry_polygon", "shape_name_col"]
-    for elem in ignore:
-        config_data.pop(elem, None)
-    for key, value in paths.items():
-        config_data[key] = value
+
+def compile_config_template(config_data: dict, gcloud_base_dir: str, path_to_rctm: str) -> Template:
+    """
+    Serialize the config shared by every batch once, with `$batch_name` in place of the batch
+    directory name. Batch names only hold characters that are safe in any YAML scalar,
+    so substituting them can't change how the file parses.
+    """
+    data = {key: value for key, value in config_data.items() if key not in IGNORED_CONFIG_KEYS}
+    data.update(config_paths(f"{gcloud_base_dir}/{BATCH_NAME_PLACEHOLDER}", path_to_rctm))
+    text = yaml.dump(data).replace("$", "$$").replace(BATCH_NAME_PLACEHOLDER, "${batch_name}")
+    return Template(text)
+
+
+def render_config(template: Template, batch_name: str) -> str:
+    return template.substitute(batch_name=batch_name)
+
+
+def create_config_file(batch_obj: Batch, template: Template) -> None:
     with open(batch_obj.config_path, "w") as file:
-        yaml.dump(config_data, file)
+        file.write(render_config(template, batch_obj.name))
+
+
+def write_config_index(template: Template, batch_names: list, index_path: str) -> None:
+    """Write the config template and the batch names of a run into one file, every batch config can be rendered from it."""
+    with open(index_path, "w") as file:
+        json.dump({"template": template.template, "batches": sorted(batch_names)}, file, indent=1)
+
+
+def load_config_index(index_path: str) -> tuple:
+    """Returns the config template and the batch names of a config index."""
+    with open(index_path) as file:
+        index = json.load(file)
+
+    return Template(index["template"]), index["batches"]
+
+
+def create_window_file(batch_obj: Batch, bucket_name: str, master_blobs: dict) -> None:
+    """Describe the window of a batch in the shared master files, in place of its input tiles."""
+    window = {
+        "batch": batch_obj.name,
+        "bucket_name": bucket_name,
+        "x_range": list(batch_obj.x_range),
+        "y_range": list(batch_obj.y_range),
+        "sources": dict(master_blobs),
+    }
+    with open(batch_obj.window_path, "w") as file:
+        yaml.dump(window, file)
 
 
 def make_unique_folder(full_path):
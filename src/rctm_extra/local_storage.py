@@ -0,0 +1,170 @@
+import base64
+import hashlib
+import os
+import re
+import shutil
+
+from google.api_core.exceptions import NotFound
+
+
+class LocalStorageClient:
+    """
+    A filesystem-backed stand-in for `google.cloud.storage.Client`.
+    Every bucket is a directory under `root` and every blob is a file in it.
+    Only the subset of the client API used by `rctm_extra.gcp` is implemented.
+    """
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+
+    def bucket(self, bucket_name: str):
+        return LocalBucket(self, bucket_name)
+
+    def list_blobs(self, bucket_or_name, prefix=None, delimiter=None, match_glob=None, **kwargs):
+        bucket = bucket_or_name if isinstance(bucket_or_name, LocalBucket) else self.bucket(bucket_or_name)
+        return LocalBlobIterator(bucket, prefix or "", delimiter, match_glob)
+
+
+def glob_to_regex(pattern: str) -> str:
+    """Translate a GCS `match_glob` pattern into a regular expression."""
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+            continue
+        if char == "*":
+            regex += "[^/]*"
+        elif char == "?":
+            regex += "[^/]"
+        elif char == "{":
+            end = pattern.index("}", i)
+            regex += "(?:" + "|".join(re.escape(option) for option in pattern[i + 1:end].split(",")) + ")"
+            i = end
+        elif char == "[":
+            end = pattern.index("]", i)
+            regex += pattern[i:end + 1]
+            i = end
+        else:
+            regex += re.escape(char)
+        i += 1
+
+    return regex
+
+
+class LocalBlobIterator:
+    """Yields the blobs of a listing; like the GCS iterator, `prefixes` is filled in while iterating."""
+
+    def __init__(self, bucket, prefix: str, delimiter: str = None, match_glob: str = None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.delimiter = delimiter
+        self.pattern = re.compile(glob_to_regex(match_glob)) if match_glob else None
+        self.prefixes = set()
+
+    def __iter__(self):
+        for dirpath, dirnames, filenames in os.walk(self.bucket.path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                name = os.path.relpath(os.path.join(dirpath, filename), self.bucket.path).replace(os.sep, "/")
+                if not name.startswith(self.prefix):
+                    continue
+                if self.pattern is not None and not self.pattern.fullmatch(name):
+                    continue
+                if self.delimiter and self.delimiter in name[len(self.prefix):]:
+                    rest = name[len(self.prefix):]
+                    self.prefixes.add(self.prefix + rest[:rest.index(self.delimiter) + len(self.delimiter)])
+                    continue
+
+                blob = self.bucket.blob(name)
+                blob.reload()
+                yield blob
+
+
+class LocalBucket:
+    def __init__(self, client: LocalStorageClient, name: str):
+        self.client = client
+        self.name = name
+        self.path = os.path.join(client.root, name)
+
+    def blob(self, blob_name: str, **kwargs):
+        return LocalBlob(self, blob_name)
+
+
+class LocalBlob:
+    def __init__(self, bucket: LocalBucket, name: str):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.path, *name.split("/"))
+        self.size = None
+        self.md5_hash = None
+        self.generation = None
+
+    def exists(self, **kwargs) -> bool:
+        return os.path.isfile(self.path)
+
+    def reload(self, **kwargs) -> None:
+        if not self.exists():
+            raise NotFound(f"No such object: {self.bucket.name}/{self.name}")
+
+        stat = os.stat(self.path)
+        self.size = stat.st_size
+        self.generation = stat.st_mtime_ns
+        md5 = hashlib.md5()
+        with open(self.path, "rb") as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                md5.update(chunk)
+        self.md5_hash = base64.b64encode(md5.digest()).decode()
+
+    def upload_from_filename(self, filename: str, **kwargs) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.uploading"
+        shutil.copyfile(filename, tmp_path)
+        os.replace(tmp_path, self.path)
+
+    def upload_from_string(self, data, **kwargs) -> None:
+        if isinstance(data, str):
+            data = data.encode()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.uploading"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, self.path)
+
+    def download_to_filename(self, filename: str, **kwargs) -> None:
+        if not self.exists():
+            raise NotFound(f"No such object: {self.bucket.name}/{self.name}")
+        shutil.copyfile(self.path, filename)
+
+    def download_to_file(self, file_obj, start=None, end=None, **kwargs) -> None:
+        if not self.exists():
+            raise NotFound(f"No such object: {self.bucket.name}/{self.name}")
+        with open(self.path, "rb") as file:
+            file.seek(start or 0)
+            # `end` is inclusive, as in the GCS client
+            remaining = None if end is None else end - (start or 0) + 1
+            while remaining is None or remaining > 0:
+                chunk = file.read(1024 * 1024 if remaining is None else min(1024 * 1024, remaining))
+                if not chunk:
+                    break
+                file_obj.write(chunk)
+                if remaining is not None:
+                    remaining -= len(chunk)
+
+    def open(self, mode: str = "rb", **kwargs):
+        if not self.exists():
+            raise NotFound(f"No such object: {self.bucket.name}/{self.name}")
+        return open(self.path, mode)
+
+    def delete(self, **kwargs) -> None:
+        if not self.exists():
+            raise NotFound(f"No such object: {self.bucket.name}/{self.name}")
+        os.remove(self.path)
+
+    def download_as_bytes(self, **kwargs) -> bytes:
+        if not self.exists():
+            raise NotFound(f"No such object: {self.bucket.name}/{self.name}")
+        with open(self.path, "rb") as file:
+            return file.read()
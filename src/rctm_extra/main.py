@@ -1,11 +1,10 @@
 import os
 import typer
 
-from rctm_extra.cmd.init import InitCommand
-from rctm_extra.cmd.split import SplitCommand
-from rctm_extra.cmd.run import RunCommand
-from rctm_extra.cmd.merge import MergeCommand
-from rctm_extra.cmd.submit import SubmitCommand
+from rctm_extra.config import DEFAULT_HISTORY_PATH, DEFAULT_TRANSFER_WORKERS, OUTPUT_FILES, X_STEP, Y_STEP
+
+# every SLURM job starts the CLI, so each command imports its module and the libraries
+# behind it only when it runs. `rctm_extra bench --imports-only` measures what that costs
 
 
 app = typer.Typer(
@@ -15,6 +14,8 @@ app = typer.Typer(
 @app.command("init")
 def init():
     args = type("Args", (), {})()
+    from rctm_extra.cmd.init import InitCommand
+
     InitCommand(args).execute()
 
 
@@ -29,13 +30,111 @@ def split(
     rctm_path: str = typer.Option(
         f"{os.getenv('HOME')}/RCTM", "--rctm-path", "-rctm", help="Path to the RCTM model"
     ),
+    workers: int = typer.Option(
+        None, "--workers", "-w", help="Number of processes writing tiles in parallel. Defaults to the CPU count"
+    ),
+    transfer_workers: int = typer.Option(
+        DEFAULT_TRANSFER_WORKERS, "--transfer-workers", help="Number of parallel bucket transfers"
+    ),
+    tiling: str = typer.Option(
+        "fixed", "--tiling", help="fixed: X_STEP x Y_STEP tiles. adaptive: skip empty areas and balance valid cells per tile"
+    ),
+    target_cells: int = typer.Option(
+        X_STEP * Y_STEP, "--target-cells", help="Valid cells per tile with adaptive tiling"
+    ),
+    max_tile_size: int = typer.Option(
+        None, "--max-tile-size", help="Maximum width and height of a tile with adaptive tiling"
+    ),
+    dry_run: bool = typer.Option(
+        False, "--dry-run", help="Only report the tile and valid cell distribution"
+    ),
+    pipeline: bool = typer.Option(
+        False, "--pipeline", help="Upload every batch as soon as its tiles are written and delete the local tiles afterwards"
+    ),
+    config_index: bool = typer.Option(
+        False, "--config-index", help="Also upload one config index that submit renders every batch config from"
+    ),
+    virtual: bool = typer.Option(
+        False, "--virtual", help="Upload the inputs once as chunked master files, batches only get a window descriptor"
+    ),
+    bbox: str = typer.Option(
+        None, "--bbox", help="xmin,ymin,xmax,ymax in the coordinates of the inputs. Only update the batches of the previous run that overlap it"
+    ),
+    time_range: str = typer.Option(
+        None, "--time-range", help="start,end dates. Only update the tiles of the previous run whose inputs have time steps in it. Without --bbox that is every batch, whose config and SLURM files are also regenerated and compared with the bucket"
+    ),
+    run_dir: str = typer.Option(
+        None, "--run-dir", help="Update an existing local batch directory in place instead of creating a new one. Required with --bbox and --time-range"
+    ),
+    memory_budget: int = typer.Option(
+        None, "--memory-budget", help="MiB the split workers may hold in memory together. Reads the inputs in row bands of batches that fit"
+    ),
+    job_resources: bool = typer.Option(
+        False, "--job-resources", help="Ask SLURM for the time and memory each batch needs, predicted from its valid cells and the jobs in the history file"
+    ),
+    history_path: str = typer.Option(
+        DEFAULT_HISTORY_PATH, "--history", help="Runtimes and memory of earlier jobs, recorded by rctm_extra status"
+    ),
+    compression: str = typer.Option(
+        "zlib", "--compression", help="NetCDF tile compression: none, zlib or zstd"
+    ),
+    compression_level: int = typer.Option(
+        4, "--compression-level", help="NetCDF tile compression level"
+    ),
+    time_chunk: int = typer.Option(
+        None, "--time-chunk", help="Time steps per NetCDF chunk. Defaults to the whole time axis"
+    ),
+    spatial_chunk: int = typer.Option(
+        50, "--spatial-chunk", help="Cells per NetCDF chunk along x and y"
+    ),
+    float32: bool = typer.Option(
+        False, "--float32", help="Store float64 variables as float32 when no value loses precision"
+    ),
+    raster_compression: str = typer.Option(
+        "deflate", "--raster-compression", help="GeoTIFF tile compression: none, deflate, zstd or lzw"
+    ),
+    raster_block_size: int = typer.Option(
+        256, "--raster-block-size", help="GeoTIFF block size, a multiple of 16"
+    ),
+    report_path: str = typer.Option(
+        None, "--report", help="Where to write the JSON run report, a CSV of every item goes next to it. Defaults to the batch directory"
+    ),
 ):
+    from rctm_extra.encoding import EncodingProfile
+
     args = type("Args", (), {
         "config_path": config_path,
         "remote_batch_path": remote_batch_path,
         "rctm_path": rctm_path,
+        "workers": workers,
+        "transfer_workers": transfer_workers,
+        "tiling": tiling,
+        "target_cells": target_cells,
+        "max_tile_size": max_tile_size,
+        "dry_run": dry_run,
+        "pipeline": pipeline,
+        "config_index": config_index,
+        "virtual": virtual,
+        "bbox": bbox,
+        "time_range": time_range,
+        "run_dir": run_dir,
+        "memory_budget": memory_budget,
+        "job_resources": job_resources,
+        "history_path": history_path,
+        "report_path": report_path,
+        "encoding_profile": EncodingProfile(
+            compression=compression,
+            level=compression_level,
+            time_chunk=time_chunk,
+            spatial_chunk=spatial_chunk,
+            float32=float32,
+            raster_compression=raster_compression,
+            raster_block_size=raster_block_size,
+        ),
         },
     )()
+    from rctm_extra.cmd.split import SplitCommand
+
     SplitCommand(args).execute()
 
 
@@ -50,33 +149,271 @@ def submit(
     local_batch_path: str = typer.Option(
         ..., "--local-batch-path", "-l", help="Local path to store remote data"
     ),
+    transfer_workers: int = typer.Option(
+        DEFAULT_TRANSFER_WORKERS, "--transfer-workers", help="Number of parallel bucket transfers"
+    ),
+    array: bool = typer.Option(
+        False, "--array", help="Submit all batches as a single SLURM job array instead of one job per batch"
+    ),
+    batches_per_task: int = typer.Option(
+        1, "--batches-per-task", min=1, help="Number of batches each array task runs"
+    ),
+    max_concurrent: int = typer.Option(
+        None, "--max-concurrent", min=1, help="Maximum number of array tasks running at once"
+    ),
+    max_array_size: int = typer.Option(
+        1000, "--max-array-size", min=1, help="Maximum number of tasks in one array, see MaxArraySize in slurm.conf"
+    ),
+    pack_cpus: int = typer.Option(
+        None, "--pack-cpus", help="Run batches split with --job-resources side by side, up to this many in one job"
+    ),
+    pack_hours: float = typer.Option(
+        4, "--pack-hours", help="Longest time a job of packed batches may ask for"
+    ),
+    report_path: str = typer.Option(
+        None, "--report", help="Where to write the JSON run report, a CSV of every item goes next to it. Defaults to the local batch path"
+    ),
 ):
     args = type("Args", (), {
         "bucket_name": bucket_name,
         "remote_batch_path": remote_batch_path,
         "local_batch_path": local_batch_path,
+        "transfer_workers": transfer_workers,
+        "array": array,
+        "batches_per_task": batches_per_task,
+        "max_concurrent": max_concurrent,
+        "max_array_size": max_array_size,
+        "pack_cpus": pack_cpus,
+        "pack_hours": pack_hours,
+        "report_path": report_path,
         },
     )()
+    from rctm_extra.cmd.submit import SubmitCommand
+
     SubmitCommand(args).execute()
 
 
 @app.command("run")
 def run(
-    config_path: str = typer.Option(
-        ..., "--config-path", "-c", help="Path to the configuration file"
+    config_paths: list[str] = typer.Option(
+        None, "--config-path", "-c", help="Path to the configuration file. Can be repeated"
+    ),
+    batch_index: str = typer.Option(
+        None, "--batch-index", "-i", help="Batch index file written by submit --array"
+    ),
+    task_id: int = typer.Option(
+        None, "--task-id", help="Line of the batch index to run. Defaults to SLURM_ARRAY_TASK_ID, or every line"
+    ),
+    workers: int = typer.Option(
+        1, "--workers", "-w", help="Number of batches to run in parallel. 0 uses every allocated core"
+    ),
+    report_path: str = typer.Option(
+        None, "--report", help="Write a JSON run report with the duration of every batch, and a CSV next to it"
+    ),
+    node_cache: bool = typer.Option(
+        True, "--node-cache/--no-node-cache", help="Read the RCTM templates the configs point at from a node-local copy shared by every job on the node"
+    ),
+    cache_dir: str = typer.Option(
+        None, "--cache-dir", help="Directory of the node-local cache. Defaults to rctm_extra_cache in TMPDIR"
+    ),
+    cache_size: int = typer.Option(
+        1024, "--cache-size", help="Size of the node-local cache in MiB before the least recently used entries are evicted"
+    ),
+    spin_cache: str = typer.Option(
+        None, "--spin-cache", help="Directory or gs://bucket/prefix to reuse spin-up results from when a batch's spin inputs, parameters and config are unchanged. Needs configs that set C_stock_spin_out_path and an RCTM whose transient period reads the spin-up results from there"
+    ),
+    spin_ignore_keys: list[str] = typer.Option(
+        None, "--spin-ignore-key", help="Config key that doesn't affect the spin-up, like a transient-period setting. Can be repeated"
+    ),
+    spin_cache_max_age: float = typer.Option(
+        None, "--spin-cache-max-age", help="Evict spin-up results unused for this many days after the batches ran"
+    ),
+    spin_cache_size: float = typer.Option(
+        None, "--spin-cache-size", help="Evict the least recently used spin-up results beyond this many GiB after the batches ran"
+    ),
+    profile: bool = typer.Option(
+        False, "--profile", help="Write a CPU profile and the wall time and peak memory of every pipeline stage into a profile directory next to each config"
     ),
 ):
     args = type("Args", (), {
-        "config_path": config_path,
+        "config_paths": config_paths,
+        "batch_index": batch_index,
+        "task_id": task_id,
+        "workers": workers,
+        "report_path": report_path,
+        "node_cache": node_cache,
+        "cache_dir": cache_dir,
+        "cache_size": cache_size,
+        "spin_cache": spin_cache,
+        "spin_ignore_keys": spin_ignore_keys,
+        "spin_cache_max_age": spin_cache_max_age,
+        "spin_cache_size": spin_cache_size,
+        "profile": profile,
     })()
+    from rctm_extra.cmd.run import RunCommand
+
     RunCommand(args).execute()
 
 
 @app.command("merge")
-def merge():
-    args = type("Args", (), {})()
+def merge(
+    local_batch_path: str = typer.Option(
+        ..., "--local-batch-path", "-l", help="Local path that holds the batch directories"
+    ),
+    output_path: str = typer.Option(
+        ..., "--output-path", "-o", help="Directory to write the merged files into"
+    ),
+    bucket_name: str = typer.Option(
+        None, "--bucket-name", "-b", help="Bucket to download the batch outputs from. Reads local outputs if omitted"
+    ),
+    remote_batch_path: str = typer.Option(
+        None, "--remote-batch-path", "-p", help="Blob path of the split data without the bucket name"
+    ),
+    output_files: list[str] = typer.Option(
+        OUTPUT_FILES, "--output-file", "-f", help="Batch output to merge, relative to the batch directory. Can be repeated"
+    ),
+    workers: int = typer.Option(
+        None, "--workers", "-w", help="Number of processes reading batch outputs. Defaults to the CPU count"
+    ),
+    transfer_workers: int = typer.Option(
+        DEFAULT_TRANSFER_WORKERS, "--transfer-workers", help="Number of parallel bucket transfers"
+    ),
+):
+    args = type("Args", (), {
+        "local_batch_path": local_batch_path,
+        "output_path": output_path,
+        "bucket_name": bucket_name,
+        "remote_batch_path": remote_batch_path,
+        "output_files": output_files,
+        "workers": workers,
+        "transfer_workers": transfer_workers,
+    })()
+    from rctm_extra.cmd.merge import MergeCommand
+
     MergeCommand(args).execute()
 
 
+@app.command("status")
+def status(
+    local_batch_path: str = typer.Option(
+        ..., "--local-batch-path", "-l", help="Local path given to submit"
+    ),
+    bucket_name: str = typer.Option(
+        None, "--bucket-name", "-b", help="Bucket to look for batch outputs in"
+    ),
+    remote_batch_path: str = typer.Option(
+        None, "--remote-batch-path", "-p", help="Blob path of the split data without the bucket name"
+    ),
+    retry: bool = typer.Option(
+        True, "--retry/--no-retry", help="Resubmit failed and timed out batches"
+    ),
+    max_retries: int = typer.Option(
+        2, "--max-retries", help="Number of times a batch is resubmitted before giving up"
+    ),
+    watch: int = typer.Option(
+        0, "--watch", help="Keep polling every given number of seconds until every batch is done or gave up"
+    ),
+    verbose: bool = typer.Option(
+        False, "--verbose", "-v", help="Print the state of every batch"
+    ),
+    history_path: str = typer.Option(
+        DEFAULT_HISTORY_PATH, "--history", help="File to record the runtime and memory of finished jobs in, split --job-resources sizes jobs from it"
+    ),
+):
+    args = type("Args", (), {
+        "local_batch_path": local_batch_path,
+        "bucket_name": bucket_name,
+        "remote_batch_path": remote_batch_path,
+        "retry": retry,
+        "max_retries": max_retries,
+        "watch": watch,
+        "verbose": verbose,
+        "history_path": history_path,
+    })()
+    from rctm_extra.cmd.status import StatusCommand
+
+    StatusCommand(args).execute()
+
+
+@app.command("profile")
+def profile(
+    local_batch_path: str = typer.Option(
+        ..., "--local-batch-path", "-l", help="Local path that holds the batch directories run with --profile"
+    ),
+    top: int = typer.Option(
+        30, "--top", help="Number of functions to list in each hotspot table"
+    ),
+    report_path: str = typer.Option(
+        None, "--report", help="Where to write the JSON report. Defaults to the local batch path"
+    ),
+):
+    args = type("Args", (), {
+        "local_batch_path": local_batch_path,
+        "top": top,
+        "report_path": report_path,
+    })()
+    from rctm_extra.cmd.profile import ProfileCommand
+
+    ProfileCommand(args).execute()
+
+
+@app.command("bench")
+def bench(
+    output_path: str = typer.Option(
+        "rctm_extra_bench.json", "--output", "-o", help="JSON file to write the results into"
+    ),
+    x_size: int = typer.Option(
+        500, "--x-size", help="Width of the synthetic grid in cells"
+    ),
+    y_size: int = typer.Option(
+        500, "--y-size", help="Height of the synthetic grid in cells"
+    ),
+    time_steps: int = typer.Option(
+        24, "--time-steps", help="Time steps of the synthetic input file"
+    ),
+    workers: int = typer.Option(
+        None, "--workers", "-w", help="Number of processes splitting and merging. Defaults to the CPU count"
+    ),
+    transfer_workers: int = typer.Option(
+        DEFAULT_TRANSFER_WORKERS, "--transfer-workers", help="Number of parallel bucket transfers"
+    ),
+    work_directory: str = typer.Option(
+        None, "--work-dir", help="Directory for the synthetic data and the fake bucket. Defaults to a temporary one"
+    ),
+    keep: bool = typer.Option(
+        False, "--keep", help="Keep the temporary directory"
+    ),
+    compare_path: str = typer.Option(
+        None, "--compare", help="Results of a previous run to compare with"
+    ),
+    max_slowdown: float = typer.Option(
+        None, "--max-slowdown", help="Exit with an error if a stage got slower than this factor of the compared run"
+    ),
+    imports_only: bool = typer.Option(
+        False, "--imports-only", help="Only measure how long every command takes to import, with python -X importtime"
+    ),
+    max_run_startup: float = typer.Option(
+        None, "--max-run-startup", help="Exit with an error if importing the run command takes this many seconds more than the bare interpreter"
+    ),
+):
+    args = type("Args", (), {
+        "output_path": output_path,
+        "x_size": x_size,
+        "y_size": y_size,
+        "time_steps": time_steps,
+        "workers": workers,
+        "transfer_workers": transfer_workers,
+        "work_directory": work_directory,
+        "keep": keep,
+        "compare_path": compare_path,
+        "max_slowdown": max_slowdown,
+        "imports_only": imports_only,
+        "max_run_startup": max_run_startup,
+    })()
+    from rctm_extra.cmd.bench import BenchCommand
+
+    BenchCommand(args).execute()
+
+
 def main():
     app()
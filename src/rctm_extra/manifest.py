@@ -0,0 +1,128 @@
+import base64
+import hashlib
+import json
+import os
+
+from google.api_core.exceptions import NotFound
+
+from rctm_extra.config import PARTIAL_SUFFIX
+
+MANIFEST_NAME = "manifest.json"
+
+
+def file_md5(path: str) -> str:
+    """Base64 encoded MD5 of a file, the same format GCS reports in `Blob.md5_hash`."""
+    md5 = hashlib.md5()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            md5.update(chunk)
+
+    return base64.b64encode(md5.digest()).decode()
+
+
+def is_up_to_date(local_path: str, remote_md5: str) -> bool:
+    return os.path.exists(local_path) and file_md5(local_path) == remote_md5
+
+
+def load_manifest(path: str) -> dict:
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_manifest(manifest: dict, path: str) -> None:
+    with open(path, "w") as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+
+
+def fetch_remote_manifest(storage_client, bucket_name: str, remote_batch_path: str) -> dict:
+    """Returns the manifest of the previous split run under `remote_batch_path`, or an empty one."""
+    blob = storage_client.bucket(bucket_name).blob(f"{remote_batch_path}/{MANIFEST_NAME}")
+    try:
+        return json.loads(blob.download_as_bytes())
+    except NotFound:
+        return {"sources": {}, "files": {}}
+
+
+def unchanged_tiles(previous: dict, batch_obj, source_md5s: dict, encoding: str) -> set:
+    """
+    Returns the tile kinds of a batch that the previous run already produced
+    from the same source file, for the same window and with the same encoding,
+    the `EncodingProfile.fingerprint` of the current run.
+    """
+    kinds = set()
+    for kind, path in batch_obj.tile_paths().items():
+        entry = previous["files"].get(os.path.relpath(path, batch_obj.local_base_directory))
+        if (
+            entry is not None
+            and entry["source_md5"] == source_md5s[kind]
+            and entry.get("encoding") == encoding
+            and tuple(entry["x_range"]) == tuple(batch_obj.x_range)
+            and tuple(entry["y_range"]) == tuple(batch_obj.y_range)
+        ):
+            kinds.add(kind)
+
+    return kinds
+
+
+def manifest_windows(manifest: dict) -> dict:
+    """Returns `batch name -> (x_range, y_range)` of every batch a manifest lists files of."""
+    return {
+        entry["batch"]: (tuple(entry["x_range"]), tuple(entry["y_range"]))
+        for entry in manifest["files"].values()
+    }
+
+
+def accept_sources(previous: dict, source_md5s: dict, changed) -> None:
+    """
+    Mark the tiles of the `previous` manifest for which `changed(entry)` is false as made
+    from the current sources, so an update of part of a site leaves them as they are.
+    """
+    for entry in previous["files"].values():
+        if entry["source"] and not changed(entry):
+            entry["source_md5"] = source_md5s[entry["source"]]
+
+
+def batch_entries(batch_obj, source_md5s: dict, previous: dict, skipped_kinds=(), encoding: str = None) -> dict:
+    """
+    Manifest entries of the files of one batch on disk. Tiles of the `skipped_kinds`
+    were not regenerated and keep the entries of the `previous` manifest.
+    The other tiles were written with the `encoding` fingerprint.
+    """
+    files = {}
+    tile_kinds = {path: kind for kind, path in batch_obj.tile_paths().items()}
+    for kind in skipped_kinds:
+        relative_path = os.path.relpath(batch_obj.tile_paths()[kind], batch_obj.local_base_directory)
+        files[relative_path] = previous["files"][relative_path]
+
+    for dirpath, _, filenames in os.walk(batch_obj.local_batch_path):
+        for filename in filenames:
+            # left behind by a split that was killed while writing the tile
+            if os.path.splitext(filename)[0].endswith(PARTIAL_SUFFIX):
+                continue
+            path = os.path.join(dirpath, filename)
+            kind = tile_kinds.get(path)
+            files[os.path.relpath(path, batch_obj.local_base_directory)] = {
+                "md5": file_md5(path),
+                "size": os.path.getsize(path),
+                "batch": batch_obj.name,
+                "x_range": list(batch_obj.x_range),
+                "y_range": list(batch_obj.y_range),
+                "source": kind,
+                "source_md5": source_md5s[kind] if kind else None,
+                "encoding": encoding if kind else None,
+            }
+
+    return files
+
+
+def build_manifest(batch_objs: list, source_md5s: dict, previous: dict, skipped: dict, encoding: str = None) -> dict:
+    """
+    Creates the manifest of a split run from the files on disk.
+    Tiles listed in `skipped` (batch name -> tile kinds) were not regenerated
+    and keep the entries of the `previous` manifest.
+    """
+    files = {}
+    for obj in batch_objs:
+        files.update(batch_entries(obj, source_md5s, previous, skipped.get(obj.name, ()), encoding))
+
+    return {"sources": source_md5s, "files": files}
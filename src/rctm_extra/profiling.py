@@ -0,0 +1,164 @@
+import cProfile
+import functools
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+CPU_PROFILE_NAME = "cpu.prof"
+STAGES_FILE_NAME = "stages.json"
+# how often the resident memory is sampled while the model runs, in seconds
+RSS_SAMPLE_INTERVAL = 0.05
+
+
+def current_rss() -> int:
+    with open("/proc/self/statm") as file:
+        return int(file.read().split()[1]) * resource.getpagesize()
+
+
+class StageRecorder:
+    """
+    Records the wall time and peak resident memory of every call of the wrapped pipeline methods.
+    Nested calls are recorded too, so the time of a stage includes the stages it calls.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.active = []
+        self.peak_rss = current_rss()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self) -> None:
+        while not self.stopped.wait(RSS_SAMPLE_INTERVAL):
+            rss = current_rss()
+            with self.lock:
+                self.peak_rss = max(self.peak_rss, rss)
+                for call in self.active:
+                    call["peak_rss"] = max(call["peak_rss"], rss)
+
+    def wrap(self, name: str, method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            call = {"stage": name, "depth": len(self.active), "peak_rss": current_rss()}
+            with self.lock:
+                self.active.append(call)
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                call["seconds"] = time.perf_counter() - start
+                call["peak_rss"] = max(call["peak_rss"], current_rss())
+                with self.lock:
+                    self.active.remove(call)
+                self.calls.append(call)
+
+        return wrapper
+
+    def instrument(self, pipeline) -> None:
+        """Wrap every public method the pipeline's class defines, on the instance."""
+        for name in dir(type(pipeline)):
+            if name.startswith("_") or not callable(getattr(type(pipeline), name)):
+                continue
+            setattr(pipeline, name, self.wrap(name, getattr(pipeline, name)))
+
+
+@contextmanager
+def profiled(pipeline, directory: str):
+    """
+    Profile the pipeline while the context is open: a cProfile of the whole run and
+    the wall time and peak memory of every pipeline method, written into `directory`.
+    """
+    recorder = StageRecorder()
+    recorder.instrument(pipeline)
+    profile = cProfile.Profile()
+    recorder.sampler.start()
+    error = None
+    start = time.perf_counter()
+    profile.enable()
+    try:
+        yield
+    except Exception as e:
+        error = repr(e)
+        raise
+    finally:
+        profile.disable()
+        seconds = time.perf_counter() - start
+        recorder.stopped.set()
+        recorder.sampler.join()
+
+        os.makedirs(directory, exist_ok=True)
+        profile.dump_stats(os.path.join(directory, CPU_PROFILE_NAME))
+        with open(os.path.join(directory, STAGES_FILE_NAME), "w") as file:
+            json.dump({
+                "seconds": seconds,
+                "peak_rss": max(recorder.peak_rss, current_rss()),
+                # the largest program the model started so far, like STARFM. ru_maxrss is in KiB on Linux
+                "children_peak_rss": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+                "error": error,
+                "stages": recorder.calls,
+            }, file, indent=1)
+
+
+def self_seconds(calls: list) -> list:
+    """
+    The time of every call of a stages file minus the time of the stages it called, in the order of `calls`.
+    Calls are recorded when they return, so the ones a call made come right before it, one `depth` deeper.
+    """
+    # seconds of the finished calls at each depth whose caller hasn't returned yet
+    nested = {}
+    seconds = []
+    for call in calls:
+        seconds.append(call["seconds"] - nested.pop(call["depth"] + 1, 0.0))
+        nested[call["depth"]] = nested.get(call["depth"], 0.0) + call["seconds"]
+
+    return seconds
+
+
+def aggregate_stages(stage_files: list) -> tuple:
+    """
+    Sum up the stages files of many batches. `seconds` is the self time of a stage, without the stages
+    it calls, so the stages add up to the time spent in the pipeline; `cumulative_seconds` includes them.
+    Returns `stage -> {"batches", "calls", "seconds", "cumulative_seconds", "max_seconds", "max_peak_rss"}`
+    and the seconds of all batches.
+    """
+    stages = {}
+    totals = []
+    for path in stage_files:
+        with open(path) as file:
+            batch = json.load(file)
+        totals.append(batch["seconds"])
+        seen = set()
+        for call, seconds in zip(batch["stages"], self_seconds(batch["stages"])):
+            stage = stages.setdefault(call["stage"], {
+                "batches": 0, "calls": 0, "seconds": 0.0, "cumulative_seconds": 0.0, "max_seconds": 0.0, "max_peak_rss": 0,
+            })
+            if call["stage"] not in seen:
+                stage["batches"] += 1
+                seen.add(call["stage"])
+            stage["calls"] += 1
+            stage["seconds"] += seconds
+            stage["cumulative_seconds"] += call["seconds"]
+            stage["max_seconds"] = max(stage["max_seconds"], call["seconds"])
+            stage["max_peak_rss"] = max(stage["max_peak_rss"], call["peak_rss"])
+
+    return stages, sum(totals)
+
+
+def hotspots(stats, count: int, key: int) -> list:
+    """
+    The `count` functions of a `pstats.Stats` with the largest total (`key=2`) or cumulative (`key=3`) time.
+    Returns `(function, calls, total seconds, cumulative seconds)` rows.
+    """
+    rows = []
+    for (file_name, line, function_name), (_, calls, total, cumulative, _) in stats.stats.items():
+        # the stage wrappers only add themselves on top of every stage
+        if os.path.basename(file_name) == os.path.basename(__file__):
+            continue
+        location = function_name if file_name == "~" else f"{os.path.basename(file_name)}:{line}({function_name})"
+        rows.append((location, calls, total, cumulative))
+
+    return sorted(rows, key=lambda row: row[key], reverse=True)[:count]
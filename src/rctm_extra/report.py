@@ -0,0 +1,163 @@
+import csv
+import json
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+BATCH_NAME = re.compile(r"batch_x_\d+-\d+_y_\d+-\d+")
+# redraw the progress line at most this often, in seconds
+PROGRESS_INTERVAL = 0.2
+CSV_FIELDS = ["stage", "item", "batch", "seconds", "bytes", "retries", "error"]
+
+
+class StageProgress:
+    """Counts the items of one stage and keeps a progress line up to date on a terminal."""
+
+    def __init__(self, report: "RunReport", name: str, total: int = None):
+        self.report = report
+        self.name = name
+        self.total = total
+        self.items = 0
+        self.bytes = 0
+        self.retries = 0
+        self.failures = 0
+        self.started = time.perf_counter()
+        self.last_draw = 0
+
+    def advance(self, item: str, seconds: float = None, nbytes: int = 0, retries: int = 0, error=None, batch: str = None) -> None:
+        """Record one finished item. Safe to call from worker threads."""
+        if batch is None:
+            match = BATCH_NAME.search(str(item))
+            batch = match.group() if match else None
+
+        with self.report.lock:
+            self.items += 1
+            self.bytes += nbytes or 0
+            self.retries += retries
+            self.failures += error is not None
+            self.report.rows.append({
+                "stage": self.name,
+                "item": str(item),
+                "batch": batch,
+                "seconds": seconds,
+                "bytes": nbytes,
+                "retries": retries,
+                "error": None if error is None else str(error),
+            })
+            self._draw()
+
+    def fail(self, item: str, error, batch: str = None) -> None:
+        self.advance(item, error=error, batch=batch)
+
+    def _draw(self, force: bool = False) -> None:
+        now = time.perf_counter()
+        if not self.report.live or (not force and now - self.last_draw < PROGRESS_INTERVAL):
+            return
+
+        self.last_draw = now
+        elapsed = max(now - self.started, 1e-9)
+        line = f"{self.name}: {self.items}" + (f"/{self.total}" if self.total is not None else "")
+        if self.bytes:
+            line += f", {self.bytes / 1024 ** 2:.1f} MiB at {self.bytes / 1024 ** 2 / elapsed:.1f} MiB/s"
+        if self.failures:
+            line += f", {self.failures} failed"
+        sys.stderr.write(f"\r\033[K{line}")
+        sys.stderr.flush()
+
+    def summary(self, seconds: float) -> dict:
+        return {
+            "seconds": seconds,
+            "items": self.items,
+            "total": self.total,
+            "bytes": self.bytes,
+            "throughput": self.bytes / seconds if seconds else None,
+            "retries": self.retries,
+            "failures": self.failures,
+        }
+
+
+class RunReport:
+    """
+    Collects the duration, transferred bytes, retries and failures of the stages of a command
+    and of every item they handle, and saves them as a JSON report with a CSV of the items next to it.
+    The live progress line is only drawn when stderr is a terminal, not in SLURM logs.
+    """
+
+    def __init__(self, command: str, live: bool = None):
+        self.command = command
+        self.live = sys.stderr.isatty() if live is None else live
+        self.started_at = time.time()
+        self.stages = {}
+        self.rows = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str, total: int = None):
+        progress = StageProgress(self, name, total)
+        try:
+            yield progress
+        finally:
+            seconds = time.perf_counter() - progress.started
+            with self.lock:
+                progress._draw(force=True)
+                if self.live:
+                    sys.stderr.write("\n")
+                self.stages[name] = progress.summary(seconds)
+
+    @property
+    def failures(self) -> int:
+        return sum(stage["failures"] for stage in self.stages.values())
+
+    def batches(self) -> dict:
+        """Returns `batch name -> {stage: seconds}`, summed over the items of the batch."""
+        batches = {}
+        for row in self.rows:
+            if row["batch"] and row["seconds"] is not None:
+                stages = batches.setdefault(row["batch"], {})
+                stages[row["stage"]] = stages.get(row["stage"], 0) + row["seconds"]
+
+        return batches
+
+    def to_dict(self) -> dict:
+        return {
+            "command": self.command,
+            "started_at": self.started_at,
+            "seconds": time.time() - self.started_at,
+            "failures": self.failures,
+            "stages": self.stages,
+            "batches": self.batches(),
+            "failed_items": [row for row in self.rows if row["error"] is not None],
+        }
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as file:
+            json.dump(self.to_dict(), file, indent=1, sort_keys=True)
+
+        with open(f"{os.path.splitext(path)[0]}.csv", "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=CSV_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.rows)
+
+    def print_summary(self) -> None:
+        for name, stage in self.stages.items():
+            line = f"{name:<20} {stage['seconds']:>9.2f} s {stage['items']:>8} items"
+            if stage["bytes"] and stage["throughput"]:
+                line += f" {stage['bytes'] / 1024 ** 2:>10.1f} MiB {stage['throughput'] / 1024 ** 2:>8.1f} MiB/s"
+            if stage["retries"]:
+                line += f" {stage['retries']} retries"
+            if stage["failures"]:
+                line += f" {stage['failures']} failed"
+            print(line)
+
+    def finish(self, path: str) -> int:
+        """Print the stage summary and save the report. Returns the number of failed items."""
+        self.print_summary()
+        self.save(path)
+        print(f"run report saved to {path}")
+        if self.failures:
+            print(f"{self.failures} items failed, see the report for details")
+
+        return self.failures
@@ -0,0 +1,173 @@
+import heapq
+import json
+import math
+import os
+import re
+from dataclasses import dataclass
+
+import numpy as np
+
+# runs needed before jobs are sized from the history instead of taking a whole node
+MIN_HISTORY = 5
+# requests are the prediction times these margins, jobs over their request get killed
+TIME_MARGIN = 1.5
+MEMORY_MARGIN = 1.3
+MIN_SECONDS = 10 * 60
+MIN_MEMORY = 1024 ** 3
+# the first line of a batch's SLURM script, read back to relate a job's usage to the size of its batches
+SIZE_HEADER = "# rctm_extra: valid_cells={valid_cells} time_steps={time_steps}"
+SIZE_PATTERN = re.compile(r"# rctm_extra: valid_cells=(\d+) time_steps=(\d+)")
+
+
+@dataclass
+class Resources:
+    seconds: int
+    memory: int
+    cpus: int = 1
+
+    def sbatch_lines(self) -> str:
+        minutes = math.ceil(self.seconds / 60)
+        return (
+            f"#SBATCH --time={minutes // 60:02d}:{minutes % 60:02d}:00\n"
+            f"#SBATCH --mem={math.ceil(self.memory / 1024 ** 2)}M\n"
+            f"#SBATCH --cpus-per-task={self.cpus}"
+        )
+
+
+def read_script_resources(script_path: str):
+    """
+    Returns the `(valid_cells, time_steps)` and the `Resources` a SLURM script of split was written with.
+    Either is None if the script doesn't have them.
+    """
+    if not os.path.exists(script_path):
+        return None, None
+
+    with open(script_path) as file:
+        text = file.read()
+
+    match = SIZE_PATTERN.search(text)
+    size = (int(match.group(1)), int(match.group(2))) if match else None
+    time_match = re.search(r"--time=(\d+):(\d+):(\d+)", text)
+    memory_match = re.search(r"--mem=(\d+)M", text)
+    cpus_match = re.search(r"--cpus-per-task=(\d+)", text)
+    resources = None
+    if time_match and memory_match:
+        hours, minutes, seconds = map(int, time_match.groups())
+        resources = Resources(
+            seconds=hours * 3600 + minutes * 60 + seconds,
+            memory=int(memory_match.group(1)) * 1024 ** 2,
+            cpus=int(cpus_match.group(1)) if cpus_match else 1,
+        )
+
+    return size, resources
+
+
+def resize_script(script_path: str, resources: Resources) -> None:
+    """Replace the resource requests of a SLURM script written with them."""
+    with open(script_path) as file:
+        text = file.read()
+
+    time_line, memory_line, cpus_line = resources.sbatch_lines().splitlines()
+    text = re.sub(r"#SBATCH --time=.*", time_line, text)
+    text = re.sub(r"#SBATCH --mem=.*", memory_line, text)
+    text = re.sub(r"#SBATCH --cpus-per-task=.*", cpus_line, text)
+    with open(script_path, "w") as file:
+        file.write(text)
+
+
+def load_history(path: str) -> list:
+    if not os.path.exists(path):
+        return []
+
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def append_history(path: str, records: list) -> None:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "a") as file:
+        for record in records:
+            file.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+class CostModel:
+    """
+    Predicts the runtime and the peak memory of a batch as linear functions of its
+    valid cells times time steps, fitted to the completed jobs of the history file.
+    """
+
+    def __init__(self, time_coefficients: tuple, memory_coefficients: tuple, runs: int):
+        self.time_coefficients = time_coefficients
+        self.memory_coefficients = memory_coefficients
+        self.runs = runs
+
+    @staticmethod
+    def fit(history: list):
+        """Returns the model of the history, or None if it has fewer than `MIN_HISTORY` completed jobs."""
+        # a job running several batches in parallel works through their cells `cpus` at a time
+        # and holds the memory of `cpus` of them, so it counts as that share of one batch
+        runs = [
+            (record["cell_steps"] / record["cpus"], record["seconds"], record["max_rss"] / min(record["cpus"], record["batches"]))
+            for record in history
+            if record["state"] == "COMPLETED" and record["seconds"] and record["max_rss"]
+        ]
+        if len(runs) < MIN_HISTORY:
+            return None
+
+        work, seconds, memory = (np.array(values, dtype=float) for values in zip(*runs))
+        design = np.column_stack([np.ones_like(work), work])
+
+        def fit_line(values):
+            (intercept, slope), *_ = np.linalg.lstsq(design, values, rcond=None)
+            # noisy runs can tilt the line below zero, the minimums of `predict` cover small batches
+            return max(intercept, 0), max(slope, 0)
+
+        return CostModel(fit_line(seconds), fit_line(memory), len(runs))
+
+    def predict(self, valid_cells: int, time_steps: int) -> Resources:
+        work = valid_cells * time_steps
+        seconds = self.time_coefficients[0] + self.time_coefficients[1] * work
+        memory = self.memory_coefficients[0] + self.memory_coefficients[1] * work
+        return Resources(
+            seconds=max(int(seconds * TIME_MARGIN), MIN_SECONDS),
+            memory=max(int(memory * MEMORY_MARGIN), MIN_MEMORY),
+        )
+
+
+def makespan(seconds: list, cpus: int) -> int:
+    """
+    How long `cpus` workers take to run batches of `seconds` in the given order, each one
+    started on the first worker that is free, the way `rctm_extra run --workers 0` runs a pack.
+    """
+    workers = [0] * max(min(cpus, len(seconds)), 1)
+    for batch_seconds in seconds:
+        heapq.heapreplace(workers, workers[0] + batch_seconds)
+
+    return max(workers)
+
+
+def pack_batches(requests: dict, cpus: int, max_seconds: int) -> list:
+    """
+    Group batches into jobs that run up to `cpus` of them side by side within `max_seconds`,
+    first fit, longest batch first. `requests` holds the `Resources` of every batch by name.
+    A job asks for the makespan of its batches, which run longest first.
+    Returns `(batch names, Resources)` of every job.
+    """
+    packs = []
+    for name in sorted(requests, key=lambda name: requests[name].seconds, reverse=True):
+        for pack in packs:
+            if makespan([requests[other].seconds for other in pack + [name]], cpus) <= max_seconds:
+                pack.append(name)
+                break
+        else:
+            packs.append([name])
+
+    jobs = []
+    for pack in packs:
+        pack_cpus = min(cpus, len(pack))
+        seconds = makespan([requests[name].seconds for name in pack], pack_cpus)
+        # the workers hold at most the `pack_cpus` largest batches at once
+        memory = sum(sorted((requests[name].memory for name in pack), reverse=True)[:pack_cpus])
+        jobs.append((pack, Resources(seconds, memory, pack_cpus)))
+
+    return jobs
@@ -0,0 +1,112 @@
+import subprocess
+
+# SLURM job states after which the job won't run again on its own
+FAILED_STATES = {
+    "BOOT_FAIL",
+    "CANCELLED",
+    "DEADLINE",
+    "FAILED",
+    "NODE_FAIL",
+    "OUT_OF_MEMORY",
+    "PREEMPTED",
+    "TIMEOUT",
+}
+# how many job IDs go into one sacct/squeue call
+QUERY_CHUNK_SIZE = 500
+
+
+def sbatch(script_path: str) -> str:
+    """Submit a script and return its job ID."""
+    result = subprocess.run(["sbatch", "--parsable", script_path], capture_output=True, text=True, check=True)
+    # --parsable prints "<job id>" or "<job id>;<cluster>"
+    return result.stdout.strip().split(";")[0]
+
+
+def _parse_states(output: str) -> dict:
+    states = {}
+    for line in output.splitlines():
+        if "|" not in line:
+            continue
+        job_id, state = line.split("|", 1)
+        # sacct reports states like "CANCELLED by 1234"
+        states[job_id.strip()] = state.split()[0] if state.strip() else "UNKNOWN"
+
+    return states
+
+
+def query_states(job_ids: list) -> dict:
+    """
+    Returns the SLURM state of each job ID (plain or `<array id>_<task>`) that the scheduler knows.
+    Asks sacct first and falls back to squeue for the jobs sacct doesn't report,
+    e.g. when accounting is disabled.
+    """
+    base_ids = sorted({job_id.split("_")[0] for job_id in job_ids})
+    states = {}
+    for i in range(0, len(base_ids), QUERY_CHUNK_SIZE):
+        chunk = ",".join(base_ids[i:i + QUERY_CHUNK_SIZE])
+        try:
+            result = subprocess.run(
+                ["sacct", "-n", "-P", "-X", "-j", chunk, "--format=JobID,State"],
+                capture_output=True, text=True, check=True,
+            )
+            states.update(_parse_states(result.stdout))
+        except (OSError, subprocess.CalledProcessError):
+            pass
+
+    missing = sorted({job_id.split("_")[0] for job_id in job_ids if job_id not in states})
+    for i in range(0, len(missing), QUERY_CHUNK_SIZE):
+        chunk = ",".join(missing[i:i + QUERY_CHUNK_SIZE])
+        try:
+            result = subprocess.run(
+                ["squeue", "-h", "-r", "-j", chunk, "-o", "%i|%T"],
+                capture_output=True, text=True, check=True,
+            )
+            states.update(_parse_states(result.stdout))
+        except (OSError, subprocess.CalledProcessError):
+            pass
+
+    return {job_id: states[job_id] for job_id in job_ids if job_id in states}
+
+
+def _parse_memory(value: str) -> int:
+    """Bytes of a sacct memory value like "1234K"."""
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    value = value.strip()
+    if not value:
+        return 0
+    if value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(float(value))
+
+
+def query_usage(job_ids: list) -> dict:
+    """
+    Returns `{job ID: (state, elapsed seconds, peak RSS in bytes, allocated CPUs)}` of the jobs sacct knows.
+    The peak RSS is the largest of the job's steps, sacct only reports it per step.
+    """
+    base_ids = sorted({job_id.split("_")[0] for job_id in job_ids})
+    usage = {}
+    for i in range(0, len(base_ids), QUERY_CHUNK_SIZE):
+        chunk = ",".join(base_ids[i:i + QUERY_CHUNK_SIZE])
+        try:
+            result = subprocess.run(
+                ["sacct", "-n", "-P", "-j", chunk, "--format=JobID,State,ElapsedRaw,MaxRSS,AllocCPUS"],
+                capture_output=True, text=True, check=True,
+            )
+        except (OSError, subprocess.CalledProcessError):
+            continue
+
+        max_rss = {}
+        for line in result.stdout.splitlines():
+            fields = line.split("|")
+            if len(fields) != 5:
+                continue
+            step_id, state, elapsed, rss, cpus = fields
+            job_id = step_id.split(".")[0]
+            max_rss[job_id] = max(max_rss.get(job_id, 0), _parse_memory(rss))
+            if "." not in step_id:
+                usage[job_id] = (state.split()[0] if state.strip() else "UNKNOWN", int(elapsed or 0), 0, int(cpus or 1))
+        for job_id, (state, elapsed, _, cpus) in list(usage.items()):
+            usage[job_id] = (state, elapsed, max_rss.get(job_id, 0), cpus)
+
+    return {job_id: usage[job_id] for job_id in job_ids if job_id in usage}
@@ -1,5 +1,21 @@
+import contextlib
+import os
+import time
+
+import netCDF4
+import numpy as np
+import rioxarray
 import xarray as xr
 
+from rctm_extra.config import PARTIAL_SUFFIX, TILE_ALIGN, X_STEP, Y_STEP
+from rctm_extra.encoding import EncodingProfile
+from rctm_extra.tiling import ValidCellGrid
+
+# master datasets opened once per split worker process, see `open_sources`
+_sources = {}
+# peak memory of writing a block as a multiple of its size, the tile being encoded is a copy
+BLOCK_MEMORY_FACTOR = 2
+
 
 def get_dimensions_netcdf(file_path: str, x_dim: str = "x", y_dim: str = "y"):
     with xr.open_dataset(file_path) as ds:
@@ -7,3 +23,322 @@ def get_dimensions_netcdf(file_path: str, x_dim: str = "x", y_dim: str = "y"):
         Y = ds.sizes[y_dim]
 
     return X, Y
+
+
+def grid_description(file_path: str) -> dict:
+    """
+    The size and cell-center coordinates of the x and y axes of a NetCDF file, as split stores them
+    in the manifest. A regular axis is kept as its start and step, any other one as every value.
+    """
+    description = {}
+    with xr.open_dataset(file_path) as ds:
+        for dim in ("x", "y"):
+            coords = ds[dim].values.astype(np.float64)
+            step = float(coords[1] - coords[0]) if len(coords) > 1 else 0.0
+            axis = {"size": len(coords), "start": float(coords[0]), "step": step}
+            if not np.allclose(np.diff(coords), step):
+                axis["values"] = coords.tolist()
+            description[dim] = axis
+
+    return description
+
+
+def grid_coordinates(description: dict) -> dict:
+    """The x and y coordinates of every cell of a grid from its `grid_description`."""
+    return {
+        dim: np.array(axis["values"]) if "values" in axis else axis["start"] + axis["step"] * np.arange(axis["size"])
+        for dim, axis in description.items()
+    }
+
+
+def coordinate_window(file_path: str, bbox: tuple):
+    """
+    Returns the `(x_range, y_range)` of the cells of a NetCDF file that overlap
+    `bbox`, `(xmin, ymin, xmax, ymax)` in the coordinates of the file, or None if no cell does.
+    """
+    xmin, ymin, xmax, ymax = bbox
+    with xr.open_dataset(file_path) as ds:
+        x, y = ds["x"].values, ds["y"].values
+
+    ranges = []
+    for coords, low, high in ((x, xmin, xmax), (y, ymin, ymax)):
+        # coordinates are cell centers, a cell overlaps if any part of it is inside
+        half = abs(coords[1] - coords[0]) / 2 if len(coords) > 1 else 0
+        indices = np.flatnonzero((coords + half > low) & (coords - half < high))
+        if not len(indices):
+            return None
+        ranges.append((int(indices[0]), int(indices[-1]) + 1))
+
+    return tuple(ranges)
+
+
+def count_time_steps(file_path: str) -> int:
+    """Number of time steps of a NetCDF file, 1 if it has no time axis."""
+    with xr.open_dataset(file_path) as ds:
+        return ds.sizes.get("time", 1)
+
+
+def time_steps_in_range(file_path: str, start: str, end: str) -> int:
+    """Number of time steps of a NetCDF file from `start` to `end`, both included. 0 if it has no time axis."""
+    with xr.open_dataset(file_path) as ds:
+        if "time" not in ds.coords:
+            return 0
+        return ds["time"].sel(time=slice(start, end)).size
+
+
+def spatial_index(dimensions, x_range, y_range):
+    return tuple(
+        slice(*x_range) if dim == "x" else slice(*y_range) if dim == "y" else slice(None)
+        for dim in dimensions
+    )
+
+
+def create_netcdf_target(template_path: str, target_path: str, X: int, Y: int, x_chunk: int = X_STEP, y_chunk: int = Y_STEP, profile: EncodingProfile = None) -> None:
+    """
+    Create an empty, chunked NetCDF file shaped like the file at
+    `template_path` but spanning the whole X by Y grid, compressed as `profile` says.
+    Variables without x and y dimensions are copied over.
+    """
+    compression = (profile or EncodingProfile()).netcdf4_compression()
+    with netCDF4.Dataset(template_path) as src, netCDF4.Dataset(target_path, "w") as dst:
+        src.set_auto_maskandscale(False)
+        dst.set_auto_maskandscale(False)
+        dst.setncatts(src.__dict__)
+        sizes = {}
+        for name, dim in src.dimensions.items():
+            sizes[name] = {"x": X, "y": Y}.get(name, len(dim))
+            dst.createDimension(name, None if dim.isunlimited() else sizes[name])
+
+        for name, var in src.variables.items():
+            chunks = [
+                min(x_chunk, X) if dim == "x" else min(y_chunk, Y) if dim == "y" else max(sizes[dim], 1)
+                for dim in var.dimensions
+            ]
+            out = dst.createVariable(
+                name,
+                var.dtype,
+                var.dimensions,
+                **compression,
+                chunksizes=chunks or None,
+                fill_value=var.__dict__.get("_FillValue"),
+            )
+            out.setncatts({key: value for key, value in var.__dict__.items() if key != "_FillValue"})
+            if "x" not in var.dimensions and "y" not in var.dimensions:
+                out[:] = var[:]
+
+
+def rechunk_netcdf(source_path: str, target_path: str, chunk: int, profile: EncodingProfile = None) -> None:
+    """
+    Copy a NetCDF file into one stored in `chunk` x `chunk` spatial chunks that hold
+    the whole time axis, so reading a window only touches the chunks it overlaps.
+    The copy is compressed as `profile` says and goes in strips of about `Y_STEP` rows.
+    """
+    with netCDF4.Dataset(source_path) as src:
+        X, Y = len(src.dimensions["x"]), len(src.dimensions["y"])
+
+    create_netcdf_target(source_path, target_path, X, Y, chunk, chunk, profile)
+    # whole chunks per strip, so no chunk is compressed twice
+    strip = max(Y_STEP // chunk, 1) * chunk
+    with netCDF4.Dataset(source_path) as src, netCDF4.Dataset(target_path, "a") as dst:
+        src.set_auto_maskandscale(False)
+        dst.set_auto_maskandscale(False)
+        for name, var in src.variables.items():
+            if "x" not in var.dimensions and "y" not in var.dimensions:
+                continue
+            for y_start in range(0, Y, strip):
+                index = spatial_index(var.dimensions, (0, X), (y_start, min(y_start + strip, Y)))
+                dst.variables[name][index] = var[index]
+
+
+def get_valid_cell_grid(path_to_input: str, path_to_params: str, align: int = TILE_ALIGN, opener=None) -> ValidCellGrid:
+    """
+    Count the valid cells of the site in `align` x `align` blocks. A cell is valid when every
+    spatial parameter band and the first time step of every input variable is set.
+    The sources are read in strips of `Y_STEP` rows so memory doesn't grow with the grid.
+    `opener(path)` returns a file object for both paths, to read them from a bucket instead of the disk.
+    """
+    input_file = opener(path_to_input) if opener else contextlib.nullcontext(path_to_input)
+    with (
+        input_file as source,
+        xr.open_dataset(source, engine="h5netcdf" if opener else None) as ds,
+        rioxarray.open_rasterio(path_to_params, masked=True, opener=opener) as params,
+    ):
+        x_dim, y_dim = ds.sizes["x"], ds.sizes["y"]
+        # `Y_STEP` is a multiple of `align`, so strips never split a block
+        strip = max(Y_STEP // align, 1) * align
+        counts = np.zeros((-(-y_dim // align), -(-x_dim // align)), dtype=np.int64)
+        variables = [name for name, var in ds.data_vars.items() if {"x", "y"} <= set(var.dims)]
+        for y_start in range(0, y_dim, strip):
+            rows = slice(y_start, min(y_start + strip, y_dim))
+            valid = params.isel(y=rows).notnull().all("band").values
+            for name in variables:
+                var = ds[name].isel(y=rows)
+                var = var.isel({dim: 0 for dim in var.dims if dim not in ("x", "y")})
+                valid &= var.notnull().transpose("y", "x").values
+
+            padded = np.zeros((strip, counts.shape[1] * align), dtype=bool)
+            padded[: valid.shape[0], : valid.shape[1]] = valid
+            block_counts = padded.reshape(strip // align, align, counts.shape[1], align).sum(axis=(1, 3))
+            first_block = y_start // align
+            last_block = min(first_block + strip // align, counts.shape[0])
+            counts[first_block:last_block] = block_counts[: last_block - first_block]
+
+    return ValidCellGrid(counts, align, x_dim, y_dim)
+
+
+def open_sources(path_to_input: str, path_to_spin_input: str, path_to_params: str) -> None:
+    """
+    Open the master input files lazily in the current process.
+    Used as a process pool initializer so every worker keeps its own file handles
+    and only reads the windows of the batches it writes.
+    """
+    _sources["input"] = xr.open_dataset(path_to_input)
+    _sources["spin_input"] = xr.open_dataset(path_to_spin_input)
+    _sources["params"] = rioxarray.open_rasterio(path_to_params)
+
+
+def get_window(ds, batch_obj):
+    return ds.isel(
+        x=slice(batch_obj.x_range[0], batch_obj.x_range[1]),
+        y=slice(batch_obj.y_range[0], batch_obj.y_range[1]),
+    )
+
+
+def write_tile(kind: str, subset, path: str, profile: EncodingProfile) -> tuple:
+    """
+    Write one tile. Returns its in-memory and its on-disk size.
+    The tile only appears at `path` once it is complete. If writing fails,
+    any older tile at `path` is removed too, so no stale tile gets into the manifest.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    root, extension = os.path.splitext(path)
+    # the extension stays last, rasterio picks the driver from it
+    partial_path = f"{root}{PARTIAL_SUFFIX}{extension}"
+    try:
+        if kind == "params":
+            subset.rio.to_raster(partial_path, **profile.raster_options(subset))
+        else:
+            subset.to_netcdf(partial_path, encoding=profile.netcdf_encoding(subset))
+    except BaseException:
+        for leftover in (partial_path, path):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        raise
+    os.replace(partial_path, path)
+
+    return subset.nbytes, os.path.getsize(path)
+
+
+def write_batch_tiles(batch_obj, kinds=None, profile: EncodingProfile = None) -> dict:
+    """
+    Write the input, spin input and spatial parameter tiles of a batch
+    from the sources opened by `open_sources`. `kinds` restricts which of them are written.
+    Returns the in-memory and the on-disk size of each written tile.
+    """
+    profile = profile or EncodingProfile()
+    sizes = {}
+    for kind, path in batch_obj.tile_paths().items():
+        if kinds is not None and kind not in kinds:
+            continue
+
+        sizes[kind] = write_tile(kind, get_window(_sources[kind], batch_obj), path, profile)
+
+    return sizes
+
+
+def write_batch_task(task) -> tuple:
+    """
+    `write_batch_tiles` for a `(batch_obj, kinds, profile)` tuple, for pools that map over single items.
+    Returns the tile sizes and the seconds the batch took.
+    """
+    start = time.perf_counter()
+    sizes = write_batch_tiles(*task)
+    return sizes, time.perf_counter() - start
+
+
+def cell_bytes(path_to_input: str, path_to_spin_input: str, path_to_params: str) -> int:
+    """Bytes one cell of the largest source takes in memory, with every variable and time step."""
+    sizes = []
+    for path in (path_to_input, path_to_spin_input):
+        with xr.open_dataset(path) as ds:
+            cells = ds.sizes["x"] * ds.sizes["y"]
+            sizes.append(sum(
+                var.dtype.itemsize * var.size // cells
+                for var in ds.data_vars.values()
+                if {"x", "y"} <= set(var.dims)
+            ))
+    with rioxarray.open_rasterio(path_to_params) as da:
+        sizes.append(da.dtype.itemsize * da.sizes["band"])
+
+    return max(sizes)
+
+
+def block_window(batch_objs: list) -> tuple:
+    """The `(x_range, y_range)` that covers every batch of a block."""
+    return (
+        (min(obj.x_range[0] for obj in batch_objs), max(obj.x_range[1] for obj in batch_objs)),
+        (min(obj.y_range[0] for obj in batch_objs), max(obj.y_range[1] for obj in batch_objs)),
+    )
+
+
+def block_bytes(batch_objs: list, bytes_per_cell: int) -> int:
+    """Peak memory of writing a block."""
+    x_range, y_range = block_window(batch_objs)
+    return (x_range[1] - x_range[0]) * (y_range[1] - y_range[0]) * bytes_per_cell * BLOCK_MEMORY_FACTOR
+
+
+def plan_blocks(batch_objs: list, bytes_per_cell: int, max_bytes: int) -> list:
+    """
+    Group the batches into blocks that are read from the sources in one go: the batches that start
+    in the same `Y_STEP` row band, left to right, as long as writing the block takes at most `max_bytes`.
+    A batch that needs more than that on its own is a block by itself.
+    """
+    strips = {}
+    for obj in sorted(batch_objs, key=lambda obj: (obj.y_range[0], obj.x_range[0])):
+        strips.setdefault(obj.y_range[0] // Y_STEP, []).append(obj)
+
+    blocks = []
+    for strip in strips.values():
+        block = []
+        for obj in sorted(strip, key=lambda obj: obj.x_range[0]):
+            if block and block_bytes(block + [obj], bytes_per_cell) > max_bytes:
+                blocks.append(block)
+                block = []
+            block.append(obj)
+        blocks.append(block)
+
+    return blocks
+
+
+def write_block_task(task) -> list:
+    """
+    Read the window of a block of batches from each source opened by `open_sources` once,
+    one source at a time, and write the tiles of its batches from memory.
+    `task` is `(batch_objs, tile_kinds, profile)` with the tile kinds to write by batch name.
+    Returns `(batch_obj, sizes, seconds)` for every batch of the block.
+    """
+    batch_objs, tile_kinds, profile = task
+    profile = profile or EncodingProfile()
+    x_range, y_range = block_window(batch_objs)
+    sizes = {obj.name: {} for obj in batch_objs}
+    seconds = dict.fromkeys(sizes, 0.0)
+    for kind in _sources:
+        kind_objs = [obj for obj in batch_objs if kind in tile_kinds[obj.name]]
+        if not kind_objs:
+            continue
+
+        start = time.perf_counter()
+        block = _sources[kind].isel(x=slice(*x_range), y=slice(*y_range)).load()
+        # the read is shared by the batches of the block
+        read_seconds = (time.perf_counter() - start) / len(kind_objs)
+        for obj in kind_objs:
+            start = time.perf_counter()
+            subset = block.isel(
+                x=slice(obj.x_range[0] - x_range[0], obj.x_range[1] - x_range[0]),
+                y=slice(obj.y_range[0] - y_range[0], obj.y_range[1] - y_range[0]),
+            )
+            sizes[obj.name][kind] = write_tile(kind, subset, obj.tile_paths()[kind], profile)
+            seconds[obj.name] += read_seconds + time.perf_counter() - start
+        del block
+
+    return [(obj, sizes[obj.name], seconds[obj.name]) for obj in batch_objs]
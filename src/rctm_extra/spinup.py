@@ -0,0 +1,229 @@
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+import yaml
+from google.api_core.exceptions import NotFound
+
+from rctm_extra.gcp import get_storage_client, list_blob_checksums
+from rctm_extra.io import config_paths
+from rctm_extra.local_storage import LocalStorageClient
+from rctm_extra.manifest import file_md5
+
+# the pipeline method that runs the spin-up, a cache hit replaces it with a no-op
+SPIN_METHOD = "run_spinup"
+# config keys of the spin-up results, blobs in the batch's bucket. a cache hit puts them back there,
+# which only stands in for the spin-up if the transient period reads them instead of state the spin-up
+# leaves on the pipeline. split doesn't set them (see `io.config_paths`), so the cache refuses to run
+# until the configs of a run name them
+SPIN_OUTPUT_KEYS = ["C_stock_spin_out_path"]
+ENTRY_FILE_NAME = "entry.json"
+# keys of the files the spin-up reads besides the spin inputs, they go into the key by content
+SPIN_SOURCE_KEYS = ["path_to_RCTM_params", "C_stock_inits_yaml", "path_to_RCTM_spatial_params"]
+# keys that only say where a batch's files are, they're hashed by content or not at all
+LOCATION_KEYS = set(config_paths("", "")) | set(SPIN_OUTPUT_KEYS) | {"bucket_name"}
+
+
+def rctm_commit(rctm_path: str) -> str:
+    """The commit of the RCTM checkout, None if it isn't a git repository."""
+    try:
+        result = subprocess.run(["git", "-C", rctm_path, "rev-parse", "HEAD"], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return result.stdout.strip()
+
+
+def source_md5(client, bucket_name: str, path: str) -> str:
+    """MD5 of a file a config points at, on this node or in the bucket."""
+    if os.path.exists(path):
+        return file_md5(path)
+
+    blob = client.bucket(bucket_name).blob(path)
+    blob.reload()
+    return blob.md5_hash
+
+
+def spin_cache_problems(pipeline_class, config_paths: list) -> list:
+    """Returns why the spin-up of the batches of `config_paths` can't be cached, nothing if it can."""
+    if not hasattr(pipeline_class, SPIN_METHOD):
+        return [f"the RCTM pipeline has no {SPIN_METHOD} method to skip"]
+
+    problems = []
+    for config_path in config_paths:
+        with open(config_path) as file:
+            config_data = yaml.safe_load(file)
+        missing = [key for key in SPIN_OUTPUT_KEYS if not config_data.get(key)]
+        if missing:
+            problems.append(f"{config_path} doesn't say where the spin-up results go, it has no {', '.join(missing)}")
+
+    return problems
+
+
+class SpinCache:
+    """
+    Spin-up results of earlier batches, stored under the hash of what the spin-up reads:
+    the spin input and spatial parameter tiles, the parameter files, the config values that
+    aren't locations of files and the RCTM commit. `location` is a directory or gs://bucket/prefix.
+    Entries unused for `max_age` seconds, and the least recently used ones beyond
+    `max_bytes`, are evicted by `evict`.
+    """
+
+    def __init__(self, location: str, ignored_keys: list = (), rctm_path: str = None, max_age: float = None, max_bytes: int = None):
+        self.location = location
+        self.ignored_keys = set(ignored_keys)
+        self.commit = rctm_commit(rctm_path) if rctm_path else None
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+
+    def _store(self) -> tuple:
+        """Returns the client, bucket and prefix of the cache."""
+        if self.location.startswith("gs://"):
+            bucket_name, _, prefix = self.location[len("gs://"):].partition("/")
+            return get_storage_client(), bucket_name, prefix.strip("/")
+
+        root = os.path.abspath(self.location)
+        return LocalStorageClient(os.path.dirname(root)), os.path.basename(root), ""
+
+    def _entry_prefix(self, prefix: str, key: str) -> str:
+        return f"{prefix}/{key}" if prefix else key
+
+    def key(self, config_data: dict) -> str:
+        client = get_storage_client()
+        bucket_name = config_data.get("bucket_name")
+        sources = {
+            "spin_input": os.path.join(config_data["RCTM_input_dir"], "RCTM_spin_inputs.nc"),
+        }
+        sources.update((key, config_data[key]) for key in SPIN_SOURCE_KEYS if config_data.get(key))
+        values = {
+            key: value
+            for key, value in config_data.items()
+            if key not in LOCATION_KEYS and key not in self.ignored_keys
+        }
+        description = {
+            "sources": {name: source_md5(client, bucket_name, path) for name, path in sources.items()},
+            "config": values,
+            "rctm": self.commit,
+            "outputs": SPIN_OUTPUT_KEYS,
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+    def restore(self, key: str, config_data: dict) -> bool:
+        """Copy the spin-up results of `key` to where the batch's config says its spin-up writes them. Returns False on a miss."""
+        client, cache_bucket, prefix = self._store()
+        entry_prefix = self._entry_prefix(prefix, key)
+        entry_blob = client.bucket(cache_bucket).blob(f"{entry_prefix}/{ENTRY_FILE_NAME}")
+        try:
+            entry = json.loads(entry_blob.download_as_bytes())
+        except NotFound:
+            return False
+
+        output_bucket = get_storage_client().bucket(config_data["bucket_name"])
+        with tempfile.TemporaryDirectory() as directory:
+            try:
+                for output_key in entry["files"]:
+                    local_path = os.path.join(directory, output_key)
+                    client.bucket(cache_bucket).blob(f"{entry_prefix}/files/{output_key}").download_to_filename(local_path)
+                    output_bucket.blob(config_data[output_key]).upload_from_filename(local_path)
+            except NotFound:
+                # evicted while it was read
+                return False
+
+        entry["last_used"] = time.time()
+        entry_blob.upload_from_string(json.dumps(entry))
+        return True
+
+    def save(self, key: str, config_data: dict) -> int:
+        """
+        Copy the spin-up results a batch wrote into the cache under `key`.
+        Returns the number of files, 0 if the batch didn't write all of them.
+        """
+        output_bucket = get_storage_client().bucket(config_data["bucket_name"])
+        client, cache_bucket, prefix = self._store()
+        entry_prefix = self._entry_prefix(prefix, key)
+        size = 0
+        with tempfile.TemporaryDirectory() as directory:
+            for output_key in SPIN_OUTPUT_KEYS:
+                local_path = os.path.join(directory, output_key)
+                try:
+                    output_bucket.blob(config_data[output_key]).download_to_filename(local_path)
+                except NotFound:
+                    return 0
+                client.bucket(cache_bucket).blob(f"{entry_prefix}/files/{output_key}").upload_from_filename(local_path)
+                size += os.path.getsize(local_path)
+
+        # written last, an entry without it is incomplete and never read
+        now = time.time()
+        entry = {"created": now, "last_used": now, "bytes": size, "files": SPIN_OUTPUT_KEYS}
+        client.bucket(cache_bucket).blob(f"{entry_prefix}/{ENTRY_FILE_NAME}").upload_from_string(json.dumps(entry))
+        return len(SPIN_OUTPUT_KEYS)
+
+    def evict(self) -> int:
+        """Remove the entries older than `max_age` and the least recently used ones beyond `max_bytes`. Returns how many."""
+        client, cache_bucket, prefix = self._store()
+        bucket = client.bucket(cache_bucket)
+        match_glob = f"{self._entry_prefix(prefix, '*')}/{ENTRY_FILE_NAME}"
+        entries = []
+        for blob_name in list_blob_checksums(client, cache_bucket, prefix, match_glob):
+            try:
+                entry = json.loads(bucket.blob(blob_name).download_as_bytes())
+            except NotFound:
+                continue
+            entries.append((entry["last_used"], entry["bytes"], blob_name.rsplit("/", 1)[0], entry["files"]))
+
+        now = time.time()
+        total = sum(size for _, size, _, _ in entries)
+        evicted = 0
+        for last_used, size, entry_prefix, files in sorted(entries):
+            expired = self.max_age is not None and now - last_used > self.max_age
+            oversized = self.max_bytes is not None and total > self.max_bytes
+            if not expired and not oversized:
+                continue
+            # the entry file goes first, so nobody starts reading what is being removed
+            for blob_name in [f"{entry_prefix}/{ENTRY_FILE_NAME}"] + [f"{entry_prefix}/files/{path}" for path in files]:
+                try:
+                    bucket.blob(blob_name).delete()
+                except NotFound:
+                    pass
+            total -= size
+            evicted += 1
+
+        return evicted
+
+    def run(self, pipeline, config_path: str) -> None:
+        """Run the pipeline of a batch, with the spin-up results of the cache if it has them."""
+        if not hasattr(pipeline, SPIN_METHOD):
+            raise RuntimeError(f"the RCTM pipeline has no {SPIN_METHOD}, run {config_path} without --spin-cache")
+
+        with open(config_path) as file:
+            config_data = yaml.safe_load(file)
+        missing = [key for key in SPIN_OUTPUT_KEYS if not config_data.get(key)]
+        if missing:
+            raise KeyError(f"{config_path} has no {', '.join(missing)}, the spin-up results can't be cached")
+
+        # the cache only saves time, trouble reaching it or the bucket mustn't fail the batch
+        try:
+            key = self.key(config_data)
+            restored = self.restore(key, config_data)
+        except Exception as e:
+            print(f"couldn't look up the spin-up results of {config_path}, running the spin-up: {e}")
+            pipeline.run_RCTM()
+            return
+
+        if restored:
+            print(f"reusing the spin-up results {key[:12]} for {config_path}")
+            setattr(pipeline, SPIN_METHOD, lambda *args, **kwargs: None)
+            pipeline.run_RCTM()
+            return
+
+        pipeline.run_RCTM()
+        try:
+            saved = self.save(key, config_data)
+        except Exception as e:
+            print(f"couldn't cache the spin-up results of {config_path}: {e}")
+            return
+        if not saved:
+            print(f"{config_path} didn't write all of {', '.join(SPIN_OUTPUT_KEYS)}, nothing to cache")
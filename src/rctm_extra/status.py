@@ -0,0 +1,76 @@
+import os
+import sqlite3
+import time
+
+STATUS_DB_NAME = "rctm_extra_status.db"
+
+# batch states kept in the store
+SUBMITTED = "submitted"
+RUNNING = "running"
+FAILED = "failed"
+DONE = "done"
+
+
+class StatusStore:
+    """
+    Keeps the SLURM job ID, state and attempt count of every batch
+    in an SQLite file under the local batch directory.
+    """
+
+    def __init__(self, work_directory: str):
+        self.path = os.path.join(work_directory, STATUS_DB_NAME)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS batches (
+                name TEXT PRIMARY KEY,
+                job_id TEXT,
+                state TEXT NOT NULL,
+                slurm_state TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL
+            )"""
+        )
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def record_submission(self, job_ids: dict) -> None:
+        """Record a new attempt for each `batch name -> job ID` pair."""
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                """INSERT INTO batches (name, job_id, state, slurm_state, attempts, updated_at)
+                VALUES (?, ?, ?, NULL, 1, ?)
+                ON CONFLICT(name) DO UPDATE SET
+                    job_id = excluded.job_id,
+                    state = excluded.state,
+                    slurm_state = NULL,
+                    attempts = attempts + 1,
+                    updated_at = excluded.updated_at""",
+                [(name, job_id, SUBMITTED, now) for name, job_id in job_ids.items()],
+            )
+
+    def update_states(self, states: dict) -> None:
+        """Set `batch name -> (state, slurm state)`."""
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE batches SET state = ?, slurm_state = ?, updated_at = ? WHERE name = ?",
+                [(state, slurm_state, now, name) for name, (state, slurm_state) in states.items()],
+            )
+
+    def batches(self) -> list:
+        """Returns `(name, job_id, state, slurm_state, attempts)` rows ordered by name."""
+        return self.connection.execute(
+            "SELECT name, job_id, state, slurm_state, attempts FROM batches ORDER BY name"
+        ).fetchall()
+
+    def summary(self) -> dict:
+        return dict(self.connection.execute("SELECT state, COUNT(*) FROM batches GROUP BY state").fetchall())
@@ -0,0 +1,79 @@
+import numpy as np
+
+
+class ValidCellGrid:
+    """
+    Valid cell counts of the input grid, aggregated into `align` x `align` blocks.
+    Tile edges produced from it always fall on block boundaries, which keeps the
+    count queries cheap even for continental grids.
+    """
+
+    def __init__(self, counts: np.ndarray, align: int, x_dim: int, y_dim: int):
+        self.counts = counts
+        self.align = align
+        self.x_dim = x_dim
+        self.y_dim = y_dim
+        self._sat = np.zeros((counts.shape[0] + 1, counts.shape[1] + 1), dtype=np.int64)
+        self._sat[1:, 1:] = counts.cumsum(axis=0).cumsum(axis=1)
+
+    def _block_count(self, bx0, bx1, by0, by1) -> int:
+        sat = self._sat
+        return int(sat[by1, bx1] - sat[by0, bx1] - sat[by1, bx0] + sat[by0, bx0])
+
+    def count(self, x_range: tuple, y_range: tuple) -> int:
+        """Valid cells inside a window whose edges are multiples of `align` or the grid edge."""
+        bx0, by0 = x_range[0] // self.align, y_range[0] // self.align
+        bx1, by1 = -(-x_range[1] // self.align), -(-y_range[1] // self.align)
+        return self._block_count(bx0, bx1, by0, by1)
+
+    def _to_window(self, bx0, bx1, by0, by1):
+        return (
+            (int(bx0) * self.align, min(int(bx1) * self.align, self.x_dim)),
+            (int(by0) * self.align, min(int(by1) * self.align, self.y_dim)),
+        )
+
+    def _trim(self, bx0, bx1, by0, by1):
+        """Shrink a block region to the bounding box of its non-empty blocks."""
+        region = self.counts[by0:by1, bx0:bx1]
+        rows = np.flatnonzero(region.sum(axis=1))
+        cols = np.flatnonzero(region.sum(axis=0))
+        return bx0 + cols[0], bx0 + cols[-1] + 1, by0 + rows[0], by0 + rows[-1] + 1
+
+    def balanced_windows(self, target_cells: int, max_size: int = None) -> list:
+        """
+        Recursively bisect the grid until every tile holds at most `target_cells` valid cells
+        and is at most `max_size` cells wide and high (or is a single block), skipping empty regions.
+        Every cut is placed where it splits the valid cells of a region in half, along its longer side.
+        Returns `(x_range, y_range, valid_cells)` tuples.
+        """
+        windows = []
+        stack = [(0, self.counts.shape[1], 0, self.counts.shape[0])]
+        while stack:
+            bx0, bx1, by0, by1 = stack.pop()
+            cells = self._block_count(bx0, bx1, by0, by1)
+            if cells == 0:
+                continue
+
+            bx0, bx1, by0, by1 = self._trim(bx0, bx1, by0, by1)
+            x_range, y_range = self._to_window(bx0, bx1, by0, by1)
+            too_large = max_size is not None and max(x_range[1] - x_range[0], y_range[1] - y_range[0]) > max_size
+            single_block = bx1 - bx0 == 1 and by1 - by0 == 1
+            if single_block or (cells <= target_cells and not too_large):
+                windows.append((x_range, y_range, cells))
+                continue
+
+            region = self.counts[by0:by1, bx0:bx1]
+            split_x = bx1 - bx0 > 1 and (by1 - by0 == 1 or bx1 - bx0 >= by1 - by0)
+            profile = region.sum(axis=0 if split_x else 1).cumsum()
+            # first cut position that leaves at least half of the cells on the low side,
+            # kept away from the edges so both halves are non-empty in extent
+            cut = int(np.searchsorted(profile, cells / 2)) + 1
+            cut = min(max(cut, 1), len(profile) - 1)
+            if split_x:
+                stack.append((bx0, bx0 + cut, by0, by1))
+                stack.append((bx0 + cut, bx1, by0, by1))
+            else:
+                stack.append((bx0, bx1, by0, by0 + cut))
+                stack.append((bx0, bx1, by0 + cut, by1))
+
+        return sorted(windows)
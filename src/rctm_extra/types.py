@@ -1,4 +1,5 @@
 import os
+import re
 from dataclasses import dataclass
 
 from rctm_extra.config import X_STEP, Y_STEP
@@ -16,41 +17,76 @@ class Batch:
     spatial_params_path: str
     config_path: str
     slurm_script_path: str
+    valid_cells: int = None
+    window_path: str = None
+
+    def tile_paths(self) -> dict:
+        return {
+            "input": self.input_path,
+            "spin_input": self.spin_input_path,
+            "params": self.spatial_params_path,
+        }
+
+    @staticmethod
+    def parse_name(batch_name: str):
+        """Returns the `(x_range, y_range)` encoded in a batch name, or None if it isn't one."""
+        match = re.fullmatch(r"batch_x_(\d+)-(\d+)_y_(\d+)-(\d+)", batch_name)
+        if match is None:
+            return None
+
+        x_start, x_end, y_start, y_end = map(int, match.groups())
+        return (x_start, x_end), (y_start, y_end)
+
+    @staticmethod
+    def from_window(x_range: tuple, y_range: tuple, local_base_dir: str, valid_cells: int = None) -> "Batch":
+        batch_name = f"batch_x_{x_range[0]}-{x_range[1]}_y_{y_range[0]}-{y_range[1]}"
+        return Batch(
+            name=batch_name,
+            x_range=tuple(x_range),
+            y_range=tuple(y_range),
+            local_base_directory=local_base_dir,
+            local_batch_path=os.path.join(
+                local_base_dir, batch_name
+            ),
+            input_path=os.path.join(
+                local_base_dir, batch_name, "RCTM_ins", "RCTM_inputs.nc"
+            ),
+            spin_input_path=os.path.join(
+                local_base_dir, batch_name, "RCTM_ins", "RCTM_spin_inputs.nc"
+            ),
+            spatial_params_path=os.path.join(
+                local_base_dir, batch_name, "params", "spatial_params.tif"
+            ),
+            config_path=os.path.join(
+                local_base_dir, batch_name, "config.yaml"
+            ),
+            slurm_script_path=os.path.join(
+                local_base_dir, batch_name, "slurm_runner.sh"
+            ),
+            valid_cells=valid_cells,
+            window_path=os.path.join(
+                local_base_dir, batch_name, "window.yaml"
+            ),
+        )
 
     @staticmethod
     def create_list(x_dim: int, y_dim: int, local_base_dir: str) -> list:
         batch_objs = []
         for x in range(0, x_dim, X_STEP):
             for y in range(0, y_dim, Y_STEP):
-                x_start = x
-                x_end = min(x + X_STEP, x_dim)
-                y_start = y
-                y_end = min(y + Y_STEP, y_dim)
-                batch_name = f"batch_x_{x_start}-{x_end}_y_{y_start}-{y_end}"
-                obj = Batch(
-                    name=batch_name,
-                    x_range=(x_start, x_end),
-                    y_range=(y_start, y_end),
-                    local_base_directory=local_base_dir,
-                    local_batch_path=os.path.join(
-                        local_base_dir, batch_name
-                    ),
-                    input_path=os.path.join(
-                        local_base_dir, batch_name, "RCTM_ins", "RCTM_inputs.nc"
-                    ),
-                    spin_input_path=os.path.join(
-                        local_base_dir, batch_name, "RCTM_ins", "RCTM_spin_inputs.nc"
-                    ),
-                    spatial_params_path=os.path.join(
-                        local_base_dir, batch_name, "params", "spatial_params.tif"
-                    ),
-                    config_path=os.path.join(
-                        local_base_dir, batch_name, "config.yaml"
-                    ),
-                    slurm_script_path=os.path.join(
-                        local_base_dir, batch_name, "slurm_runner.sh"
-                    )
-                )
-                batch_objs.append(obj)
+                x_range = (x, min(x + X_STEP, x_dim))
+                y_range = (y, min(y + Y_STEP, y_dim))
+                batch_objs.append(Batch.from_window(x_range, y_range, local_base_dir))
 
         return batch_objs
+
+    @staticmethod
+    def create_adaptive_list(grid, local_base_dir: str, target_cells: int, max_size: int = None) -> list:
+        """
+        Tile the valid cells of a `ValidCellGrid` into batches of roughly `target_cells` valid cells each.
+        Empty regions get no batch.
+        """
+        return [
+            Batch.from_window(x_range, y_range, local_base_dir, valid_cells)
+            for x_range, y_range, valid_cells in grid.balanced_windows(target_cells, max_size)
+        ]
@@ -1,10 +1,19 @@
-def get_batch_dirs(file_list, prefix):
-    batch_dirs = []
-    for file in file_list:
-        file = file.replace(f"{prefix}/", "")
-        files = file.split("/")
-        batch_dir = files[0]
-        batch_dirs.append(batch_dir)
+import concurrent.futures
 
-    batch_dirs = set(batch_dirs)
-    return batch_dirs
+
+def bounded_submit(executor, func, items, max_in_flight: int):
+    """
+    Submit `func(item)` for every item while keeping at most `max_in_flight` of them pending,
+    so the results waiting to be consumed never pile up in memory.
+    Yields `(item, future)` pairs as they complete.
+    """
+    pending = {}
+    for item in items:
+        pending[executor.submit(func, item)] = item
+        if len(pending) >= max_in_flight:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future
+
+    for future in concurrent.futures.as_completed(pending):
+        yield pending[future], future
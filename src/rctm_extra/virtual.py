@@ -0,0 +1,111 @@
+import os
+import tempfile
+
+import yaml
+
+# rctm_extra run imports this module for every job, the raster and storage libraries
+# are only imported by the functions that need them
+
+WINDOW_FILE_NAME = "window.yaml"
+# directory of the chunked master files, next to the batch directories
+MASTER_DIR = "master"
+
+# master file names, by tile kind
+MASTER_FILES = {
+    "input": "RCTM_inputs.nc",
+    "spin_input": "RCTM_spin_inputs.nc",
+    "params": "spatial_params.tif",
+}
+
+
+def create_master_files(path_to_input: str, path_to_spin_input: str, path_to_params: str, master_directory: str, profile: "EncodingProfile" = None) -> dict:
+    """
+    Convert the input files into masters that jobs can read a window of without fetching the rest:
+    chunked NetCDF files and a Cloud Optimized GeoTIFF.
+    Returns the path of each master file by tile kind.
+    """
+    import rasterio.shutil
+
+    from rctm_extra.encoding import EncodingProfile
+    from rctm_extra.spatial import rechunk_netcdf
+
+    profile = profile or EncodingProfile()
+    os.makedirs(master_directory, exist_ok=True)
+    paths = {kind: os.path.join(master_directory, file_name) for kind, file_name in MASTER_FILES.items()}
+
+    rechunk_netcdf(path_to_input, paths["input"], profile.spatial_chunk, profile)
+    rechunk_netcdf(path_to_spin_input, paths["spin_input"], profile.spatial_chunk, profile)
+    rasterio.shutil.copy(
+        path_to_params,
+        paths["params"],
+        driver="COG",
+        COMPRESS=profile.raster_compression.upper(),
+        BLOCKSIZE=profile.raster_block_size,
+        BIGTIFF="IF_SAFER",
+    )
+
+    return paths
+
+
+def window_file_path(config_path: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(config_path)), WINDOW_FILE_NAME)
+
+
+def scratch_directory(batch_name: str) -> str:
+    # TMPDIR usually points at node-local disk on the cluster
+    return os.path.join(tempfile.gettempdir(), "rctm_extra", batch_name)
+
+
+def materialize_window(config_path: str) -> str:
+    """
+    Read the window of a batch from the master files in the bucket into a scratch directory
+    and write a copy of its config that points at them. Returns the path of that config.
+    """
+    import rasterio
+    import rioxarray
+    import xarray as xr
+
+    from rctm_extra.gcp import get_storage_client, open_blob
+
+    with open(window_file_path(config_path)) as file:
+        window = yaml.safe_load(file)
+    with open(config_path) as file:
+        config_data = yaml.safe_load(file)
+
+    bucket_name = window["bucket_name"]
+    sources = window["sources"]
+    x_slice = slice(*window["x_range"])
+    y_slice = slice(*window["y_range"])
+    scratch = scratch_directory(window["batch"])
+    input_directory = os.path.join(scratch, "RCTM_ins")
+    params_path = os.path.join(scratch, "params", "spatial_params.tif")
+    os.makedirs(input_directory, exist_ok=True)
+    os.makedirs(os.path.dirname(params_path), exist_ok=True)
+
+    client = get_storage_client()
+    for kind in ("input", "spin_input"):
+        with open_blob(client, bucket_name, sources[kind]) as file, xr.open_dataset(file, engine="h5netcdf") as ds:
+            subset = ds.isel(x=x_slice, y=y_slice).load()
+        for var in subset.variables.values():
+            # the master's chunking doesn't fit the window
+            var.encoding.pop("chunksizes", None)
+        subset.to_netcdf(os.path.join(input_directory, MASTER_FILES[kind]))
+
+    def opener(path, mode="rb"):
+        return open_blob(client, bucket_name, path)
+
+    # the opener streams the blocks of the window, GDAL shouldn't look for sidecar files next to the blob
+    with rasterio.Env(GDAL_DISABLE_READDIR_ON_OPEN="EMPTY_DIR"):
+        with rioxarray.open_rasterio(sources["params"], opener=opener) as da:
+            subset = da.isel(x=x_slice, y=y_slice).load()
+    subset.rio.to_raster(params_path)
+
+    config_data["RCTM_input_dir"] = input_directory
+    config_data["transient_covariate_path"] = os.path.join(input_directory, MASTER_FILES["input"])
+    config_data["spatial_param_outname"] = params_path
+    config_data["path_to_RCTM_spatial_params"] = params_path
+    local_config_path = os.path.join(scratch, "config.yaml")
+    with open(local_config_path, "w") as file:
+        yaml.dump(config_data, file)
+
+    return local_config_path
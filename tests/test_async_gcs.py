@@ -0,0 +1,195 @@
+import asyncio
+import base64
+import hashlib
+import os
+import threading
+
+import pytest
+from aiohttp import web
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import storage
+
+from rctm_extra import async_gcs
+from rctm_extra.async_gcs import AsyncStorage
+from rctm_extra.gcp import TransferManager
+from rctm_extra.local_storage import LocalStorageClient
+from rctm_extra.manifest import file_md5
+
+
+class FakeStorageAPI:
+    """
+    The parts of the GCS JSON API `AsyncStorage` uses, serving the buckets of a `LocalStorageClient`.
+    `faults` are `(status, headers)` answered to the next requests instead of the real response.
+    """
+
+    def __init__(self, root: str):
+        self.client = LocalStorageClient(root)
+        self.faults = []
+        self.bad_md5 = set()
+        self.requests = []
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 ** 2, middlewares=[self.inject_faults])
+        app.router.add_get("/storage/v1/b/{bucket}/o", self.list_objects)
+        app.router.add_get("/storage/v1/b/{bucket}/o/{name:.+}", self.download)
+        app.router.add_post("/upload/storage/v1/b/{bucket}/o", self.upload)
+        return app
+
+    @web.middleware
+    async def inject_faults(self, request, handler):
+        self.requests.append((request.method, request.path, dict(request.query)))
+        if self.faults:
+            status, headers = self.faults.pop(0)
+            return web.Response(status=status, headers=headers, text="try again")
+        return await handler(request)
+
+    async def download(self, request):
+        name = request.match_info["name"]
+        blob = self.client.bucket(request.match_info["bucket"]).blob(name)
+        if not blob.exists():
+            return web.Response(status=404, text=f"No such object: {name}")
+        with open(blob.path, "rb") as file:
+            data = file.read()
+        md5 = hashlib.md5(b"not the content" if name in self.bad_md5 else data).digest()
+        return web.Response(body=data, headers={"x-goog-hash": f"crc32c=AAAAAA==,md5={base64.b64encode(md5).decode()}"})
+
+    async def upload(self, request):
+        name = request.query["name"]
+        path = os.path.join(self.client.bucket(request.match_info["bucket"]).path, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+            file.write(await request.read())
+        return web.json_response({"name": name, "md5Hash": file_md5(path)})
+
+    async def list_objects(self, request):
+        query = request.query
+        blobs = self.client.list_blobs(
+            request.match_info["bucket"], prefix=query.get("prefix"), delimiter=query.get("delimiter"), match_glob=query.get("matchGlob"),
+        )
+        entries = [("item", blob.name, blob.md5_hash) for blob in blobs]
+        entries += [("prefix", prefix, None) for prefix in blobs.prefixes]
+        entries.sort(key=lambda entry: entry[1])
+
+        start = int(query.get("pageToken", 0))
+        end = start + int(query["maxResults"])
+        page = {
+            "items": [{"name": name, "md5Hash": md5} for kind, name, md5 in entries[start:end] if kind == "item"],
+            "prefixes": [name for kind, name, _ in entries[start:end] if kind == "prefix"],
+        }
+        if end < len(entries):
+            page["nextPageToken"] = str(end)
+        return web.json_response(page)
+
+
+@pytest.fixture
+def fake_api(tmp_path):
+    fake = FakeStorageAPI(str(tmp_path / "buckets"))
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(fake.app())
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", 0).start())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    host, port = runner.addresses[0][:2]
+    client = storage.Client(project="test", credentials=AnonymousCredentials(), client_options={"api_endpoint": f"http://{host}:{port}"})
+    yield fake, client
+
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+class Progress:
+    def __init__(self):
+        self.retries = {}
+        self.errors = {}
+
+    def advance(self, name, seconds=None, nbytes=None, retries=0, error=None):
+        if error is not None:
+            self.errors[name] = error
+        else:
+            self.retries[name] = retries
+
+
+def write(path, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as file:
+        file.write(data)
+
+
+def test_uploads_and_downloads_round_trip(tmp_path, fake_api):
+    fake, client = fake_api
+    files = {f"run/batch_{i}/config.yaml": os.urandom(1000 + i) for i in range(5)}
+    for name, data in files.items():
+        write(str(tmp_path / "split" / name), data)
+    async_storage = AsyncStorage(client, "bucket", concurrency=3)
+
+    assert async_storage.upload_files([(str(tmp_path / "split" / name), name) for name in files]) == []
+    tasks = [(name, str(tmp_path / "downloaded" / name)) for name in files]
+    for _, destination in tasks:
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+    assert async_storage.download_files(tasks) == []
+
+    for name, data in files.items():
+        with open(tmp_path / "downloaded" / name, "rb") as file:
+            assert file.read() == data
+
+
+def test_listings_page_through_every_blob(tmp_path, fake_api, monkeypatch):
+    fake, client = fake_api
+    monkeypatch.setattr(async_gcs, "LIST_PAGE_SIZE", 2)
+    names = [f"run/batch_{i}/{file_name}" for i in range(3) for file_name in ("config.yaml", "RCTM_ins/RCTM_inputs.nc")]
+    for name in names:
+        write(str(tmp_path / "buckets" / "bucket" / name), name.encode())
+    async_storage = AsyncStorage(client, "bucket", concurrency=2)
+
+    checksums = async_storage.list_checksums("run/")
+    assert checksums == {name: file_md5(str(tmp_path / "buckets" / "bucket" / name)) for name in names}
+    # more than a page, so the listing was split into the batch directories
+    assert any(query.get("delimiter") == "/" for _, _, query in fake.requests)
+
+    configs = async_storage.list_checksums("run/", "run/*/config.yaml")
+    assert sorted(configs) == [name for name in names if name.endswith("config.yaml")]
+
+
+def test_throttled_requests_back_off(tmp_path, fake_api, monkeypatch):
+    fake, client = fake_api
+    backoffs = []
+    monkeypatch.setattr(async_gcs, "backoff", lambda retry: backoffs.append(retry) or 0)
+    write(str(tmp_path / "buckets" / "bucket" / "run/config.yaml"), b"config")
+    fake.faults = [(429, {"Retry-After": "0"}), (503, {})]
+    progress = Progress()
+
+    failures = AsyncStorage(client, "bucket", concurrency=1).download_files([("run/config.yaml", str(tmp_path / "config.yaml"))], progress)
+
+    assert failures == []
+    assert progress.retries == {"run/config.yaml": 2}
+    # the 429 said how long to wait, only the 503 falls back to the exponential backoff
+    assert backoffs == [1]
+
+
+def test_a_checksum_mismatch_is_a_failure(tmp_path, fake_api):
+    fake, client = fake_api
+    write(str(tmp_path / "buckets" / "bucket" / "run/config.yaml"), b"config")
+    fake.bad_md5.add("run/config.yaml")
+
+    failures = AsyncStorage(client, "bucket", concurrency=1).download_files([("run/config.yaml", str(tmp_path / "config.yaml"))])
+
+    assert [(name, type(error)) for name, error in failures] == [("run/config.yaml", ValueError)]
+
+
+def test_large_objects_go_through_the_transfer_manager(tmp_path, fake_api):
+    fake, client = fake_api
+    data = os.urandom(async_gcs.MAX_OBJECT_SIZE + 1)
+    write(str(tmp_path / "split" / "inputs.nc"), data)
+    # the transfer manager reads and writes the same bucket as the fake API
+    transfer_manager = TransferManager(fake.client, "bucket", workers=2)
+    async_storage = AsyncStorage(client, "bucket", concurrency=2, transfer_manager=transfer_manager)
+
+    assert async_storage.upload_files([(str(tmp_path / "split" / "inputs.nc"), "run/inputs.nc")]) == []
+    assert not [request for request in fake.requests if request[0] == "POST"]
+    assert async_storage.download_files([("run/inputs.nc", str(tmp_path / "inputs.nc"))]) == []
+
+    with open(tmp_path / "inputs.nc", "rb") as file:
+        assert file.read() == data
@@ -0,0 +1,27 @@
+from rctm_extra.bench import _parse_importtime, compare_results
+
+
+def test_compare_results_only_lists_measurements_both_runs_have():
+    current = {"stages": {
+        "split": {"wall_time": 3.0, "peak_rss": 200, "bytes_written": None},
+        "merge": {"wall_time": 1.0, "peak_rss": None, "bytes_written": None},
+    }}
+    baseline = {"stages": {"split": {"wall_time": 2.0, "peak_rss": 0, "bytes_written": 10}}}
+
+    assert compare_results(current, baseline) == [
+        ("split", "wall_time", 2.0, 3.0, 1.5),
+        ("split", "peak_rss", 0, 200, None),
+    ]
+
+
+def test_parse_importtime_keeps_top_level_imports():
+    output = "\n".join([
+        "import time: self [us] | cumulative | imported package",
+        "import time:       120 |        120 |   _io",
+        "import time:       300 |       1500 | rctm_extra",
+        "import time:       200 |        900 |   rctm_extra.config",
+        "import time:      4000 |      25000 | xarray",
+        "some other warning",
+    ])
+
+    assert _parse_importtime(output) == {"rctm_extra": 0.0015, "xarray": 0.025}
@@ -0,0 +1,78 @@
+import fcntl
+import os
+import shutil
+
+import yaml
+
+from rctm_extra import cache
+from rctm_extra.cache import NodeCache, cached_config
+
+
+def make_template(tmp_path, name="RCTM_params.yaml", content="a: 1\n"):
+    path = tmp_path / "shared" / name
+    path.parent.mkdir(exist_ok=True)
+    path.write_text(content)
+    return str(path)
+
+
+def test_use_returns_copies_under_the_cache(tmp_path):
+    template = make_template(tmp_path)
+    node_cache = NodeCache(str(tmp_path / "cache"))
+
+    with node_cache.use([template]) as cached:
+        assert cached[template].startswith(str(tmp_path / "cache"))
+        with open(cached[template]) as file:
+            assert file.read() == "a: 1\n"
+
+
+def test_a_changed_file_gets_a_new_entry(tmp_path):
+    template = make_template(tmp_path)
+    node_cache = NodeCache(str(tmp_path / "cache"))
+    with node_cache.use([template]) as cached:
+        first = cached[template]
+
+    make_template(tmp_path, content="a: 2\n")
+    with node_cache.use([template]) as cached:
+        assert cached[template] != first
+
+
+def test_evict_keeps_the_cache_under_its_size(tmp_path):
+    node_cache = NodeCache(str(tmp_path / "cache"), max_bytes=150)
+    for i in range(3):
+        with node_cache.use([make_template(tmp_path, f"t{i}.yaml", "x" * 100)]):
+            pass
+
+    entries = os.listdir(tmp_path / "cache" / "objects")
+    assert len([name for name in entries if "." not in name]) == 1
+
+
+def test_an_entry_evicted_while_the_lock_is_downgraded_is_staged_again(tmp_path, monkeypatch):
+    template = make_template(tmp_path)
+    node_cache = NodeCache(str(tmp_path / "cache"))
+    flock = fcntl.flock
+    evicted = []
+
+    def racing_flock(file, operation):
+        # another job evicts the entry between the exclusive and the shared lock, once
+        if operation == fcntl.LOCK_SH and not evicted:
+            evicted.append(file.name)
+            shutil.rmtree(file.name[:-len(".lock")])
+        flock(file, operation)
+
+    monkeypatch.setattr(cache.fcntl, "flock", racing_flock)
+    with node_cache.use([template]) as cached:
+        assert evicted
+        assert os.path.exists(cached[template])
+
+
+def test_cached_config_points_shared_keys_at_the_cache(tmp_path):
+    template = make_template(tmp_path)
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text(yaml.dump({"path_to_RCTM_params": template, "bucket_name": "bucket"}))
+
+    with cached_config(str(config_path), NodeCache(str(tmp_path / "cache")), str(tmp_path / "job")) as local_config_path:
+        with open(local_config_path) as file:
+            config = yaml.safe_load(file)
+
+    assert config["bucket_name"] == "bucket"
+    assert config["path_to_RCTM_params"].startswith(str(tmp_path / "cache"))
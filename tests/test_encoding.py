@@ -0,0 +1,18 @@
+import numpy as np
+import xarray as xr
+
+from rctm_extra.encoding import is_float32_safe
+
+
+def test_values_float32_holds_exactly_are_safe():
+    assert is_float32_safe(xr.DataArray([0.5, -2.0, 1024.25, np.nan]))
+
+
+def test_a_value_float32_rounds_is_not_safe():
+    # 987654321.123 comes back from float32 as 987654336.0
+    assert not is_float32_safe(xr.DataArray([1.0000001234567, 987654321.123]))
+    assert not is_float32_safe(xr.DataArray([0.1]))
+
+
+def test_only_float64_is_converted():
+    assert not is_float32_safe(xr.DataArray(np.array([1, 2], dtype=np.int64)))
@@ -0,0 +1,85 @@
+import json
+import os
+
+import pytest
+
+from rctm_extra.gcp import TransferManager, list_batch_files, list_blob_checksums
+from rctm_extra.local_storage import LocalStorageClient
+from rctm_extra.manifest import file_md5
+
+
+def write(path, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as file:
+        file.write(data)
+
+
+def test_round_trip_through_a_local_bucket(tmp_path):
+    source = tmp_path / "split"
+    files = {
+        "batch_x_0-100_y_0-100/config.yaml": b"config a",
+        "batch_x_0-100_y_0-100/slurm_runner.sh": b"runner a",
+        "batch_x_0-100_y_0-100/RCTM_ins/RCTM_inputs.nc": os.urandom(10_000),
+        "batch_x_100-200_y_0-100/config.yaml": b"config b",
+    }
+    for relative_path, data in files.items():
+        write(str(source / relative_path), data)
+
+    client = LocalStorageClient(str(tmp_path / "buckets"))
+    # slices smaller than the tile, so the large download goes through the sliced path
+    manager = TransferManager(client, "bucket", workers=4, slice_size=1024)
+    assert manager.upload_directory(str(source), str(source), "run") == []
+
+    checksums = list_blob_checksums(client, "bucket", "run")
+    assert checksums == {f"run/{path}": file_md5(str(source / path)) for path in files}
+    assert list_batch_files(client, "bucket", "run", ["config.yaml", "slurm_runner.sh"]) == {
+        "batch_x_0-100_y_0-100": {
+            "config.yaml": checksums["run/batch_x_0-100_y_0-100/config.yaml"],
+            "slurm_runner.sh": checksums["run/batch_x_0-100_y_0-100/slurm_runner.sh"],
+        },
+        "batch_x_100-200_y_0-100": {"config.yaml": checksums["run/batch_x_100-200_y_0-100/config.yaml"]},
+    }
+
+    destination = tmp_path / "downloaded"
+    tasks = [(f"run/{path}", str(destination / path.replace("/", "_"))) for path in files]
+    os.makedirs(destination)
+    assert manager.download_files(tasks) == []
+    for (_, local_path), data in zip(tasks, files.values()):
+        with open(local_path, "rb") as file:
+            assert file.read() == data
+    # the slice state of the resumable download is gone once it completed
+    assert not [name for name in os.listdir(destination) if ".part" in name]
+
+
+def test_failed_transfers_are_reported(tmp_path):
+    client = LocalStorageClient(str(tmp_path / "buckets"))
+    manager = TransferManager(client, "bucket", workers=2, retries=1)
+
+    failures = manager.download_files([("run/missing.nc", str(tmp_path / "missing.nc"))])
+
+    assert [blob_name for blob_name, _ in failures] == ["run/missing.nc"]
+
+
+def test_a_resumed_download_with_a_corrupt_slice_starts_over(tmp_path):
+    data = os.urandom(4096)
+    write(str(tmp_path / "buckets" / "bucket" / "run" / "inputs.nc"), data)
+    client = LocalStorageClient(str(tmp_path / "buckets"))
+    manager = TransferManager(client, "bucket", workers=2, slice_size=1024, retries=1)
+    blob = client.bucket("bucket").blob("run/inputs.nc")
+    blob.reload()
+
+    # an interrupted download whose slices all claim to be done, but one holds the wrong bytes
+    destination = str(tmp_path / "inputs.nc")
+    write(f"{destination}.part", data[:1024] + bytes(1024) + data[2048:])
+    with open(f"{destination}.part.json", "w") as file:
+        json.dump({"generation": blob.generation, "size": blob.size, "slice_size": 1024, "done": [0, 1024, 2048, 3072]}, file)
+
+    with pytest.raises(ValueError):
+        manager.download("run/inputs.nc", destination)
+    assert not os.path.exists(destination)
+    assert not os.path.exists(f"{destination}.part")
+    assert not os.path.exists(f"{destination}.part.json")
+
+    assert manager.download_files([("run/inputs.nc", destination)]) == []
+    with open(destination, "rb") as file:
+        assert file.read() == data
@@ -0,0 +1,49 @@
+import yaml
+
+from rctm_extra.io import (
+    IGNORED_CONFIG_KEYS,
+    compile_config_template,
+    create_batch_index,
+    load_config_index,
+    render_config,
+    write_config_index,
+)
+
+CONFIG = {
+    "bucket_name": "bucket",
+    "start_date": "2001-01-01",
+    # a `$` in the site config must survive the substitution
+    "note": "costs $5",
+    IGNORED_CONFIG_KEYS[0]: "/geometries",
+}
+
+
+def test_render_config_only_fills_in_the_batch_directory():
+    template = compile_config_template(CONFIG, "sites/a/run", "/home/user/RCTM")
+
+    config = yaml.safe_load(render_config(template, "batch_x_0-100_y_0-100"))
+
+    assert config["bucket_name"] == "bucket"
+    assert config["note"] == "costs $5"
+    assert config["gcloud_workflow_base_dir"] == "sites/a/run/batch_x_0-100_y_0-100"
+    assert config["RCTM_input_dir"] == "sites/a/run/batch_x_0-100_y_0-100/RCTM_ins"
+    assert config["path_to_RCTM_params"] == "/home/user/RCTM/RCTM/templates/RCTM_params.yaml"
+    assert IGNORED_CONFIG_KEYS[0] not in config
+
+
+def test_config_index_round_trip(tmp_path):
+    template = compile_config_template(CONFIG, "sites/a/run", "/home/user/RCTM")
+    index_path = str(tmp_path / "config_index.json")
+
+    write_config_index(template, ["batch_x_100-200_y_0-100", "batch_x_0-100_y_0-100"], index_path)
+    loaded, batch_names = load_config_index(index_path)
+
+    assert batch_names == ["batch_x_0-100_y_0-100", "batch_x_100-200_y_0-100"]
+    assert render_config(loaded, batch_names[0]) == render_config(template, batch_names[0])
+
+
+def test_batch_index_groups_configs_per_task(tmp_path):
+    index_path = tmp_path / "batch_index.txt"
+
+    assert create_batch_index(["a", "b", "c"], str(index_path), batches_per_task=2) == 2
+    assert index_path.read_text() == "a b\nc\n"
@@ -0,0 +1,85 @@
+import os
+
+from rctm_extra.encoding import EncodingProfile
+from rctm_extra.manifest import batch_entries, build_manifest, unchanged_tiles
+from rctm_extra.types import Batch
+
+SOURCE_MD5S = {"input": "in-md5", "spin_input": "spin-md5", "params": "params-md5"}
+
+
+def write_tiles(batch_obj):
+    for path in batch_obj.tile_paths().values():
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as file:
+            file.write(path)
+
+
+def previous_manifest(batch_obj, encoding):
+    write_tiles(batch_obj)
+    return build_manifest([batch_obj], SOURCE_MD5S, {"files": {}}, {}, encoding)
+
+
+def test_tiles_of_the_same_sources_window_and_encoding_are_unchanged(tmp_path):
+    encoding = EncodingProfile().fingerprint()
+    batch_obj = Batch.from_window((0, 100), (0, 100), str(tmp_path))
+    previous = previous_manifest(batch_obj, encoding)
+
+    assert unchanged_tiles(previous, batch_obj, SOURCE_MD5S, encoding) == {"input", "spin_input", "params"}
+
+
+def test_a_changed_source_only_regenerates_its_tiles(tmp_path):
+    encoding = EncodingProfile().fingerprint()
+    batch_obj = Batch.from_window((0, 100), (0, 100), str(tmp_path))
+    previous = previous_manifest(batch_obj, encoding)
+
+    changed = dict(SOURCE_MD5S, spin_input="new-spin-md5")
+
+    assert unchanged_tiles(previous, batch_obj, changed, encoding) == {"input", "params"}
+
+
+def test_a_different_window_regenerates_every_tile(tmp_path):
+    encoding = EncodingProfile().fingerprint()
+    previous = previous_manifest(Batch.from_window((0, 100), (0, 100), str(tmp_path)), encoding)
+    # same name, so the same paths, but another window
+    batch_obj = Batch.from_window((0, 100), (0, 100), str(tmp_path))
+    batch_obj.x_range = (0, 90)
+
+    assert unchanged_tiles(previous, batch_obj, SOURCE_MD5S, encoding) == set()
+
+
+def test_other_encoding_settings_regenerate_every_tile(tmp_path):
+    batch_obj = Batch.from_window((0, 100), (0, 100), str(tmp_path))
+    previous = previous_manifest(batch_obj, EncodingProfile().fingerprint())
+
+    for profile in (EncodingProfile(compression="none"), EncodingProfile(float32=True), EncodingProfile(spatial_chunk=25)):
+        assert unchanged_tiles(previous, batch_obj, SOURCE_MD5S, profile.fingerprint()) == set()
+
+
+def test_entries_without_an_encoding_are_regenerated(tmp_path):
+    batch_obj = Batch.from_window((0, 100), (0, 100), str(tmp_path))
+    previous = previous_manifest(batch_obj, None)
+
+    assert unchanged_tiles(previous, batch_obj, SOURCE_MD5S, EncodingProfile().fingerprint()) == set()
+
+
+def test_skipped_tiles_keep_their_previous_entries(tmp_path):
+    batch_obj = Batch.from_window((0, 100), (0, 100), str(tmp_path))
+    previous = previous_manifest(batch_obj, "old")
+    os.remove(batch_obj.input_path)
+
+    entries = batch_entries(batch_obj, SOURCE_MD5S, previous, {"input"}, "new")
+    relative_path = os.path.relpath(batch_obj.input_path, str(tmp_path))
+
+    assert entries[relative_path] == previous["files"][relative_path]
+    assert {entry["encoding"] for path, entry in entries.items() if path != relative_path} == {"new"}
+
+
+def test_partial_tiles_are_left_out(tmp_path):
+    batch_obj = Batch.from_window((0, 100), (0, 100), str(tmp_path))
+    write_tiles(batch_obj)
+    with open(os.path.join(batch_obj.local_batch_path, "RCTM_ins", "RCTM_inputs.partial.nc"), "w") as file:
+        file.write("half")
+
+    entries = batch_entries(batch_obj, SOURCE_MD5S, {"files": {}})
+
+    assert not any("partial" in path for path in entries)
@@ -0,0 +1,54 @@
+import numpy as np
+import xarray as xr
+
+from rctm_extra.cmd.merge import MergeCommand
+from rctm_extra.encoding import EncodingProfile
+from rctm_extra.spatial import grid_coordinates, grid_description, write_tile
+from rctm_extra.types import Batch
+
+
+def test_grid_description_round_trips_regular_and_irregular_axes(tmp_path):
+    path = str(tmp_path / "master.nc")
+    ds = xr.Dataset(
+        {"tmin": (("y", "x"), np.zeros((3, 4)))},
+        coords={"x": [10.0, 20.0, 30.0, 40.0], "y": [5.0, 4.0, 2.0]},
+    )
+    ds.to_netcdf(path)
+
+    description = grid_description(path)
+    coordinates = grid_coordinates(description)
+
+    assert "values" not in description["x"]
+    assert "values" in description["y"]
+    np.testing.assert_allclose(coordinates["x"], ds["x"])
+    np.testing.assert_allclose(coordinates["y"], ds["y"])
+
+
+def test_merge_spans_the_source_grid_when_an_edge_batch_is_missing(tmp_path):
+    master = xr.Dataset(
+        {"tmin": (("y", "x"), np.arange(24, dtype=np.float64).reshape(4, 6))},
+        coords={"x": np.arange(6) * 30.0, "y": 100 - np.arange(4) * 30.0},
+    )
+    master_path = str(tmp_path / "master.nc")
+    master.to_netcdf(master_path)
+    # only the left batch of the two finished
+    batch = Batch.from_window((0, 3), (0, 4), str(tmp_path))
+    write_tile("input", master.isel(x=slice(0, 3)), batch.input_path, EncodingProfile())
+
+    command = MergeCommand(type("Args", (), {"output_path": str(tmp_path)})())
+    problems = command._merge_file(
+        "RCTM_ins/RCTM_inputs.nc",
+        {batch.name: (batch.x_range, batch.y_range)},
+        str(tmp_path),
+        6,
+        4,
+        1,
+        grid_coordinates(grid_description(master_path)),
+    )
+
+    assert problems == {}
+    with xr.open_dataset(tmp_path / "RCTM_inputs.nc") as merged:
+        assert merged.sizes == {"x": 6, "y": 4}
+        np.testing.assert_allclose(merged["x"], master["x"])
+        np.testing.assert_allclose(merged["y"], master["y"])
+        np.testing.assert_allclose(merged["tmin"][:, :3], master["tmin"][:, :3])
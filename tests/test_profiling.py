@@ -0,0 +1,37 @@
+import json
+
+from rctm_extra.profiling import aggregate_stages, self_seconds
+
+
+def call(stage, depth, seconds, peak_rss=100):
+    return {"stage": stage, "depth": depth, "seconds": seconds, "peak_rss": peak_rss}
+
+
+# run_RCTM calls the spin-up, which calls a step, and then the transient period
+CALLS = [
+    call("step", 2, 1.0),
+    call("run_spinup", 1, 4.0),
+    call("run_transient", 1, 3.0),
+    call("run_RCTM", 0, 8.0, peak_rss=300),
+]
+
+
+def test_self_seconds_leave_out_the_stages_a_call_made():
+    assert self_seconds(CALLS) == [1.0, 3.0, 3.0, 1.0]
+
+
+def test_aggregate_stages_add_up_to_the_outermost_calls(tmp_path):
+    stage_files = []
+    for name in ("batch_0", "batch_1"):
+        path = tmp_path / f"{name}.json"
+        path.write_text(json.dumps({"seconds": 8.5, "stages": CALLS}))
+        stage_files.append(str(path))
+
+    stages, total_seconds = aggregate_stages(stage_files)
+
+    assert total_seconds == 17.0
+    assert sum(stage["seconds"] for stage in stages.values()) == 16.0
+    assert stages["run_RCTM"] == {
+        "batches": 2, "calls": 2, "seconds": 2.0, "cumulative_seconds": 16.0, "max_seconds": 8.0, "max_peak_rss": 300,
+    }
+    assert stages["run_spinup"]["seconds"] == 6.0
@@ -0,0 +1,97 @@
+import pytest
+
+from rctm_extra.resources import (
+    MIN_HISTORY,
+    MIN_MEMORY,
+    MIN_SECONDS,
+    TIME_MARGIN,
+    CostModel,
+    Resources,
+    makespan,
+    pack_batches,
+    read_script_resources,
+    resize_script,
+)
+
+
+def history_record(cell_steps, seconds, max_rss, cpus=1, batches=1, state="COMPLETED"):
+    return {"cell_steps": cell_steps, "seconds": seconds, "max_rss": max_rss, "cpus": cpus, "batches": batches, "state": state}
+
+
+def test_makespan_runs_each_batch_on_the_first_free_worker():
+    assert makespan([700] * 5, 4) == 1400
+    assert makespan([600, 500, 400, 300], 2) == 900
+    assert makespan([300], 8) == 300
+
+
+def test_more_batches_than_cpus_ask_for_the_whole_schedule():
+    requests = {f"batch_{i}": Resources(seconds=700, memory=1024 ** 3) for i in range(5)}
+
+    [(pack, resources)] = pack_batches(requests, cpus=4, max_seconds=4 * 3600)
+
+    assert sorted(pack) == sorted(requests)
+    assert resources.seconds == 1400
+    assert resources.cpus == 4
+    assert resources.memory == 4 * 1024 ** 3
+
+
+def test_packs_fit_in_the_longest_job():
+    requests = {f"batch_{i}": Resources(seconds=seconds, memory=1) for i, seconds in enumerate([3000, 2500, 2000, 1500, 1000, 500, 500])}
+
+    jobs = pack_batches(requests, cpus=2, max_seconds=3600)
+
+    assert sorted(name for pack, _ in jobs for name in pack) == sorted(requests)
+    for pack, resources in jobs:
+        assert resources.seconds <= 3600
+        assert resources.seconds == makespan([requests[name].seconds for name in pack], resources.cpus)
+
+
+def test_a_batch_longer_than_the_limit_gets_its_own_job():
+    requests = {"large": Resources(seconds=5000, memory=1), "small": Resources(seconds=100, memory=1)}
+
+    jobs = pack_batches(requests, cpus=4, max_seconds=3600)
+
+    assert [pack for pack, _ in jobs] == [["large"], ["small"]]
+
+
+def test_cost_model_needs_enough_completed_jobs():
+    history = [history_record(1000, 60, 1024 ** 3)] * (MIN_HISTORY - 1)
+    history.append(history_record(1000, 60, 1024 ** 3, state="TIMEOUT"))
+
+    assert CostModel.fit(history) is None
+
+
+def test_cost_model_fits_a_line_through_the_history():
+    # 100 s plus 1 s per 1000 cell steps, 2 GiB plus 1 MiB per 1000 cell steps
+    history = [
+        history_record(work, 100 + work / 1000, 2 * 1024 ** 3 + work * 1024 ** 2 / 1000)
+        for work in (10_000, 50_000, 100_000, 200_000, 400_000)
+    ]
+
+    model = CostModel.fit(history)
+
+    assert model.runs == 5
+    assert model.time_coefficients == pytest.approx((100, 1 / 1000))
+    resources = model.predict(valid_cells=1000, time_steps=1000)
+    assert resources.seconds == pytest.approx((100 + 1000) * TIME_MARGIN, abs=1)
+    assert model.predict(valid_cells=1, time_steps=1).seconds == MIN_SECONDS
+    assert resources.memory >= MIN_MEMORY
+
+
+def test_packed_jobs_count_as_their_share_of_one_batch():
+    # 4 batches side by side on 4 CPUs, the same work per batch as one batch on one CPU
+    history = [history_record(work * 4, 100 + work / 1000, 1024 ** 3 * 4, cpus=4, batches=4) for work in (1e4, 2e4, 4e4, 8e4, 16e4)]
+
+    model = CostModel.fit(history)
+
+    assert model.time_coefficients == pytest.approx((100, 1 / 1000))
+    assert model.memory_coefficients[0] == pytest.approx(1024 ** 3)
+
+
+def test_script_resources_round_trip(tmp_path):
+    script_path = tmp_path / "slurm_runner.sh"
+    script_path.write_text("# rctm_extra: valid_cells=12 time_steps=34\n" + Resources(600, 1024 ** 3, 2).sbatch_lines() + "\n")
+
+    resize_script(str(script_path), Resources(3600, 2 * 1024 ** 3, 4))
+
+    assert read_script_resources(str(script_path)) == ((12, 34), Resources(3600, 2 * 1024 ** 3, 4))
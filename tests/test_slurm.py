@@ -0,0 +1,15 @@
+from rctm_extra.slurm import _parse_memory, _parse_states
+
+
+def test_parse_states_keeps_the_first_word_of_a_state():
+    output = "101|COMPLETED\n102_3|CANCELLED by 1234\n103|\nnot a state line\n"
+
+    assert _parse_states(output) == {"101": "COMPLETED", "102_3": "CANCELLED", "103": "UNKNOWN"}
+
+
+def test_parse_memory_understands_sacct_units():
+    assert _parse_memory("") == 0
+    assert _parse_memory("512") == 512
+    assert _parse_memory("2K") == 2048
+    assert _parse_memory("1.5M") == 1.5 * 1024 ** 2
+    assert _parse_memory("3G") == 3 * 1024 ** 3
@@ -0,0 +1,83 @@
+import os
+
+import netCDF4
+import numpy as np
+import pytest
+import xarray as xr
+
+from rctm_extra.config import X_STEP, Y_STEP
+from rctm_extra.encoding import EncodingProfile
+from rctm_extra.spatial import block_bytes, plan_blocks, rechunk_netcdf, write_tile
+from rctm_extra.types import Batch
+
+
+def make_dataset(x=4, y=3):
+    return xr.Dataset({"tmin": (("y", "x"), np.arange(x * y, dtype=np.float64).reshape(y, x))})
+
+
+class FailingDataset:
+    """Writes part of a file, then fails like an interrupted `to_netcdf`."""
+
+    nbytes = 0
+    data_vars = {}
+
+    def to_netcdf(self, path, encoding=None):
+        with open(path, "w") as file:
+            file.write("half")
+        raise OSError("disk full")
+
+
+def test_write_tile_leaves_only_the_complete_tile(tmp_path):
+    path = tmp_path / "RCTM_ins" / "RCTM_inputs.nc"
+    raw_size, written_size = write_tile("input", make_dataset(), str(path), EncodingProfile())
+
+    assert os.listdir(path.parent) == ["RCTM_inputs.nc"]
+    assert written_size == os.path.getsize(path)
+    assert raw_size == make_dataset().nbytes
+
+
+def test_failed_write_removes_the_partial_and_the_stale_tile(tmp_path):
+    path = tmp_path / "RCTM_inputs.nc"
+    path.write_text("tile of the previous run")
+
+    with pytest.raises(OSError):
+        write_tile("input", FailingDataset(), str(path), EncodingProfile())
+
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize("compression", ["none", "zlib"])
+def test_rechunk_netcdf_compresses_as_the_profile_says(tmp_path, compression):
+    source = str(tmp_path / "source.nc")
+    target = str(tmp_path / "target.nc")
+    make_dataset(x=30, y=20).to_netcdf(source)
+
+    rechunk_netcdf(source, target, 10, EncodingProfile(compression=compression, level=7))
+
+    with netCDF4.Dataset(target) as ds:
+        filters = ds.variables["tmin"].filters()
+        assert ds.variables["tmin"].chunking() == [10, 10]
+    assert filters["zlib"] == (compression == "zlib")
+    assert filters["complevel"] == (7 if compression == "zlib" else 0)
+    with xr.open_dataset(source) as original, xr.open_dataset(target) as copy:
+        xr.testing.assert_equal(original, copy)
+
+
+def test_plan_blocks_groups_batches_of_a_row_band_within_the_budget(tmp_path):
+    batch_objs = Batch.create_list(4 * X_STEP, 2 * Y_STEP, str(tmp_path))
+    # two batches of a row fit, three don't
+    max_bytes = 2 * X_STEP * Y_STEP * 8 * 2
+
+    blocks = plan_blocks(batch_objs, 8, max_bytes)
+
+    assert sorted(obj.name for block in blocks for obj in block) == sorted(obj.name for obj in batch_objs)
+    assert len(blocks) == 4
+    for block in blocks:
+        assert len({obj.y_range for obj in block}) == 1
+        assert block_bytes(block, 8) <= max_bytes
+
+
+def test_a_batch_over_the_budget_is_a_block_by_itself(tmp_path):
+    batch_objs = Batch.create_list(300, 100, str(tmp_path))
+
+    assert [len(block) for block in plan_blocks(batch_objs, 8, 1)] == [1, 1, 1]
@@ -0,0 +1,92 @@
+import pytest
+import yaml
+
+from rctm_extra.gcp import LOCAL_BUCKET_ENV
+from rctm_extra.spinup import SpinCache, spin_cache_problems
+
+SPIN_OUTPUT = "run/batch_0/RCTM_output/spinup/RCTM_C_stocks_spin_output_grass-tree.tif"
+
+
+class FakePipeline:
+    """Writes the spin-up result like RCTM would and counts the spin-ups."""
+
+    spin_ups = 0
+
+    def __init__(self, bucket_root):
+        self.bucket_root = bucket_root
+
+    def run_spinup(self):
+        FakePipeline.spin_ups += 1
+        path = self.bucket_root / SPIN_OUTPUT
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"spun up")
+
+    def run_RCTM(self):
+        self.run_spinup()
+
+
+def write_config(tmp_path, **values):
+    input_dir = tmp_path / "inputs"
+    input_dir.mkdir(exist_ok=True)
+    (input_dir / "RCTM_spin_inputs.nc").write_bytes(b"spin inputs")
+    config_data = {"bucket_name": "bucket", "RCTM_input_dir": str(input_dir), "C_stock_spin_out_path": SPIN_OUTPUT}
+    config_data.update(values)
+    path = tmp_path / "config.yaml"
+    path.write_text(yaml.dump(config_data))
+    return str(path)
+
+
+@pytest.fixture
+def bucket(tmp_path, monkeypatch):
+    monkeypatch.setenv(LOCAL_BUCKET_ENV, str(tmp_path / "buckets"))
+    FakePipeline.spin_ups = 0
+    return tmp_path / "buckets" / "bucket"
+
+
+def test_a_second_batch_reuses_the_spin_up(tmp_path, bucket):
+    config_path = write_config(tmp_path)
+    spin_cache = SpinCache(str(tmp_path / "spin_cache"))
+
+    spin_cache.run(FakePipeline(bucket), config_path)
+    (bucket / SPIN_OUTPUT).unlink()
+    spin_cache.run(FakePipeline(bucket), config_path)
+
+    assert FakePipeline.spin_ups == 1
+    assert (bucket / SPIN_OUTPUT).read_bytes() == b"spun up"
+
+
+def test_a_config_without_the_spin_output_fails(tmp_path, bucket):
+    config_path = write_config(tmp_path, C_stock_spin_out_path=None)
+
+    assert spin_cache_problems(FakePipeline, [config_path])
+    with pytest.raises(KeyError):
+        SpinCache(str(tmp_path / "spin_cache")).run(FakePipeline(bucket), config_path)
+
+
+def test_a_pipeline_without_a_spin_up_method_fails(tmp_path, bucket):
+    config_path = write_config(tmp_path)
+
+    assert spin_cache_problems(object, [config_path])
+    assert spin_cache_problems(FakePipeline, [config_path]) == []
+
+
+def test_network_errors_run_uncached(tmp_path, bucket, monkeypatch):
+    config_path = write_config(tmp_path)
+    spin_cache = SpinCache(str(tmp_path / "spin_cache"))
+
+    def fail(*args, **kwargs):
+        raise ConnectionError("connection reset")
+
+    monkeypatch.setattr(spin_cache, "restore", fail)
+    monkeypatch.setattr(spin_cache, "save", fail)
+    spin_cache.run(FakePipeline(bucket), config_path)
+
+    assert FakePipeline.spin_ups == 1
+
+
+def test_the_spin_output_location_is_not_part_of_the_key(tmp_path, bucket):
+    spin_cache = SpinCache(str(tmp_path / "spin_cache"))
+    config_data = yaml.safe_load(open(write_config(tmp_path)))
+    other = dict(config_data, C_stock_spin_out_path="run/batch_1/RCTM_output/spinup/out.tif")
+
+    assert spin_cache.key(config_data) == spin_cache.key(other)
@@ -0,0 +1,161 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio
+import xarray as xr
+import yaml
+from rasterio.transform import from_origin
+
+from rctm_extra.cmd import split
+from rctm_extra.cmd.split import SplitCommand
+from rctm_extra.encoding import EncodingProfile
+from rctm_extra.gcp import LOCAL_BUCKET_ENV, TransferManager, get_storage_client, list_blob_checksums
+from rctm_extra.manifest import MANIFEST_NAME
+
+# 200 by 150 cells, split into four fixed batches
+X, Y = 200, 150
+CELL = 30.0
+X0, Y0 = 500000.0, 4000000.0
+BATCHES = ["batch_x_0-100_y_0-100", "batch_x_0-100_y_100-150", "batch_x_100-200_y_0-100", "batch_x_100-200_y_100-150"]
+
+
+def site_dataset(time_steps: int) -> xr.Dataset:
+    rng = np.random.default_rng(time_steps)
+    return xr.Dataset(
+        {"ndvi": (("time", "y", "x"), rng.random((time_steps, Y, X)))},
+        coords={
+            "time": pd.date_range("2000-01-01", periods=time_steps, freq="MS"),
+            "y": Y0 - CELL * np.arange(Y),
+            "x": X0 + CELL * np.arange(X),
+        },
+    )
+
+
+@pytest.fixture
+def site(tmp_path, monkeypatch):
+    """A site in a local bucket, and the config and RCTM folder split is run with."""
+    monkeypatch.setenv(LOCAL_BUCKET_ENV, str(tmp_path / "buckets"))
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    get_storage_client.cache_clear()
+    site_path = tmp_path / "buckets" / "bucket" / "site"
+    os.makedirs(site_path / "RCTM_ins")
+    os.makedirs(site_path / "params")
+    site_dataset(3).to_netcdf(site_path / "RCTM_ins" / "RCTM_inputs.nc")
+    site_dataset(4).to_netcdf(site_path / "RCTM_ins" / "RCTM_spin_inputs.nc")
+    profile = {
+        "driver": "GTiff", "width": X, "height": Y, "count": 1, "dtype": "float32",
+        "crs": "EPSG:32613", "transform": from_origin(X0 - CELL / 2, Y0 + CELL / 2, CELL, CELL),
+    }
+    with rasterio.open(site_path / "params" / "spatial_params.tif", "w", **profile) as dst:
+        dst.write(np.ones((1, Y, X), dtype=np.float32))
+
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text(yaml.dump({"bucket_name": "bucket", "gcloud_workflow_base_dir": "site"}))
+    os.makedirs(tmp_path / "rctm")
+    os.makedirs(tmp_path / "home")
+    yield site_path
+    get_storage_client.cache_clear()
+
+
+def make_args(tmp_path, **overrides):
+    args = {
+        "config_path": str(tmp_path / "config.yaml"),
+        "remote_batch_path": "run",
+        "rctm_path": str(tmp_path / "rctm"),
+        "workers": 2,
+        "transfer_workers": 2,
+        "tiling": "fixed",
+        "target_cells": 10000,
+        "max_tile_size": None,
+        "dry_run": False,
+        "pipeline": False,
+        "config_index": False,
+        "virtual": False,
+        "bbox": None,
+        "time_range": None,
+        "run_dir": None,
+        "memory_budget": None,
+        "job_resources": False,
+        "history_path": str(tmp_path / "history.jsonl"),
+        "report_path": None,
+        "encoding_profile": EncodingProfile(),
+    }
+    args.update(overrides)
+    return type("Args", (), args)()
+
+
+def record_uploads(monkeypatch) -> list:
+    uploads = []
+    upload_files = TransferManager.upload_files
+
+    def recording(self, tasks, progress=None):
+        uploads.extend(blob_name for _, blob_name in tasks)
+        return upload_files(self, tasks, progress)
+
+    monkeypatch.setattr(TransferManager, "upload_files", recording)
+    return uploads
+
+
+def tile_checksums() -> dict:
+    checksums = list_blob_checksums(get_storage_client(), "bucket", "run")
+    return {name: md5 for name, md5 in checksums.items() if name.endswith((".nc", ".tif"))}
+
+
+def test_a_bbox_update_only_rewrites_the_tiles_that_overlap_it(tmp_path, site, monkeypatch, capsys):
+    SplitCommand(make_args(tmp_path)).execute()
+    run_dir = str(tmp_path / "home" / "split_data")
+    before = tile_checksums()
+    assert len(before) == 3 * len(BATCHES)
+
+    # cells 10 to 19 along both axes changed, all in the first batch
+    with xr.open_dataset(site / "RCTM_ins" / "RCTM_inputs.nc") as ds:
+        changed = ds.load()
+    changed["ndvi"][:, 10:20, 10:20] = -1.0
+    changed.to_netcdf(site / "RCTM_ins" / "RCTM_inputs.nc")
+    bbox = f"{X0 + 10 * CELL},{Y0 - 19 * CELL},{X0 + 19 * CELL},{Y0 - 10 * CELL}"
+    uploads = record_uploads(monkeypatch)
+
+    capsys.readouterr()
+    SplitCommand(make_args(tmp_path, bbox=bbox, run_dir=run_dir)).execute()
+
+    assert f"1 of {len(BATCHES)} batches overlap the change" in capsys.readouterr().out
+    after = tile_checksums()
+    assert {name for name in after if after[name] != before[name]} == {f"run/{BATCHES[0]}/RCTM_ins/RCTM_inputs.nc"}
+    assert [name for name in uploads if name != f"run/{MANIFEST_NAME}"] == [f"run/{BATCHES[0]}/RCTM_ins/RCTM_inputs.nc"]
+    with open(os.path.join(run_dir, MANIFEST_NAME)) as file:
+        manifest = json.load(file)
+    assert sorted({entry["batch"] for entry in manifest["files"].values()}) == BATCHES
+
+
+def test_a_pipelined_split_keeps_failed_uploads_out_of_the_manifest(tmp_path, site, monkeypatch):
+    failing_blob = f"run/{BATCHES[1]}/RCTM_ins/RCTM_inputs.nc"
+
+    class FailingTransferManager(TransferManager):
+        def upload_file(self, local_path, blob_name):
+            if blob_name == failing_blob:
+                raise ConnectionError("connection reset")
+            return super().upload_file(local_path, blob_name)
+
+    monkeypatch.setattr(split, "TransferManager", FailingTransferManager)
+
+    with pytest.raises(SystemExit):
+        SplitCommand(make_args(tmp_path, pipeline=True)).execute()
+
+    run_dir = tmp_path / "home" / "split_data"
+    with open(run_dir / MANIFEST_NAME) as file:
+        manifest = json.load(file)
+    assert f"{BATCHES[1]}/RCTM_ins/RCTM_inputs.nc" not in manifest["files"]
+    assert len([path for path in manifest["files"] if path.endswith((".nc", ".tif"))]) == 3 * len(BATCHES) - 1
+    assert failing_blob not in tile_checksums()
+
+    # uploaded tiles are gone from the scratch disk, the failed one stays to look into
+    local_tiles = sorted(
+        os.path.relpath(os.path.join(dirpath, name), run_dir)
+        for dirpath, _, names in os.walk(run_dir)
+        for name in names
+        if dirpath != str(run_dir) and name.endswith((".nc", ".tif"))
+    )
+    assert local_tiles == [f"{BATCHES[1]}/RCTM_ins/RCTM_inputs.nc"]
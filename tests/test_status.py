@@ -0,0 +1,46 @@
+import pytest
+
+from rctm_extra.cmd import status
+from rctm_extra.cmd.status import UNREPORTED, StatusCommand
+from rctm_extra.status import FAILED, SUBMITTED, StatusStore
+
+
+def make_args(tmp_path, **overrides):
+    args = {
+        "local_batch_path": str(tmp_path),
+        "bucket_name": None,
+        "remote_batch_path": None,
+        "retry": False,
+        "max_retries": 2,
+        "watch": 0,
+        "verbose": False,
+        "history_path": str(tmp_path / "history.jsonl"),
+    }
+    args.update(overrides)
+    return type("Args", (), args)()
+
+
+def test_a_job_the_scheduler_no_longer_reports_fails_after_a_poll(tmp_path, monkeypatch):
+    monkeypatch.setattr(status, "query_states", lambda job_ids: {})
+    with StatusStore(str(tmp_path)) as store:
+        store.record_submission({"batch_x_0-100_y_0-100": "101"})
+        command = StatusCommand(make_args(tmp_path))
+
+        command._poll(store)
+        assert [row[2:4] for row in store.batches()] == [(SUBMITTED, UNREPORTED)]
+
+        command._poll(store)
+        assert [row[2:4] for row in store.batches()] == [(FAILED, UNREPORTED)]
+
+
+def test_watch_ends_when_only_unreported_jobs_are_left(tmp_path, monkeypatch):
+    monkeypatch.setattr(status, "query_states", lambda job_ids: {})
+    sleeps = []
+    monkeypatch.setattr(status.time, "sleep", sleeps.append)
+    with StatusStore(str(tmp_path)) as store:
+        store.record_submission({"batch_x_0-100_y_0-100": "101"})
+
+    with pytest.raises(SystemExit):
+        StatusCommand(make_args(tmp_path, watch=60)).execute()
+
+    assert sleeps == [60]
@@ -0,0 +1,50 @@
+import pytest
+
+from rctm_extra.cmd import submit
+from rctm_extra.cmd.submit import SubmitCommand
+from rctm_extra.local_storage import LocalStorageClient
+from rctm_extra.status import StatusStore
+
+BATCHES = ["batch_x_0-100_y_0-100", "batch_x_100-200_y_0-100"]
+
+
+def make_args(tmp_path, **overrides):
+    args = {
+        "bucket_name": "bucket",
+        "remote_batch_path": "run",
+        "local_batch_path": str(tmp_path / "local"),
+        "transfer_workers": 2,
+        "array": False,
+        "batches_per_task": 1,
+        "max_concurrent": None,
+        "max_array_size": 1000,
+        "pack_cpus": None,
+        "pack_hours": 4,
+        "report_path": None,
+    }
+    args.update(overrides)
+    return type("Args", (), args)()
+
+
+def test_submissions_before_sbatch_went_missing_are_recorded(tmp_path, monkeypatch):
+    client = LocalStorageClient(str(tmp_path / "buckets"))
+    for name in BATCHES:
+        for file_name in ("config.yaml", "slurm_runner.sh"):
+            client.bucket("bucket").blob(f"run/{name}/{file_name}").upload_from_string(f"{name} {file_name}")
+    monkeypatch.setattr(submit, "get_storage_client", lambda workers: client)
+
+    job_ids = iter(["101"])
+
+    def sbatch(path):
+        try:
+            return next(job_ids)
+        except StopIteration:
+            raise FileNotFoundError("sbatch") from None
+
+    monkeypatch.setattr(submit, "sbatch", sbatch)
+
+    with pytest.raises(SystemExit):
+        SubmitCommand(make_args(tmp_path)).execute()
+
+    with StatusStore(str(tmp_path / "local")) as store:
+        assert [(name, job_id) for name, job_id, *_ in store.batches()] == [(BATCHES[0], "101")]
@@ -0,0 +1,56 @@
+import numpy as np
+
+from rctm_extra.tiling import ValidCellGrid
+
+
+def make_grid(counts, align=10):
+    counts = np.array(counts)
+    return ValidCellGrid(counts, align, counts.shape[1] * align, counts.shape[0] * align)
+
+
+def test_count_sums_the_blocks_of_a_window():
+    grid = make_grid([[1, 2, 3], [4, 5, 6]])
+
+    assert grid.count((0, 30), (0, 20)) == 21
+    assert grid.count((10, 30), (10, 20)) == 11
+
+
+def test_balanced_windows_cover_every_valid_cell_once():
+    rng = np.random.default_rng(0)
+    counts = rng.integers(0, 100, size=(12, 17))
+    grid = make_grid(counts)
+
+    windows = grid.balanced_windows(target_cells=800)
+
+    assert sum(cells for _, _, cells in windows) == counts.sum()
+    covered = np.zeros_like(counts)
+    for x_range, y_range, cells in windows:
+        covered[y_range[0] // 10:-(-y_range[1] // 10), x_range[0] // 10:-(-x_range[1] // 10)] += 1
+        assert cells == grid.count(x_range, y_range)
+        assert cells <= 800 or (x_range[1] - x_range[0], y_range[1] - y_range[0]) == (10, 10)
+    assert covered.max() == 1
+
+
+def test_balanced_windows_skip_empty_regions():
+    grid = make_grid([[0, 0, 0, 0], [0, 0, 0, 50], [0, 0, 0, 0]])
+
+    assert grid.balanced_windows(target_cells=100) == [((30, 40), (10, 20), 50)]
+
+
+def test_balanced_windows_respect_the_maximum_size():
+    grid = make_grid(np.ones((4, 8), dtype=int))
+
+    windows = grid.balanced_windows(target_cells=1000, max_size=20)
+
+    assert len(windows) == 8
+    assert all(x[1] - x[0] <= 20 and y[1] - y[0] <= 20 for x, y, _ in windows)
+
+
+def test_edge_windows_are_clipped_to_the_grid():
+    counts = np.ones((2, 2), dtype=int)
+    grid = ValidCellGrid(counts, 10, 15, 12)
+
+    windows = grid.balanced_windows(target_cells=1)
+
+    assert max(x[1] for x, _, _ in windows) == 15
+    assert max(y[1] for _, y, _ in windows) == 12